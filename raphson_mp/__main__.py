@@ -27,6 +27,9 @@ def handle_start(args: Any, logconfig_dict: dict) -> None:
 
     if args.dev:
         log.info('Starting Flask web server in debug mode')
+        if os.getenv('WERKZEUG_RUN_MAIN') == 'true':  # only in reloaded child process
+            from raphson_mp import warmup
+            warmup.start()
         app = app_main.get_app(args.proxy_count, True)
         app.run(host=args.host, port=args.port, debug=True)
         return
@@ -156,6 +159,42 @@ def handle_scan(_args: Any) -> None:
     scanner.scan()
 
 
+def handle_warmup(_args: Any) -> None:
+    """
+    Handle command to warm up new or changed tracks
+    """
+    from raphson_mp import warmup
+
+    warmup.run()
+
+
+def handle_benchmark_normalization(args: Any) -> None:
+    """
+    Handle command to compare CPU time of loudness normalization modes
+    """
+    from raphson_mp import benchmark
+
+    benchmark.normalization(args.tracks)
+
+
+def handle_transcode_report(args: Any) -> None:
+    """
+    Handle command to show resource usage of ffmpeg processes
+    """
+    from raphson_mp import benchmark
+
+    benchmark.transcode_report(args.limit, args.days)
+
+
+def handle_cache_report(_args: Any) -> None:
+    """
+    Handle command to show cache composition
+    """
+    from raphson_mp import benchmark
+
+    benchmark.cache_report()
+
+
 def handle_cleanup(_args: Any) -> None:
     """
     Handle command to clean up old entries from databases
@@ -319,6 +358,42 @@ def main():
     parser.add_argument('--news-server',
                         help='news server url: https://github.com/Derkades/news-scraper',
                         default=_strenv('NEWS_SERVER', 'http://127.0.0.1:43473'))
+    parser.add_argument('--transcode-streaming',
+                        action='store_true',
+                        default=_boolenv('TRANSCODE_STREAMING'),
+                        help='send audio to the client while it is being transcoded, instead of after transcoding has finished')
+    parser.add_argument('--normalization',
+                        choices=['loudnorm', 'gain'],
+                        default=_strenv('NORMALIZATION', 'loudnorm'),
+                        help='loudness normalization mode: two-pass loudnorm filter, or a cheaper static gain with limiter only when required')
+    parser.add_argument('--max-jobs',
+                        type=int,
+                        default=_intenv('MAX_JOBS', 0),
+                        help='maximum number of ffmpeg processes running at the same time, by default the number of CPU cores')
+    parser.add_argument('--warmup',
+                        action='store_true',
+                        default=_boolenv('WARMUP'),
+                        help='transcode new or changed tracks in the background, before they are played')
+    parser.add_argument('--warmup-workers',
+                        type=int,
+                        default=_intenv('WARMUP_WORKERS', 0),
+                        help='number of tracks to warm up concurrently, by default half the number of CPU cores')
+    parser.add_argument('--scan-video',
+                        action='store_true',
+                        default=_boolenv('SCAN_VIDEO'),
+                        help='prepare music videos for playback in the background after scanning, instead of when they are first played')
+    parser.add_argument('--proxy-offload',
+                        choices=('nginx', 'sendfile'),
+                        default=_strenv('PROXY_OFFLOAD'),
+                        help='let the reverse proxy send audio, covers and downloads from disk, using X-Accel-Redirect (nginx) or X-Sendfile')
+    parser.add_argument('--cache-memory-mb',
+                        type=int,
+                        default=_intenv('CACHE_MEMORY_MB', 64),
+                        help='memory used by each process to keep small, frequently used cache entries, in MiB')
+    parser.add_argument('--cache-max-gb',
+                        type=int,
+                        default=_intenv('CACHE_MAX_GB', 0),
+                        help='maximum size of cached data in GiB, least recently used entries are removed when exceeded. By default, the cache size is not limited.')
 
     subparsers = parser.add_subparsers(required=True)
 
@@ -359,6 +434,28 @@ def main():
                                      help='scan playlists for changes')
     cmd_scan.set_defaults(func=handle_scan)
 
+    cmd_warmup = subparsers.add_parser('warmup',
+                                       help='hash and measure loudness of new tracks, and transcode tracks that were added or changed since the last warm-up')
+    cmd_warmup.set_defaults(func=handle_warmup)
+
+    cmd_benchmark_normalization = subparsers.add_parser('benchmark-normalization',
+                                                        help='compare CPU time of loudness normalization modes')
+    cmd_benchmark_normalization.add_argument('--tracks', type=int, default=10,
+                                             help='number of randomly chosen tracks to transcode')
+    cmd_benchmark_normalization.set_defaults(func=handle_benchmark_normalization)
+
+    cmd_transcode_report = subparsers.add_parser('transcode-report',
+                                                 help='show slowest tracks and CPU time per audio type')
+    cmd_transcode_report.add_argument('--limit', type=int, default=20,
+                                      help='number of slowest tracks to show')
+    cmd_transcode_report.add_argument('--days', type=int, default=30,
+                                      help='only include processes from this many recent days')
+    cmd_transcode_report.set_defaults(func=handle_transcode_report)
+
+    cmd_cache_report = subparsers.add_parser('cache-report',
+                                             help='show size of cached data by namespace and time since last use')
+    cmd_cache_report.set_defaults(func=handle_cache_report)
+
     cmd_cleanup = subparsers.add_parser('cleanup',
                                         help='clean old or unused data from the database')
     cmd_cleanup.set_defaults(func=handle_cleanup)
@@ -414,6 +511,15 @@ def main():
     settings.spotify_api_secret = args.spotify_api_secret
     settings.offline_mode = args.offline
     settings.news_server = args.news_server
+    settings.transcode_streaming = args.transcode_streaming
+    settings.normalization_mode = args.normalization
+    settings.max_jobs = args.max_jobs
+    settings.warmup = args.warmup
+    settings.warmup_workers = args.warmup_workers
+    settings.scan_video = args.scan_video
+    settings.proxy_offload = args.proxy_offload
+    settings.cache_memory_mb = args.cache_memory_mb
+    settings.cache_max_gb = args.cache_max_gb
 
     if settings.offline_mode:
         settings.music_dir = Path('/dev/null')
@@ -0,0 +1,152 @@
+"""
+Benchmarks and reports, run from the command line
+"""
+import logging
+import resource
+import subprocess
+import time
+
+from raphson_mp import cache, db, settings
+from raphson_mp.music import Track
+
+log = logging.getLogger(__name__)
+
+
+def _cpu_time(command: list[str]) -> float:
+    """
+    Run command
+    Returns: User and system CPU time used by the command, in seconds
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    subprocess.run(command, shell=False, check=True)
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+
+def _transcode_command(track: Track, audio_filter: str) -> list[str]:
+    # Same encoder settings as AudioType.WEBM_OPUS_HIGH, output is discarded
+    return ['ffmpeg',
+            '-y',
+            *settings.ffmpeg_flags(),
+            '-i', track.path.resolve().as_posix(),
+            '-map', '0:a',
+            '-map_metadata', '-1',
+            '-f', 'webm',
+            '-c:a', 'libopus',
+            '-b:a', '128k',
+            '-vbr', 'on',
+            '-frame_duration', '60',
+            '-t', str(settings.track_max_duration_seconds),
+            '-ac', '2',
+            '-filter:a', audio_filter,
+            '/dev/null']
+
+
+def normalization(track_count: int) -> None:
+    """
+    Compare CPU time of transcoding random tracks using each loudness normalization mode. No
+    normalization ('anull' filter) is included as a baseline, showing the cost of decoding
+    and encoding alone.
+    """
+    with db.connect(read_only=True) as conn:
+        relpaths = [row[0] for row in conn.execute('''
+                                                   SELECT path FROM track
+                                                   WHERE loudness_i IS NOT NULL
+                                                   ORDER BY RANDOM() LIMIT ?
+                                                   ''', (track_count,))]
+        if not relpaths:
+            print('No tracks with measured loudness, please scan first.')
+            return
+
+        totals = {'none': 0.0, 'loudnorm': 0.0, 'gain': 0.0}
+        duration = 0
+
+        for relpath in relpaths:
+            track = Track.by_relpath(conn, relpath)
+            assert track
+            filters = {'none': 'anull',
+                       'loudnorm': track.get_loudnorm_filter(),
+                       'gain': track.get_gain_filter()}
+            for mode, audio_filter in filters.items():
+                cpu_time = _cpu_time(_transcode_command(track, audio_filter))
+                log.info('%s %s: %.2fs', mode, relpath, cpu_time)
+                totals[mode] += cpu_time
+            duration += min(track.metadata().duration, settings.track_max_duration_seconds)
+
+    print(f'Transcoded {len(relpaths)} tracks, {duration} seconds of audio')
+    print('mode      CPU time per track  CPU time per audio minute')
+    for mode, total in totals.items():
+        print(f'{mode:<9} {total / len(relpaths):>17.2f}s  {total / duration * 60:>24.2f}s')
+
+
+def transcode_report(limit: int, days: int) -> None:
+    """
+    Print resource usage of ffmpeg processes recorded by jobs.wait(): the tracks that took the most
+    CPU time, and total CPU time per kind of process (audio type, thumbnail, etc.)
+    """
+    since = int(time.time()) - days * 24 * 3600
+    with db.connect(read_only=True) as conn:
+        slowest = conn.execute('''
+                               SELECT track, kind, wall_time, user_time + system_time
+                               FROM transcode
+                               WHERE timestamp > ? AND track IS NOT NULL
+                               ORDER BY user_time + system_time DESC
+                               LIMIT ?
+                               ''', (since, limit)).fetchall()
+        per_kind = conn.execute('''
+                                SELECT kind, COUNT(*), SUM(user_time + system_time), AVG(user_time + system_time),
+                                       AVG(wall_time), SUM(input_bytes), SUM(output_bytes), SUM(returncode != 0)
+                                FROM transcode
+                                WHERE timestamp > ?
+                                GROUP BY kind
+                                ORDER BY SUM(user_time + system_time) DESC
+                                ''', (since,)).fetchall()
+
+    if not per_kind:
+        print(f'No processes recorded in the last {days} days')
+        return
+
+    print(f'Slowest tracks in the last {days} days')
+    print('CPU time  wall time  kind                  track')
+    for track, kind, wall_time, cpu_time in slowest:
+        print(f'{cpu_time:>7.2f}s  {wall_time:>8.2f}s  {kind:<20}  {track}')
+
+    print()
+    print('kind                  count  total CPU  avg CPU  avg wall   input MB  output MB  failed')
+    for kind, count, total_cpu, avg_cpu, avg_wall, input_bytes, output_bytes, failed in per_kind:
+        print(f'{kind:<20} {count:>6} {total_cpu:>9.1f}s {avg_cpu:>7.2f}s {avg_wall:>8.2f}s '
+              f'{input_bytes / 1e6:>10.1f} {output_bytes / 1e6:>10.1f} {failed:>7}')
+
+
+def cache_report() -> None:
+    """
+    Print composition of the cache: number and size of entries per key namespace, and size by the
+    time since entries were last used.
+    """
+    # Last access time is only updated once per cache.ACCESS_RESOLUTION
+    age_buckets = {'<1 day': cache.DAY, '<1 week': cache.WEEK, '<1 month': cache.MONTH, 'older': None}
+    now = int(time.time())
+
+    namespaces: dict[str, dict[str, int]] = {}
+    with db.cache(read_only=True) as conn:
+        for key, size, expire_time, last_access in conn.execute('SELECT key, size, expire_time, last_access FROM cache'):
+            counts = namespaces.setdefault(cache.namespace(key), {'entries': 0, 'size': 0, 'expired': 0,
+                                                                   **{bucket: 0 for bucket in age_buckets}})
+            counts['entries'] += 1
+            counts['size'] += size
+            if expire_time < now:
+                counts['expired'] += 1
+            for bucket, max_age in age_buckets.items():
+                if max_age is None or now - last_access < max_age:
+                    counts[bucket] += size
+                    break
+
+    if not namespaces:
+        print('Cache is empty')
+        return
+
+    print('Size in MB, by time since last use')
+    print('namespace  entries  expired     size ' + ' '.join(f'{bucket:>9}' for bucket in age_buckets))
+    for name, counts in sorted(namespaces.items(), key=lambda item: item[1]['size'], reverse=True):
+        print(f'{name:<10} {counts["entries"]:>7} {counts["expired"]:>8} {counts["size"] / 1e6:>8.1f} ' +
+              ' '.join(f'{counts[bucket] / 1e6:>9.1f}' for bucket in age_buckets))
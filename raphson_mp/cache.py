@@ -1,12 +1,25 @@
 """
 Functions related to the cache (cache.db)
 """
+import atexit
+import fcntl
+import functools
+import hashlib
 import logging
+import os
 import random
+import tempfile
+import threading
 import time
-from typing import Any
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from pathlib import Path
+from sqlite3 import Connection, OperationalError
+from threading import Condition, Thread
+from typing import IO, Any
 
-from raphson_mp import db, jsonw
+from raphson_mp import db, jsonw, refresh, settings
 
 log = logging.getLogger(__name__)
 
@@ -17,60 +30,787 @@ MONTH = 30*DAY
 HALFYEAR = 6*MONTH
 YEAR = 12*MONTH
 
+# Data of at least this size is stored as a file in the cache directory, instead of as a BLOB in cache.db
+EXTERNAL_MIN_SIZE = 128*1024
+
+# Only small entries are kept in memory, see _MemoryCache
+MEMORY_MAX_ENTRY_SIZE = 64*1024
+# Entries are kept in memory for at most this duration, so entries replaced by another process
+# are not served from memory for longer than this
+MEMORY_MAX_AGE = 10*60
+
+# The last access time of an entry is only updated when it is older than this, so retrieving an
+# entry rarely requires writing to the database
+ACCESS_RESOLUTION = HOUR
+# Updated access times are written in batches, at most once per this many seconds
+ACCESS_FLUSH_INTERVAL = 60
+
+# Files of evicted entries are deleted right away, unless they were modified this recently. Such a
+# file may be about to be referenced by an entry that is being stored, see store_file().
+EVICT_MIN_FILE_AGE = 10*60
+
+# Entries stored using store() are written to the database in batches, after waiting this many
+# seconds for more entries to be stored
+WRITE_DELAY = 0.005
+
+
+# Cache keys start with one of these namespaces, statistics are kept per namespace
+NAMESPACES = ('audio', 'segment', 'video', 'cover', 'lyrics', 'news')
+OTHER_NAMESPACE = 'other'
+
+
+def namespace(key: str) -> str:
+    """
+    Returns: Namespace of a cache key, or OTHER_NAMESPACE
+    """
+    for name in NAMESPACES:
+        if key.startswith(name):
+            return name
+    return OTHER_NAMESPACE
+
+
+@dataclass
+class NamespaceStats:
+    """
+    Statistics of this process for cache keys in a namespace, exported as metrics by prometheus.py
+    """
+    hits: int = 0
+    misses: int = 0
+    expired_hits: int = 0  # expired entries returned, included in hits
+    bytes_stored: int = 0
+    bytes_served: int = 0  # size of returned data or files
+
+
+stats: dict[str, NamespaceStats] = {name: NamespaceStats() for name in (*NAMESPACES, OTHER_NAMESPACE)}
+# Functions called with the namespace and duration in seconds of every retrieve() and retrieve_file()
+retrieve_observers: list[Callable[[str, float], None]] = []
+
+
+def _cache_dir() -> Path:
+    cache_dir = settings.data_dir / 'cache'
+    cache_dir.mkdir(exist_ok=True)
+    return cache_dir
+
+
+def _external_path(digest: str) -> Path:
+    """
+    Files are content-addressed, named after their sha256 digest. They are spread over
+    subdirectories to avoid a single directory with a huge number of files.
+    """
+    return _cache_dir() / digest[:2] / digest
+
+
+def temp_file() -> IO[bytes]:
+    """
+    Create a temporary file in the cache directory. Unlike a file in /tmp, it is on the same
+    file system as the cache, so it can be stored using store_file() without copying.
+    """
+    return tempfile.NamedTemporaryFile(dir=_cache_dir(), prefix='.tmp')
+
+
+def _expire_time(duration: int) -> int:
+    # Vary cache duration so cached data doesn't all expire at once
+    duration += random.randint(-duration // 4, duration // 4)
+    return int(time.time()) + duration
+
+
+def _lock_dir() -> Path:
+    lock_dir = settings.data_dir / 'locks'
+    lock_dir.mkdir(exist_ok=True)
+    return lock_dir
+
+
+class Lock:
+    """
+    Exclusive lock for a cache key, shared by all threads and processes using the same data
+    directory. Used to ensure the same expensive operation is not performed multiple times
+    concurrently: after acquiring the lock, check the cache again before doing the work.
+    """
+    path: Path
+    _fd: int | None = None
+
+    def __init__(self, key: str):
+        self.path = _lock_dir() / hashlib.sha1(key.encode()).hexdigest()
+
+    def acquire(self) -> None:
+        """
+        Acquire lock, blocking until it is available
+        """
+        assert self._fd is None, 'lock is not reentrant'
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # The lock file may have been deleted by cleanup while we were waiting, in which case
+            # another process may have locked a new file with the same name.
+            try:
+                if os.stat(self.path).st_ino == os.fstat(fd).st_ino:
+                    self._fd = fd
+                    return
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def release(self) -> None:
+        """
+        Release lock. May be called from a different thread than the one that acquired the lock.
+        """
+        assert self._fd is not None, 'lock is not acquired'
+        # Other processes waiting for the lock check the cache database after acquiring it
+        flush()
+        os.close(self._fd)  # closing the file releases the lock
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args: Any):
+        self.release()
+
+
+class _MemoryCache:
+    """
+    Least recently used entries of cache.db, kept in memory so hot entries (lyrics, loudness, cover
+    thumbnails) can be retrieved without a database query. Expired entries are never returned from
+    memory, retrieve() falls back to the database which decides whether to return expired data.
+    """
+    _lock: threading.Lock
+    _entries: OrderedDict[str, tuple[bytes, float]]  # data and expire time, least recently used first
+    size: int = 0  # total size of data in bytes
+    hits: int = 0
+    misses: int = 0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            data, expire_time = entry
+            if expire_time < time.time():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, data: bytes, expire_time: float) -> None:
+        max_size = settings.cache_memory_mb * 1024 * 1024
+        with self._lock:
+            self._remove(key)
+            if len(data) > MEMORY_MAX_ENTRY_SIZE or len(data) > max_size:
+                return
+            self._entries[key] = (data, min(expire_time, time.time() + MEMORY_MAX_AGE))
+            self.size += len(data)
+            while self.size > max_size:
+                _key, (evicted, _expire_time) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+
+memory = _MemoryCache()
+
+_access_lock = threading.Lock()
+_accessed: dict[str, int] = {}  # access times not written to the database yet
+_access_flushed: float = time.monotonic()
+_evict_lock = threading.Lock()
+_stored_since_evict: int = 0  # bytes stored by this process since the cache size was last checked
+_evicting: bool = False  # whether an eviction thread started by _stored() is running
+
+
+def _record_access(key: str) -> None:
+    global _access_flushed
+
+    with _access_lock:
+        _accessed[key] = int(time.time())
+        if time.monotonic() - _access_flushed < ACCESS_FLUSH_INTERVAL:
+            return
+        batch = [(access_time, key) for key, access_time in _accessed.items()]
+        _accessed.clear()
+        _access_flushed = time.monotonic()
+
+    try:
+        with db.cache() as conn:
+            conn.executemany('UPDATE cache SET last_access=? WHERE key=?', batch)
+    except OperationalError:
+        # Access times are approximate, it is fine to lose some
+        log.warning('Failed to update access time of %s cache entries', len(batch), exc_info=True)
+
+
+def _stored(size: int) -> None:
+    """
+    Check cache size in the background after a significant amount of data has been stored
+    """
+    global _stored_since_evict, _evicting
+
+    if not settings.cache_max_gb:
+        return
+
+    with _evict_lock:
+        _stored_since_evict += size
+        if _evicting or _stored_since_evict < settings.cache_max_gb * 1024**3 // 100:
+            return
+        _stored_since_evict = 0
+        _evicting = True
+
+    Thread(target=_evict_background, daemon=True, name='cache-evict').start()
+
+
+def _evict_background() -> None:
+    global _evicting
+
+    try:
+        evict()
+    except Exception:
+        log.warning('Failed to evict cache entries', exc_info=True)
+    finally:
+        with _evict_lock:
+            _evicting = False
+
+
+# Entries stored using store() that have not been written to the database yet. Entries stay in
+# this dict until they have been committed, so they can be retrieved in the meantime.
+_pending: dict[str, tuple[bytes, int]] = {}
+_pending_lock = threading.Lock()
+_pending_condition = Condition(_pending_lock)
+# Held while writing to the database, so entries are written in the order they were stored
+_write_lock = threading.Lock()
+_writer_pid: int | None = None  # process the writer thread was started in, it does not survive fork()
+
+
+def _write_pending() -> None:
+    with _pending_lock:
+        batch = dict(_pending)
+
+    if not batch:
+        return
+
+    now = int(time.time())
+    try:
+        with db.cache() as conn:
+            conn.executemany("""
+                             INSERT OR REPLACE INTO cache (key, data, expire_time, external, size, last_access)
+                             VALUES (?, ?, ?, NULL, ?, ?)
+                             """, [(key, data, expire_time, len(data), now)
+                                   for key, (data, expire_time) in batch.items()])
+    except Exception:
+        log.exception('Failed to write %s cache entries', len(batch))
+
+    with _pending_lock:
+        for key, entry in batch.items():
+            # Keep the entry if it has been stored again while writing
+            if _pending.get(key) is entry:
+                del _pending[key]
+
+
+def flush() -> None:
+    """
+    Write entries stored using store() to the database
+    """
+    with _write_lock:
+        _write_pending()
+
+
+def _writer() -> None:
+    while True:
+        with _pending_condition:
+            _pending_condition.wait_for(lambda: len(_pending) > 0)
+        # Wait for more entries, for example other thumbnail sizes of the same cover
+        time.sleep(WRITE_DELAY)
+        flush()
+
 
 def store(key: str,
           data: bytes,
           duration: int) -> None:
     """
+    Entries smaller than EXTERNAL_MIN_SIZE are written to the database in the background, together
+    with other entries stored at around the same time. They can be retrieved immediately by the
+    same process, other processes can retrieve them after a few milliseconds or after a Lock for
+    the key has been released.
     Args:
         key: Cache key
         data: Data to cache
         duration: Suggested cache duration in seconds. Cache duration is varied by up to 25%, to
                   avoid high load when cache entries all expire at roughly the same time.
     """
-    with db.cache() as conn:
-        # Vary cache duration so cached data doesn't all expire at once
-        duration += random.randint(-duration // 4, duration // 4)
+    global _writer_pid
 
-        expire_time = int(time.time()) + duration
-        conn.execute("""
-                     INSERT OR REPLACE INTO cache (key, data, expire_time)
-                     VALUES (?, ?, ?)
-                     """, (key, data, expire_time))
+    if len(data) >= EXTERNAL_MIN_SIZE:
+        with temp_file() as temp:
+            temp.write(data)
+            temp.flush()
+            store_file(key, Path(temp.name), duration)
+        return
 
+    stats[namespace(key)].bytes_stored += len(data)
+    expire_time = _expire_time(duration)
+    with _pending_condition:
+        _pending[key] = (data, expire_time)
+        _pending_condition.notify()
+        if _writer_pid != os.getpid():
+            _writer_pid = os.getpid()
+            Thread(target=_writer, daemon=True, name='cache-writer').start()
+    memory.put(key, data, expire_time)
+    _stored(len(data))
 
-def retrieve(key: str,
-             return_expired: bool = True) -> bytes | None:
+
+atexit.register(flush)
+
+
+def store_file(key: str,
+               path: Path,
+               duration: int) -> Path:
     """
-    Retrieve object from cache
+    Store contents of a file in the cache, without reading it into memory. The file must be
+    located in the cache directory, use temp_file() to create it. The original file is left
+    in place, the caller is responsible for deleting it.
     Args:
         key: Cache key
-        return_expired: Whether to return the object from cache even when expired, but not cleaned
-                        up yet. Should be set to False for short lived cache objects.
+        path: File to cache
+        duration: Suggested cache duration in seconds, see store()
+    Returns: Path to cached file
+    """
+    with path.open('rb') as fp:
+        digest = hashlib.file_digest(fp, 'sha256').hexdigest()
+
+    external_path = _external_path(digest)
+    external_path.parent.mkdir(exist_ok=True)
+    try:
+        # A hard link is created instead of moving the file, so the caller can keep using the
+        # temporary file and have it deleted as usual
+        os.link(path, external_path)
+    except FileExistsError:
+        # Identical data is already cached under a different key. Update modification time so
+        # cleanup doesn't consider the file orphaned before our cache entry is inserted.
+        os.utime(external_path)
+
+    size = external_path.stat().st_size
+    stats[namespace(key)].bytes_stored += size
+    with _write_lock:
+        # An older entry for the same key that has not been written yet must not replace this entry
+        with _pending_lock:
+            _pending.pop(key, None)
+        with db.cache() as conn:
+            conn.execute("""
+                         INSERT OR REPLACE INTO cache (key, data, expire_time, external, size, last_access)
+                         VALUES (?, x'', ?, ?, ?, ?)
+                         """, (key, _expire_time(duration), digest, size, int(time.time())))
+    memory.remove(key)
+    _stored(size)
+
+    return external_path
+
+
+class _StreamState:
+    """
+    Progress of a stream being written to a temporary file by store_stream()
     """
+    condition: Condition
+    written: int = 0
+    done: bool = False
+    error: BaseException | None = None
+
+    def __init__(self):
+        self.condition = Condition()
+
+
+def _write_stream(key: str,
+                  chunks: Iterator[bytes],
+                  duration: int,
+                  postprocess: Callable[[Path, Path], None] | None,
+                  temp: IO[bytes],
+                  state: _StreamState,
+                  release: Callable[[], None] | None) -> None:
+    try:
+        _write_stream_locked(key, chunks, duration, postprocess, temp, state)
+    finally:
+        if release:
+            release()
+
+
+def _write_stream_locked(key: str,
+                         chunks: Iterator[bytes],
+                         duration: int,
+                         postprocess: Callable[[Path, Path], None] | None,
+                         temp: IO[bytes],
+                         state: _StreamState) -> None:
+    with temp:
+        try:
+            for chunk in chunks:
+                temp.write(chunk)
+                temp.flush()
+                with state.condition:
+                    state.written += len(chunk)
+                    state.condition.notify_all()
+        except BaseException as ex:
+            # Incomplete data is discarded, the temporary file is deleted when leaving the with block
+            log.warning('Stream failed, not storing in cache: %s', key)
+            with state.condition:
+                state.error = ex
+                state.done = True
+                state.condition.notify_all()
+            return
+
+        with state.condition:
+            state.done = True
+            state.condition.notify_all()
+
+        try:
+            if postprocess:
+                with temp_file() as processed:
+                    postprocess(Path(temp.name), Path(processed.name))
+                    store_file(key, Path(processed.name), duration)
+            else:
+                store_file(key, Path(temp.name), duration)
+        except Exception:
+            log.exception('Failed to store stream in cache: %s', key)
+
+
+def store_stream(key: str,
+                 chunks: Iterator[bytes],
+                 duration: int,
+                 postprocess: Callable[[Path, Path], None] | None = None,
+                 release: Callable[[], None] | None = None) -> Iterator[bytes]:
+    """
+    Store data in the cache while it is being produced. The data is consumed in a separate thread,
+    so it is stored completely even if the returned iterator is not consumed completely (for
+    example, because the client has disconnected).
+    Args:
+        key: Cache key
+        chunks: Iterator of data chunks. If it raises an exception, nothing is stored.
+        duration: Suggested cache duration in seconds, see store()
+        postprocess: Optional function, called with the path of the complete data and a path to
+                     write the data to cache to.
+        release: Optional function, called after the data has been stored or storing has failed.
+                 For example, to release an acquired lock.
+    Returns: Iterator of the same data chunks
+    """
+    temp = temp_file()
+    # Open reader before starting the writer thread, the writer deletes the temporary file when done
+    reader = open(temp.name, 'rb')  # pylint: disable=consider-using-with
+    state = _StreamState()
+    Thread(target=_write_stream, args=(key, chunks, duration, postprocess, temp, state, release), daemon=True).start()
+
+    def tail() -> Iterator[bytes]:
+        with reader:
+            position = 0
+            while True:
+                with state.condition:
+                    state.condition.wait_for(lambda: state.written > position or state.done)
+                    written, done, error = state.written, state.done, state.error
+
+                if written > position:
+                    chunk = reader.read(written - position)
+                    position += len(chunk)
+                    yield chunk
+                elif error:
+                    raise RuntimeError('stream failed') from error
+                elif done:
+                    return
+
+    return tail()
+
+
+def _retrieve_row(key: str, return_expired: bool) -> tuple[bytes, str | None, bool] | None:
+    """
+    Returns: Data, digest of external file, and whether the entry has expired
+    """
+    with _pending_lock:
+        pending = _pending.get(key)
+
+    if pending is not None:
+        data, expire_time = pending
+        if expire_time < time.time() and not return_expired:
+            return None
+        return data, None, expire_time < time.time()
+
     with db.cache(read_only=True) as conn:
-        row = conn.execute('SELECT data, expire_time FROM cache WHERE key=?',
+        row = conn.execute('SELECT data, expire_time, external, last_access FROM cache WHERE key=?',
                            (key,)).fetchone()
 
-        if row is None:
+    if row is None:
+        return None
+
+    data, expire_time, external, last_access = row
+
+    if last_access < time.time() - ACCESS_RESOLUTION:
+        _record_access(key)
+
+    expired = expire_time < time.time()
+    if expired:
+        if not return_expired:
             return None
+        log.info('Cache entry has expired, returning it anyway')
+    elif external is None:
+        memory.put(key, data, expire_time)
+
+    return data, external, expired
+
+
+def _record_retrieve(key: str, size: int | None, expired: bool, start_time: float) -> None:
+    name = namespace(key)
+    namespace_stats = stats[name]
+    if size is None:
+        namespace_stats.misses += 1
+    else:
+        namespace_stats.hits += 1
+        namespace_stats.bytes_served += size
+        if expired:
+            namespace_stats.expired_hits += 1
+
+    duration = time.perf_counter() - start_time
+    for observer in retrieve_observers:
+        observer(name, duration)
 
-        data, expire_time = row
 
-        if expire_time < time.time():
-            if return_expired:
-                log.info('Cache entry has expired, returning it anyway')
-                return data
+def _retrieve(key: str,
+              return_expired: bool,
+              revalidate: Callable[[bytes], None] | None) -> tuple[bytes, bool] | None:
+    data = memory.get(key)
+    if data is not None:
+        return data, False
 
+    row = _retrieve_row(key, return_expired)
+    if row is None:
+        return None
+
+    data, external, expired = row
+
+    if external is not None:
+        try:
+            data = _external_path(external).read_bytes()
+        except FileNotFoundError:
+            log.warning('Cached file is missing: %s', external)
             return None
 
-        return data
+    if expired and revalidate:
+        refresh.start(key, functools.partial(revalidate, data))
+
+    return data, expired
+
+
+def retrieve(key: str,
+             return_expired: bool = True,
+             revalidate: Callable[[bytes], None] | None = None) -> bytes | None:
+    """
+    Retrieve object from cache
+    Args:
+        key: Cache key
+        return_expired: Whether to return the object from cache even when expired, but not cleaned
+                        up yet. Should be set to False for short lived cache objects.
+        revalidate: Function storing up-to-date data for this key, called with the expired data.
+                    When the object has expired, it is still returned and this function is called
+                    in the background, see refresh.py.
+    """
+    start_time = time.perf_counter()
+    result = _retrieve(key, return_expired, revalidate)
+    if result is None:
+        _record_retrieve(key, None, False, start_time)
+        return None
+
+    data, expired = result
+    _record_retrieve(key, len(data), expired, start_time)
+    return data
+
+
+def _retrieve_file(key: str, return_expired: bool) -> tuple[Path, int, bool] | None:
+    row = _retrieve_row(key, return_expired)
+    if row is None:
+        return None
+
+    _data, external, expired = row
+
+    if external is None:
+        return None
+
+    path = _external_path(external)
+    try:
+        size = path.stat().st_size
+    except FileNotFoundError:
+        log.warning('Cached file is missing: %s', external)
+        return None
+
+    return path, size, expired
+
+
+def retrieve_file(key: str,
+                  return_expired: bool = True) -> Path | None:
+    """
+    Like retrieve(), but for objects stored as a file. The file may be streamed to the client,
+    without reading it into memory.
+    Returns: Path to cached file, or None if the object is not cached or not stored as a file.
+    """
+    start_time = time.perf_counter()
+    result = _retrieve_file(key, return_expired)
+    if result is None:
+        _record_retrieve(key, None, False, start_time)
+        return None
+
+    path, size, expired = result
+    _record_retrieve(key, size, expired, start_time)
+    return path
+
+
+def _cleanup_files(conn: Connection) -> int:
+    """
+    Remove files in the cache directory that are no longer referenced by a cache entry.
+    """
+    referenced = {row[0] for row in conn.execute('SELECT external FROM cache WHERE external IS NOT NULL')}
+    # Skip recently modified files, they may belong to a cache entry that is being stored right now
+    min_mtime = time.time() - HOUR
+    count = 0
+    for path in _cache_dir().glob('*/*'):
+        if path.name not in referenced and path.stat().st_mtime < min_mtime:
+            path.unlink()
+            count += 1
+    # Temporary files left behind by a crashed process
+    for path in _cache_dir().glob('.tmp*'):
+        if path.stat().st_mtime < time.time() - DAY:
+            path.unlink()
+    return count
+
+
+def _fill_external_sizes(conn: Connection) -> None:
+    """
+    Entries stored as a file before sizes were recorded have size 0
+    """
+    rows = conn.execute('SELECT key, external FROM cache WHERE external IS NOT NULL AND size = 0').fetchall()
+    sizes: list[tuple[int, str]] = []
+    for key, external in rows:
+        try:
+            sizes.append((_external_path(external).stat().st_size, key))
+        except FileNotFoundError:
+            pass
+    conn.executemany('UPDATE cache SET size=? WHERE key=?', sizes)
+
+
+def _total_size(conn: Connection) -> int:
+    """
+    Returns: Size of cached data in bytes. Files shared by multiple entries are counted once.
+    """
+    total_size, = conn.execute("""
+                               SELECT (SELECT COALESCE(SUM(size), 0) FROM cache WHERE external IS NULL) +
+                                      (SELECT COALESCE(SUM(size), 0)
+                                       FROM (SELECT MAX(size) AS size FROM cache
+                                             WHERE external IS NOT NULL GROUP BY external))
+                               """).fetchone()
+    return total_size
+
+
+def _delete_files(digests: list[str]) -> int:
+    """
+    Delete files that are no longer referenced by a cache entry, see EVICT_MIN_FILE_AGE
+    Returns: Number of deleted files
+    """
+    min_mtime = time.time() - EVICT_MIN_FILE_AGE
+    count = 0
+    for digest in digests:
+        path = _external_path(digest)
+        try:
+            if path.stat().st_mtime < min_mtime:
+                path.unlink()
+                count += 1
+        except FileNotFoundError:
+            pass
+    return count
+
+
+def _evict(conn: Connection) -> int:
+    if not settings.cache_max_gb:
+        return 0
+
+    max_size = settings.cache_max_gb * 1024**3
+    total_size = _total_size(conn)
+    if total_size <= max_size:
+        return 0
+
+    # Time since last access multiplied by size, so large entries (audio) are evicted before small
+    # entries (lyrics, loudness) that have not been used for a similar amount of time. Access times
+    # are only accurate to ACCESS_RESOLUTION, recently used entries are ordered by size.
+    excess = total_size - max_size
+    keys: list[str] = []
+    # Remaining entries referencing each file. Space is only freed once no entry references a file.
+    references: dict[str, int] = {}
+    unreferenced: list[str] = []
+    for key, size, external, external_references in conn.execute("""
+            SELECT key, size, external, COUNT(*) OVER (PARTITION BY external)
+            FROM cache
+            ORDER BY (? - last_access) * size DESC
+            """, (int(time.time()) + ACCESS_RESOLUTION,)):
+        keys.append(key)
+        if external is None:
+            excess -= size
+        else:
+            references[external] = references.get(external, external_references) - 1
+            if references[external] == 0:
+                unreferenced.append(external)
+                excess -= size
+        if excess <= 0:
+            break
+
+    conn.executemany('DELETE FROM cache WHERE key=?', [(key,) for key in keys])
+    # Files must not be deleted before the entries referencing them
+    conn.commit()
+    for key in keys:
+        memory.remove(key)
+    files = _delete_files(unreferenced)
+    log.info('Cache size %s MiB exceeds maximum, evicted %s entries and %s files',
+             total_size // 1024**2, len(keys), files)
+    return len(keys)
+
+
+def evict() -> int:
+    """
+    Remove least recently used entries until the total size of cached data is below --cache-max-gb.
+    Files no longer referenced by any entry are deleted as well.
+    Returns: Number of removed entries
+    """
+    with db.cache() as conn:
+        return _evict(conn)
+
+
+def _cleanup_locks() -> None:
+    """
+    Remove lock files that are not currently locked.
+    """
+    for path in _lock_dir().iterdir():
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            pass
+        else:
+            path.unlink()
+        finally:
+            os.close(fd)
 
 
 def cleanup() -> None:
     """
     Remove any cache entries that are beyond their expire time.
     """
+    flush()
+
     with db.cache() as conn:
         count = conn.execute('DELETE FROM cache WHERE expire_time < ?',
                             (int(time.time()),)).rowcount
@@ -79,6 +819,14 @@ def cleanup() -> None:
         conn.execute('PRAGMA incremental_vacuum(65536)')
         log.info('Deleted %s entries from cache', count)
 
+        _fill_external_sizes(conn)
+        _evict(conn)
+
+        count = _cleanup_files(conn)
+        log.info('Deleted %s files from cache directory', count)
+
+    _cleanup_locks()
+
 
 def store_json(key: str, data: dict[Any, Any], duration: int) -> None:
     """
@@ -33,6 +33,10 @@ def cleanup() -> None:
                              (time.time() - 300,)).rowcount
         log.info('Deleted %s now playing entries', count)
 
+        count = conn.execute('DELETE FROM transcode WHERE timestamp < ?',
+                             (time.time() - 90 * 24 * 3600,)).rowcount
+        log.info('Deleted %s transcode statistics', count)
+
         count = delete_old_trashed_files()
         log.info('Deleted %s trashed files', count)
 
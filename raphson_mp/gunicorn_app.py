@@ -7,6 +7,12 @@ from raphson_mp import main
 log = logging.getLogger(__name__)
 
 
+def _post_worker_init(_worker):
+    # Threads don't survive forking, so background work must be started in the worker process
+    from raphson_mp import warmup
+    warmup.start()
+
+
 class GunicornApp(BaseApplication):
     bind: str
     proxy_count: int
@@ -33,3 +39,4 @@ class GunicornApp(BaseApplication):
         self.cfg.set('logconfig_dict', self.logconfig_dict)
         self.cfg.set('preload_app', True)
         self.cfg.set('timeout', 60)
+        self.cfg.set('post_worker_init', _post_worker_init)
@@ -0,0 +1,111 @@
+"""
+ID3v2.3 tag writer, for MP3 downloads. Frames can also be written in ID3v2.4 format, for updating
+existing tags in place (see tags.py).
+https://id3.org/id3v2.3.0
+https://id3.org/id3v2.4.0-frames
+"""
+from __future__ import annotations
+
+import struct
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # Not imported at runtime, metadata imports music which imports this module
+    from raphson_mp.metadata import Metadata
+
+# Frame identifiers for text information
+TITLE = b'TIT2'
+ARTIST = b'TPE1'
+ALBUM = b'TALB'
+ALBUM_ARTIST = b'TPE2'
+TRACK_NUMBER = b'TRCK'
+YEAR = b'TYER'
+RECORDING_TIME = b'TDRC'  # replaces TYER in ID3v2.4
+GENRE = b'TCON'
+LYRICS = b'USLT'
+USER_TEXT = b'TXXX'
+
+_ENCODING_LATIN1 = b'\x00'
+_ENCODING_UTF16 = b'\x01'
+
+
+def _encode_text(text: str) -> bytes:
+    """
+    Returns: Text encoding byte followed by encoded text. ID3v2.3 only supports ISO-8859-1 and
+    UTF-16 with byte order mark.
+    """
+    try:
+        return _ENCODING_LATIN1 + text.encode('latin-1')
+    except UnicodeEncodeError:
+        return _ENCODING_UTF16 + text.encode('utf-16')
+
+
+def frame(frame_id: bytes, data: bytes, version: int = 3) -> bytes:
+    # Unlike the tag size, frame size is not sync safe in ID3v2.3. It is in ID3v2.4.
+    size = sync_safe(len(data)) if version == 4 else struct.pack('>I', len(data))
+    return frame_id + size + b'\x00\x00' + data
+
+
+def text_frame(frame_id: bytes, text: str, version: int = 3) -> bytes:
+    return frame(frame_id, _encode_text(text), version)
+
+
+def lyrics_frame(lyrics: str, version: int = 3) -> bytes:
+    encoding = _encode_text(lyrics)[:1]
+    if encoding == _ENCODING_LATIN1:
+        description, lyrics_bytes = b'\x00', lyrics.encode('latin-1')
+    else:
+        description, lyrics_bytes = ''.encode('utf-16') + b'\x00\x00', lyrics.encode('utf-16')
+    return frame(LYRICS, encoding + b'XXX' + description + lyrics_bytes, version)
+
+
+def _picture_frame(jpeg: bytes) -> bytes:
+    return frame(b'APIC',
+                  _ENCODING_LATIN1 +
+                  b'image/jpeg\x00' +
+                  b'\x03' +  # picture type: cover (front)
+                  b'Album cover\x00' +
+                  jpeg)
+
+
+def sync_safe(size: int) -> bytes:
+    """
+    Encode size as 4 bytes with 7 bits each, so the size never looks like an MP3 frame sync
+    """
+    return bytes(((size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f))
+
+
+def parse_sync_safe(data: bytes) -> int:
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def tag(meta: Metadata, cover: bytes | None) -> bytes:
+    """
+    Generate ID3v2.3 tag, to be prepended to MP3 audio data without tags
+    Args:
+        meta: Track metadata
+        cover: JPEG album cover image
+    Returns: Tag bytes
+    """
+    frames: list[bytes] = []
+    if meta.title:
+        frames.append(text_frame(TITLE, meta.title))
+    if meta.artists:
+        frames.append(text_frame(ARTIST, '/'.join(meta.artists)))
+    if meta.album:
+        frames.append(text_frame(ALBUM, meta.album))
+    if meta.album_artist:
+        frames.append(text_frame(ALBUM_ARTIST, meta.album_artist))
+    if meta.track_number is not None:
+        frames.append(text_frame(TRACK_NUMBER, str(meta.track_number)))
+    if meta.year is not None:
+        frames.append(text_frame(YEAR, str(meta.year)))
+    if meta.tags:
+        frames.append(text_frame(GENRE, '; '.join(meta.tags)))
+    if meta.lyrics:
+        frames.append(lyrics_frame(meta.lyrics))
+    if cover:
+        frames.append(_picture_frame(cover))
+
+    body = b''.join(frames)
+    return b'ID3' + bytes((3, 0)) + b'\x00' + sync_safe(len(body)) + body
@@ -2,12 +2,11 @@
 Image conversion and thumbnailing
 """
 import logging
-import subprocess
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
 
-from raphson_mp import settings
+from raphson_mp import jobs, settings
 
 log = logging.getLogger(__name__)
 
@@ -27,7 +26,8 @@ class ImageFormat(Enum):
     JPEG = 'jpeg'
 
 
-def thumbnail(input_path: Path, output_path: Path, img_format: ImageFormat, img_quality: ImageQuality, square: bool):
+def thumbnail(input_path: Path, output_path: Path, img_format: ImageFormat, img_quality: ImageQuality, square: bool,
+              priority: jobs.Priority = jobs.Priority.INTERACTIVE):
     size = img_quality.size
 
     if square:
@@ -42,13 +42,12 @@ def thumbnail(input_path: Path, output_path: Path, img_format: ImageFormat, img_
     else:
         raise ValueError()
 
-    subprocess.run(['ffmpeg',
-                    '-hide_banner',
-                    '-nostats',
-                    '-loglevel', settings.ffmpeg_log_level,
-                    '-i', input_path.as_posix(),
-                    '-filter', thumb_filter,
-                    *format_options,
-                    output_path.as_posix()],
-                   check=True,
-                   shell=False)
+    jobs.run(['ffmpeg',
+              '-hide_banner',
+              '-nostats',
+              '-loglevel', settings.ffmpeg_log_level,
+              '-i', input_path.as_posix(),
+              '-filter', thumb_filter,
+              *format_options,
+              output_path.as_posix()],
+             priority, 'thumbnail')
@@ -0,0 +1,327 @@
+"""
+Scheduler for expensive subprocesses (ffmpeg). Limits the number of processes running at the same
+time, so a few users can't overload the server, and makes sure work that a user is waiting for
+runs before background work.
+"""
+import atexit
+import itertools
+import logging
+import os
+import subprocess
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from subprocess import CalledProcessError
+from threading import Condition, Lock, Thread
+
+from werkzeug.exceptions import ServiceUnavailable
+
+from raphson_mp import db, settings
+
+log = logging.getLogger(__name__)
+
+
+class Priority(Enum):
+    """
+    Job priority classes, from highest to lowest priority
+    """
+    INTERACTIVE = 0  # a user is waiting for the result, e.g. playback
+    PREFETCH = 1  # a user will probably need the result soon
+    WARMUP = 2  # background transcoding of new tracks
+    EXPORT = 3  # downloads of many or large files
+
+    @property
+    def label(self) -> str:
+        return self.name.lower()
+
+
+# Maximum time a job may wait in the queue by default, per priority class. Interactive jobs must
+# start well within the gunicorn worker timeout.
+DEFAULT_TIMEOUT: dict[Priority, float | None] = {Priority.INTERACTIVE: 30,
+                                                 Priority.PREFETCH: 60,
+                                                 Priority.WARMUP: None,
+                                                 Priority.EXPORT: 300}
+
+
+class QueueTimeout(ServiceUnavailable):
+    description = 'The server is too busy, please try again later.'
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    deadline: float
+    sequence: int
+    priority_class: Priority = field(compare=False)
+
+
+_condition = Condition()
+_sequence = itertools.count()
+_waiting: list[_Waiter] = []
+_running: dict[Priority, int] = {priority: 0 for priority in Priority}
+
+# Statistics, exported as metrics by prometheus.py
+started: dict[Priority, int] = {priority: 0 for priority in Priority}
+timed_out: dict[Priority, int] = {priority: 0 for priority in Priority}
+wait_seconds: dict[Priority, float] = {priority: 0.0 for priority in Priority}
+
+
+@dataclass
+class ProcessStats:
+    """
+    Resource usage of a finished process
+    """
+    kind: str  # output format (audio type name), or other purpose like 'thumbnail'
+    priority: Priority
+    track: str | None  # relative path of the track being processed, if any
+    wall_time: float  # seconds
+    user_time: float  # seconds
+    system_time: float  # seconds
+    input_bytes: int  # total size of input files
+    output_bytes: int  # size of output file, or data written to stdout
+    returncode: int
+
+
+# Functions called with the statistics of every finished process, used by prometheus.py
+observers: list[Callable[[ProcessStats], None]] = []
+
+# Statistics of finished processes, waiting to be written to the transcode table by _stats_writer()
+_stats_condition = Condition()
+_stats_write_lock = Lock()
+_stats_pending: list[tuple[int, ProcessStats]] = []
+_stats_writer_pid: int | None = None  # process the writer was started in, it does not survive fork()
+
+
+def max_jobs() -> int:
+    """
+    Returns: Maximum number of jobs running at the same time, by default the number of CPU cores
+    """
+    if settings.max_jobs:
+        return settings.max_jobs
+    return os.cpu_count() or 1
+
+
+def class_limit(priority: Priority) -> int:
+    """
+    Returns: Maximum number of running jobs of a priority class. Only interactive jobs may use all
+    slots, so some capacity is always available to users.
+    """
+    total = max_jobs()
+    if priority == Priority.INTERACTIVE:
+        return total
+    if priority == Priority.EXPORT:
+        return 1
+    return max(1, total // 2)
+
+
+def queue_depth(priority: Priority) -> int:
+    return sum(1 for waiter in _waiting if waiter.priority_class == priority)
+
+
+def running(priority: Priority) -> int:
+    return _running[priority]
+
+
+def _has_capacity(priority: Priority) -> bool:
+    return sum(_running.values()) < max_jobs() and _running[priority] < class_limit(priority)
+
+
+def _may_start(waiter: _Waiter) -> bool:
+    if not _has_capacity(waiter.priority_class):
+        return False
+    # Only start if no job that should go first is waiting for the same capacity. Waiting jobs
+    # are ordered by priority, then deadline (earliest first), then arrival.
+    for other in _waiting:
+        if other < waiter and _has_capacity(other.priority_class):
+            return False
+    return True
+
+
+def acquire(priority: Priority, timeout: float | None = None) -> None:
+    """
+    Wait until a job of the given priority may run, and occupy a slot. The slot must be released
+    using release(), possibly from another thread. Prefer slot() where possible.
+    Args:
+        priority: Priority class
+        timeout: Maximum time to wait in seconds, or None to use the default for the priority class
+    Raises: QueueTimeout if the job could not be started before the timeout
+    """
+    if timeout is None:
+        timeout = DEFAULT_TIMEOUT[priority]
+    start_time = time.monotonic()
+    deadline = start_time + timeout if timeout is not None else float('inf')
+    waiter = _Waiter(priority.value, deadline, next(_sequence), priority)
+
+    with _condition:
+        _waiting.append(waiter)
+        try:
+            while not _may_start(waiter):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    log.warning('Job of priority %s waited too long in queue', priority.label)
+                    timed_out[priority] += 1
+                    raise QueueTimeout()
+                _condition.wait(timeout=None if remaining == float('inf') else remaining)
+        finally:
+            _waiting.remove(waiter)
+            # Removing a waiter may allow another job to start
+            _condition.notify_all()
+
+        _running[priority] += 1
+        started[priority] += 1
+        wait_seconds[priority] += time.monotonic() - start_time
+
+
+def release(priority: Priority) -> None:
+    """
+    Release a slot occupied using acquire()
+    """
+    with _condition:
+        _running[priority] -= 1
+        _condition.notify_all()
+
+
+@contextmanager
+def slot(priority: Priority, timeout: float | None = None) -> Iterator[None]:
+    """
+    Context manager that waits until a job of the given priority may run, and keeps a slot occupied
+    for the duration of the with block. See acquire().
+    """
+    acquire(priority, timeout)
+    try:
+        yield
+    finally:
+        release(priority)
+
+
+def _file_size(path: str) -> int:
+    try:
+        return Path(path).stat().st_size
+    except OSError:
+        # Not a file, for example pipe:1 or a lavfi source
+        return 0
+
+
+def _record(stats: ProcessStats, command: list[str]) -> None:
+    global _stats_writer_pid
+
+    log.debug('Process %s (%s) took %.2fs, %.2fs CPU: %s', stats.kind, stats.track,
+              stats.wall_time, stats.user_time + stats.system_time, command)
+
+    for observer in observers:
+        observer(stats)
+
+    # The caller may have an open write transaction on the music database, statistics are
+    # written to the database by a separate thread
+    with _stats_condition:
+        _stats_pending.append((int(time.time()), stats))
+        _stats_condition.notify()
+        if _stats_writer_pid != os.getpid():
+            _stats_writer_pid = os.getpid()
+            Thread(target=_stats_writer, daemon=True, name='jobs-stats-writer').start()
+
+
+def _write_stats() -> None:
+    with _stats_condition:
+        batch = _stats_pending.copy()
+        _stats_pending.clear()
+
+    if not batch:
+        return
+
+    try:
+        with db.connect() as conn:
+            conn.executemany('''
+                             INSERT INTO transcode (timestamp, kind, priority, track, wall_time, user_time,
+                                                    system_time, input_bytes, output_bytes, returncode)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                             ''',
+                             [(timestamp, stats.kind, stats.priority.label, stats.track, stats.wall_time,
+                               stats.user_time, stats.system_time, stats.input_bytes, stats.output_bytes,
+                               stats.returncode)
+                              for timestamp, stats in batch])
+    except Exception:
+        # Statistics are not important enough to retry
+        log.exception('Failed to store statistics of %s processes', len(batch))
+
+
+def flush() -> None:
+    """
+    Write statistics of finished processes to the database
+    """
+    with _stats_write_lock:
+        _write_stats()
+
+
+def _stats_writer() -> None:
+    while True:
+        with _stats_condition:
+            _stats_condition.wait_for(lambda: len(_stats_pending) > 0)
+        flush()
+
+
+atexit.register(flush)
+
+
+def wait(process: subprocess.Popen[bytes],
+         command: list[str],
+         priority: Priority,
+         start_time: float,
+         kind: str,
+         track: str | None = None,
+         output_bytes: int | None = None) -> int:
+    """
+    Wait for a process to exit and record its resource usage
+    Args:
+        process: Process started by the caller
+        command: Command the process was started with. Files following -i are counted as input,
+                 the last argument as output.
+        priority: Priority of the job slot the process runs in
+        start_time: time.monotonic() just before the process was started
+        kind: Output format or purpose, see ProcessStats
+        track: Relative path of the track being processed
+        output_bytes: Amount of output data, if the output is not written to a file
+    Returns: Exit code
+    """
+    # Unlike process.wait(), wait4 returns resource usage of the child process
+    _pid, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    input_bytes = sum(_file_size(command[i + 1]) for i, arg in enumerate(command[:-1]) if arg == '-i')
+    if output_bytes is None:
+        output_bytes = _file_size(command[-1])
+
+    _record(ProcessStats(kind, priority, track, time.monotonic() - start_time,
+                         rusage.ru_utime, rusage.ru_stime, input_bytes, output_bytes,
+                         process.returncode),
+            command)
+    return process.returncode
+
+
+def run(command: list[str], priority: Priority, kind: str, track: str | None = None) -> None:
+    """
+    Run command once a slot is available, and record its resource usage
+    Args:
+        command: Command, output is written to a file or discarded
+        priority: Job priority class
+        kind: Output format or purpose, see ProcessStats
+        track: Relative path of the track being processed
+    Raises: CalledProcessError if the command fails
+    """
+    with slot(priority):
+        run_in_slot(command, priority, kind, track)
+
+
+def run_in_slot(command: list[str], priority: Priority, kind: str, track: str | None = None) -> None:
+    """
+    Like run(), for a caller that already occupies a job slot of the given priority, acquired
+    using acquire() or slot()
+    """
+    start_time = time.monotonic()
+    process = subprocess.Popen(command, shell=False)
+    returncode = wait(process, command, priority, start_time, kind, track)
+    if returncode != 0:
+        raise CalledProcessError(returncode, command)
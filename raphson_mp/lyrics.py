@@ -1,4 +1,5 @@
 import difflib
+import functools
 import html
 import json
 import logging
@@ -406,23 +407,38 @@ def from_dict(dict: dict[str, Any]) -> Lyrics | None:
     raise ValueError(dict['type'])
 
 
+def _store(cache_key: str, lyrics: Lyrics | None) -> None:
+    if lyrics is None:
+        duration = cache.MONTH
+    else:
+        duration = cache.YEAR
+    cache.store_json(cache_key, to_dict(lyrics), duration)
+
+
+def _refresh(cache_key: str, title: str, artist: str, album: str | None, duration: int | None,
+             stale_data: bytes) -> None:
+    lyrics = _find(title, artist, album, duration)
+    stale_dict = json.loads(stale_data)
+    if lyrics is None and stale_dict['type'] != 'none':
+        # Fetchers fail silently, for example when a website is down. Don't replace lyrics that
+        # were found before, try again later.
+        log.info('lyrics not found again, keeping cached lyrics for: %s - %s', artist, title)
+        cache.store_json(cache_key, stale_dict, cache.MONTH)
+        return
+    _store(cache_key, lyrics)
+
+
 def find(title: str, artist: str, album: str | None, duration: int | None) -> Lyrics | None:
     assert title is not None and artist is not None, "title and artist are required"
 
     cache_key = f'lyrics{artist}{title}{album}{duration}'
 
-    cached_dict = cache.retrieve_json(cache_key)
+    cached_dict = cache.retrieve_json(cache_key,
+                                      revalidate=functools.partial(_refresh, cache_key, title, artist, album, duration))
     if cached_dict is not None:
         log.info('returning lyrics from cache')
         return from_dict(cached_dict)
 
     lyrics = _find(title, artist, album, duration)
-
-    cached_dict = to_dict(lyrics)
-    if lyrics is None:
-        duration = cache.MONTH
-    else:
-        duration = cache.YEAR
-    cache.store_json(cache_key, cached_dict, duration)
-
+    _store(cache_key, lyrics)
     return lyrics
@@ -2,10 +2,11 @@ import json
 import logging
 import re
 import subprocess
+import time
 from dataclasses import dataclass
 from pathlib import Path
 
-from raphson_mp import music
+from raphson_mp import jobs, music, settings
 
 log = logging.getLogger(__name__)
 
@@ -179,6 +180,10 @@ class Metadata:
     tags: list[str]
     lyrics: str | None
     video: str | None
+    # Properties of the first audio stream, only known when probing the file
+    audio_codec: str | None = None
+    audio_bit_rate: int | None = None
+    audio_channels: int | None = None
 
     def _meta_title(self) -> str | None:
         """
@@ -241,24 +246,34 @@ class Metadata:
 
         return None
 
-    def get_ffmpeg_options(self, option: str = '-metadata') -> list[str]:
-        metadata_options: list[str] = []
+    def tag_values(self) -> dict[str, str]:
+        """
+        Returns: Tags to write to a file, using ffmpeg metadata keys. Missing values are left out,
+        so existing tags in the file are kept.
+        """
+        values: dict[str, str] = {}
         if self.album:
-            metadata_options.extend((option, 'album=' + self.album))
+            values['album'] = self.album
         if self.artists is not None:
-            metadata_options.extend((option, 'artist=' + _join_meta_list(self.artists)))
+            values['artist'] = _join_meta_list(self.artists)
         if self.title is not None:
-            metadata_options.extend((option, 'title=' + self.title))
+            values['title'] = self.title
         if self.year is not None:
-            metadata_options.extend((option, 'date=' + str(self.year)))
+            values['date'] = str(self.year)
         if self.album_artist is not None:
-            metadata_options.extend((option, 'album_artist=' + self.album_artist))
+            values['album_artist'] = self.album_artist
         if self.track_number is not None:
-            metadata_options.extend((option, 'track=' + str(self.track_number)))
+            values['track'] = str(self.track_number)
         if self.lyrics is not None:
-            metadata_options.extend((option, 'lyrics=' + str(self.track_number)))
+            values['lyrics'] = self.lyrics
         if self.tags:
-            metadata_options.extend((option, 'genre=' + _join_meta_list(self.tags)))
+            values['genre'] = _join_meta_list(self.tags)
+        return values
+
+    def get_ffmpeg_options(self, option: str = '-metadata') -> list[str]:
+        metadata_options: list[str] = []
+        for key, value in self.tag_values().items():
+            metadata_options.extend((option, key + '=' + value))
         return metadata_options
 
 
@@ -298,6 +313,9 @@ def probe(path: Path) -> Metadata | None:
     tags = []
     lyrics = None
     video: str | None = None
+    audio_codec: str | None = None
+    audio_bit_rate: int | None = None
+    audio_channels: int | None = None
 
     meta_tags: list[tuple[str, str]] = []
 
@@ -306,6 +324,16 @@ def probe(path: Path) -> Metadata | None:
             if 'tags' in stream:
                 meta_tags.extend(stream['tags'].items())
 
+            if audio_codec is None:
+                audio_codec = stream['codec_name']
+                audio_channels = stream.get('channels')
+                if 'bit_rate' in stream:
+                    audio_bit_rate = int(stream['bit_rate'])
+                elif len(data['streams']) == 1 and 'bit_rate' in data['format']:
+                    # Matroska does not store the bit rate of streams. The average bit rate of
+                    # the file is only a good estimate if it contains nothing but audio.
+                    audio_bit_rate = int(data['format']['bit_rate'])
+
         if stream['codec_type'] == 'video':
             if stream['codec_name'] == 'vp9':
                 video = 'vp9'
@@ -370,4 +398,112 @@ def probe(path: Path) -> Metadata | None:
                     track_number,
                     tags,
                     lyrics,
-                    video)
+                    video,
+                    audio_codec,
+                    audio_bit_rate,
+                    audio_channels)
+
+
+@dataclass
+class Loudness:
+    """
+    Loudness measured by the first pass of ffmpeg's loudnorm filter
+    """
+    integrated: float  # input_i, LUFS
+    true_peak: float  # input_tp, dBTP
+    lra: float  # input_lra, LU
+    threshold: float  # input_thresh, LUFS
+    offset: float  # target_offset, LU
+
+
+def measure_loudness(path: Path, priority: jobs.Priority) -> Loudness | None:
+    """
+    Measure loudness by decoding the entire file, for 2-phase loudness normalization
+    http://k.ylo.ph/2016/04/04/loudnorm.html
+    Args:
+        path: Path to file
+        priority: Job priority class, decoding takes as long as transcoding
+    Returns: Loudness object, or None if ffmpeg failed to read the file or its output could not be parsed
+    """
+    log.info('Measuring loudness: %s', path)
+    command = ['ffmpeg',
+               '-hide_banner',
+               '-nostats',
+               '-i', path.resolve().as_posix(),
+               '-map', '0:a',
+               '-af', settings.loudnorm_filter + ':print_format=json',
+               '-f', 'null',
+               '/dev/null']
+    # Annoyingly, loudnorm outputs to stderr instead of stdout.
+    # Disabling logging also hides the loudnorm output...
+    with jobs.slot(priority):
+        start_time = time.monotonic()
+        process = subprocess.Popen(command, shell=False, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        assert process.stderr
+        output = process.stderr.read().decode()
+        returncode = jobs.wait(process, command, priority, start_time, 'loudness', music.to_relpath(path))
+
+    if returncode != 0:
+        log.warning('Error measuring loudness of track %s, ffmpeg exited with exit code %s', path, returncode)
+        log.warning('--- stderr ---\n%s', output)
+        return None
+
+    # Manually find the start of loudnorm info json
+    try:
+        start = output.rindex('Parsed_loudnorm_0') + 37
+        end = start + output[start:].index('}') + 1
+    except ValueError:
+        log.warning('Missing loudnorm output for track %s', path)
+        log.warning('--- stderr ---\n%s', output)
+        return None
+
+    json_text = output[start:end]
+    try:
+        data = json.loads(json_text)
+        return Loudness(float(data['input_i']),
+                        float(data['input_tp']),
+                        float(data['input_lra']),
+                        float(data['input_thresh']),
+                        float(data['target_offset']))
+    except (ValueError, KeyError, TypeError):
+        # JSONDecodeError is a ValueError, as is a measurement that is not a number
+        log.warning('Invalid loudnorm json: %s', json_text)
+        return None
+
+
+def audio_hash(path: Path, priority: jobs.Priority) -> str | None:
+    """
+    Hash audio stream data without decoding it. Unlike a hash of the file, it does not change when
+    metadata tags are modified.
+    Args:
+        path: Path to file
+        priority: Job priority class
+    Returns: sha256 hex digest, or None if ffmpeg failed to read the file
+    """
+    command = ['ffmpeg',
+               '-hide_banner',
+               '-nostats',
+               '-loglevel', 'error',
+               '-i', path.resolve().as_posix(),
+               '-map', '0:a',
+               '-c', 'copy',
+               '-f', 'hash',
+               '-hash', 'sha256',
+               '-']
+    with jobs.slot(priority):
+        start_time = time.monotonic()
+        process = subprocess.Popen(command, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert process.stdout and process.stderr
+        # stdout is a single line that fits in the pipe buffer, so it can be read after stderr.
+        # communicate() can't be used, it would reap the process before jobs.wait() can.
+        stderr = process.stderr.read()
+        stdout = process.stdout.read()
+        returncode = jobs.wait(process, command, priority, start_time, 'hash', music.to_relpath(path), len(stdout))
+
+    if returncode != 0:
+        log.warning('Error hashing audio of track %s, ffmpeg exited with exit code %s', path, returncode)
+        log.warning('--- stderr ---\n%s', stderr.decode())
+        return None
+
+    # Output looks like: SHA256=<hex digest>
+    return stdout.decode().strip().split('=')[1]
@@ -0,0 +1,3 @@
+-- Large cache entries are stored as files in the cache directory, the data column is empty for these entries
+
+ALTER TABLE cache ADD COLUMN external TEXT NULL;
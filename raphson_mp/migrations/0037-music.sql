@@ -0,0 +1,6 @@
+-- Loudness is measured by the scanner, instead of when a track is played for the first time
+ALTER TABLE track ADD COLUMN loudness_i REAL NULL;
+ALTER TABLE track ADD COLUMN loudness_tp REAL NULL;
+ALTER TABLE track ADD COLUMN loudness_lra REAL NULL;
+ALTER TABLE track ADD COLUMN loudness_thresh REAL NULL;
+ALTER TABLE track ADD COLUMN loudness_offset REAL NULL;
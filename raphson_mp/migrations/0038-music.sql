@@ -0,0 +1,5 @@
+-- Audio stream properties, to decide whether audio can be remuxed instead of transcoded.
+-- Filled for new and changed tracks by the scanner.
+ALTER TABLE track ADD COLUMN audio_codec TEXT NULL;
+ALTER TABLE track ADD COLUMN audio_bit_rate INTEGER NULL;
+ALTER TABLE track ADD COLUMN audio_channels INTEGER NULL;
@@ -0,0 +1,2 @@
+-- Hash of audio stream data, used in cache keys so they don't change when only metadata changes
+ALTER TABLE track ADD COLUMN audio_hash TEXT NULL;
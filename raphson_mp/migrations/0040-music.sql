@@ -0,0 +1,16 @@
+-- Resource usage of ffmpeg processes, for the transcode-report command
+CREATE TABLE transcode (
+    id INTEGER NOT NULL UNIQUE PRIMARY KEY AUTOINCREMENT,
+    timestamp INTEGER NOT NULL, -- Seconds since UNIX epoch
+    kind TEXT NOT NULL, -- Output format (audio type name), or other purpose like 'thumbnail'
+    priority TEXT NOT NULL,
+    track TEXT NULL, -- Intentionally not a foreign key, log may contain deleted tracks
+    wall_time REAL NOT NULL, -- Seconds
+    user_time REAL NOT NULL, -- Seconds
+    system_time REAL NOT NULL, -- Seconds
+    input_bytes INTEGER NOT NULL,
+    output_bytes INTEGER NOT NULL,
+    returncode INTEGER NOT NULL
+) STRICT;
+
+CREATE INDEX idx_transcode_timestamp ON transcode(timestamp);
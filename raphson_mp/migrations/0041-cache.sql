@@ -0,0 +1,9 @@
+-- Size and approximate last access time of cache entries, to evict least recently used entries when
+-- the cache is too large. Sizes of entries stored as files are filled in by cleanup.
+
+BEGIN;
+ALTER TABLE cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE cache ADD COLUMN last_access INTEGER NOT NULL DEFAULT 0;
+UPDATE cache SET size = length(data), last_access = CAST(strftime('%s', 'now') AS INTEGER);
+CREATE INDEX idx_cache_last_access ON cache(last_access, size, key);
+COMMIT;
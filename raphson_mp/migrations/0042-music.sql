@@ -0,0 +1,2 @@
+-- Set when loudness could not be measured, so the background measurement is not retried
+ALTER TABLE track ADD COLUMN loudness_failed INTEGER NOT NULL DEFAULT 0;
@@ -0,0 +1,2 @@
+-- Set when the audio stream could not be hashed, so the background hashing is not retried
+ALTER TABLE track ADD COLUMN audio_hash_failed INTEGER NOT NULL DEFAULT 0;
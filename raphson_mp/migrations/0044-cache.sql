@@ -0,0 +1,2 @@
+-- Eviction orders entries by time since last access multiplied by size, which cannot use this index
+DROP INDEX idx_cache_last_access;
@@ -1,21 +1,25 @@
 from __future__ import annotations
 
 import logging
+import math
+import os
 import random
 import shutil
 import subprocess
 import tempfile
+import time
 from collections.abc import Iterator
+from contextlib import ExitStack, contextmanager
+from functools import partial
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from enum import Enum
-from json.decoder import JSONDecodeError
 from pathlib import Path
 from sqlite3 import Connection
 from subprocess import CalledProcessError
 from typing import Literal
 
-from raphson_mp import cache, image, jsonw, lyrics, metadata, reddit, settings
+from raphson_mp import cache, id3, image, jobs, lyrics, metadata, reddit, settings, tags
 from raphson_mp.auth import User
 from raphson_mp.image import ImageFormat, ImageQuality
 from raphson_mp.lyrics import Lyrics, PlainLyrics
@@ -37,6 +41,19 @@ MUSIC_EXTENSIONS = [
     '.opus',
 ]
 
+# ffmpeg output format for each music extension, for writing metadata
+MUXERS = {
+    '.mp3': 'mp3',
+    '.flac': 'flac',
+    '.ogg': 'ogg',
+    '.webm': 'webm',
+    '.mkv': 'matroska',
+    '.mka': 'matroska',
+    '.m4a': 'ipod',
+    '.wav': 'wav',
+    '.opus': 'opus',
+}
+
 
 def to_relpath(path: Path) -> str:
     """
@@ -93,7 +110,7 @@ def list_tracks_recursively(path: Path, trashed: bool = False) -> Iterator[Path]
                 yield track_path
 
 
-def _get_possible_covers(artist: str | None, album: str, meme: bool) -> Iterator[bytes]:
+def _get_possible_covers(artist: str | None, album: str, meme: bool, fallback: bool = True) -> Iterator[bytes]:
     from raphson_mp import bing, musicbrainz
 
     if meme:
@@ -117,29 +134,22 @@ def _get_possible_covers(artist: str | None, album: str, meme: bool) -> Iterator
     for query in search_queries:
         yield from bing.image_search(query)
 
-    log.info('No suitable cover found, returning fallback image')
-    yield settings.raphson_png.read_bytes()
+    if fallback:
+        log.info('No suitable cover found, returning fallback image')
+        yield settings.raphson_png.read_bytes()
 
 
-def get_cover(artist: str | None, album: str, meme: bool,
-              img_quality: ImageQuality, img_format: ImageFormat) -> bytes:
+def _generate_covers(cache_key: str, artist: str | None, album: str, meme: bool,
+                     img_quality: ImageQuality, img_format: ImageFormat, fallback: bool = True,
+                     priority: jobs.Priority = jobs.Priority.INTERACTIVE) -> bytes:
     """
-    Find album cover
-    Parameters:
-        meta: Track metadata
-    Returns: Album cover image bytes, or None if no image was found.
+    Download album cover, generate thumbnails in all qualities and formats, and store them in the cache
+    Args:
+        fallback: Use the fallback image if no cover is found, otherwise raise ValueError
+        priority: Priority of the ffmpeg jobs generating thumbnails
+    Returns: Thumbnail image bytes in requested quality and format
     """
-    cache_key =  f'cover{artist}{album}{meme}'  # quality is appended later
-
-    cache_data = cache.retrieve(cache_key + img_quality.name + img_format.name)
-    if cache_data is not None:
-        log.info('Returning %s quality %s cover thumbnail from cache: %s - %s',
-                 img_quality.name, img_format, artist, album)
-        return cache_data
-
-    log.info('Cover thumbnail not cached, need to download album cover image: %s - %s', artist, album)
-
-    for cover_bytes in _get_possible_covers(artist, album, meme):
+    for cover_bytes in _get_possible_covers(artist, album, meme, fallback):
         with tempfile.TemporaryDirectory(prefix='music-cover') as temp_dir:
             input_path = Path(temp_dir, 'input')
             input_path.write_bytes(cover_bytes)
@@ -149,7 +159,8 @@ def get_cover(artist: str | None, album: str, meme: bool,
                 for img_format2 in ImageFormat:
                     for img_quality2 in (image.QUALITY_HIGH, image.QUALITY_LOW):
                         output_path = Path(temp_dir, 'output' + img_quality2.name + img_format2.name)
-                        image.thumbnail(input_path, output_path, img_format2, img_quality2, square=not meme)
+                        image.thumbnail(input_path, output_path, img_format2, img_quality2, square=not meme,
+                                        priority=priority)
                         image_bytes = output_path.read_bytes()
                         cache.store(cache_key + img_quality2.name + img_format2.name, image_bytes, cache.HALFYEAR)
 
@@ -161,7 +172,58 @@ def get_cover(artist: str | None, album: str, meme: bool,
 
         return return_data
 
-    raise ValueError('always at least one possible cover must be returned')
+    raise ValueError('no suitable cover found')
+
+
+def _refresh_covers(cache_key: str, artist: str | None, album: str, meme: bool,
+                    img_quality: ImageQuality, img_format: ImageFormat, _stale_data: bytes) -> None:
+    with cache.Lock(cache_key):
+        # All thumbnails are generated at once, they may have been refreshed for another quality or format
+        if cache.retrieve(cache_key + img_quality.name + img_format.name, return_expired=False) is not None:
+            return
+        log.info('Refreshing expired cover thumbnails: %s - %s', artist, album)
+        # A network error must not replace a cover found earlier with the fallback image. Nobody is
+        # waiting for the refreshed thumbnails, the expired ones are returned in the meantime.
+        _generate_covers(cache_key, artist, album, meme, img_quality, img_format, fallback=False,
+                         priority=jobs.Priority.WARMUP)
+
+
+def get_cover(artist: str | None, album: str, meme: bool,
+              img_quality: ImageQuality, img_format: ImageFormat) -> bytes:
+    """
+    Find album cover
+    Parameters:
+        meta: Track metadata
+    Returns: Album cover image bytes, or None if no image was found.
+    """
+    cache_key =  f'cover{artist}{album}{meme}'  # quality is appended later
+
+    cache_data = cache.retrieve(cache_key + img_quality.name + img_format.name,
+                                revalidate=partial(_refresh_covers, cache_key, artist, album, meme,
+                                                   img_quality, img_format))
+    if cache_data is not None:
+        log.info('Returning %s quality %s cover thumbnail from cache: %s - %s',
+                 img_quality.name, img_format, artist, album)
+        return cache_data
+
+    with cache.Lock(cache_key):
+        # Thumbnails may have been generated by another thread or process while waiting for the lock
+        cache_data = cache.retrieve(cache_key + img_quality.name + img_format.name)
+        if cache_data is not None:
+            log.info('Cover thumbnail has been generated concurrently: %s - %s', artist, album)
+            return cache_data
+
+        log.info('Cover thumbnail not cached, need to download album cover image: %s - %s', artist, album)
+        return _generate_covers(cache_key, artist, album, meme, img_quality, img_format)
+
+
+def get_cover_file(artist: str | None, album: str, meme: bool,
+                   img_quality: ImageQuality, img_format: ImageFormat) -> Path | None:
+    """
+    Returns: Path to cached album cover, or None if the cover is not cached or too small to be
+    stored as a file. See get_cover().
+    """
+    return cache.retrieve_file(f'cover{artist}{album}{meme}' + img_quality.name + img_format.name)
 
 
 class AudioType(Enum):
@@ -188,11 +250,145 @@ class AudioType(Enum):
     """
     MP3 files with metadata (including cover art), for use with external
     music player applications and devices Uses the MP3 format for broadest
-    compatibility.
+    compatibility. Transcoded audio is cached without metadata, use
+    Track.mp3_with_metadata() to get the metadata tag.
     """
     MP3_WITH_METADATA = 3
 
 
+# Audio types that can be written to a pipe by ffmpeg. MP4 with faststart and MP3 with a Xing
+# header require a seekable output file.
+STREAMING_AUDIO_TYPES = {AudioType.WEBM_OPUS_HIGH, AudioType.WEBM_OPUS_LOW}
+
+# Source audio in these codecs is remuxed instead of transcoded, if its bit rate does not exceed
+# the maximum. The maximum is a bit higher than the bit rate we encode at, because YouTube
+# provides 160kbps Opus audio.
+PASSTHROUGH_CODECS = {AudioType.WEBM_OPUS_HIGH: 'opus',
+                      AudioType.WEBM_OPUS_LOW: 'opus',
+                      AudioType.MP4_AAC: 'aac'}
+PASSTHROUGH_MAX_BIT_RATE = {AudioType.WEBM_OPUS_HIGH: 160_000,
+                            AudioType.WEBM_OPUS_LOW: 64_000,
+                            AudioType.MP4_AAC: 192_000}
+# Maximum loudness difference in dB for remuxed AAC audio, which can't be normalized without re-encoding
+AAC_PASSTHROUGH_MAX_GAIN = 1.0
+# Number of bytes at the start of a file searched for the Opus identification header
+OPUS_HEAD_SEARCH_SIZE = 64 * 1024
+
+# ffmpeg output format and media type of remuxed video, for each supported video codec
+VIDEO_FORMATS = {'vp9': ('webm', 'video/webm'),
+                 'h264': ('mp4', 'video/mp4')}
+
+# Audio types available as separately transcoded segments, for segmented playback using Media Source Extensions
+SEGMENTED_AUDIO_TYPES = {AudioType.WEBM_OPUS_HIGH, AudioType.WEBM_OPUS_LOW, AudioType.MP4_AAC}
+# Length of a segment in seconds
+SEGMENT_DURATION = 10
+
+
+def _webm_opus_options(audio_type: AudioType) -> list[str]:
+    bit_rate = '128k' if audio_type == AudioType.WEBM_OPUS_HIGH else '48k'
+    return ['-f', 'webm',
+            '-c:a', 'libopus',
+            '-b:a', bit_rate,
+            '-vbr', 'on',
+            # Higher frame duration offers better compression at the cost of latency
+            '-frame_duration', '60',
+            '-vn']  # remove video track (and album covers)
+
+
+def _opus_header_gain(path: Path) -> int | None:
+    """
+    Output gain from the Opus identification header. It is at the start of Ogg files, and part of
+    the codec private data in Matroska files, which is stored before the audio.
+    Returns: Gain in Q7.8 format, or None if the header was not found
+    """
+    with path.open('rb') as file:
+        data = file.read(OPUS_HEAD_SEARCH_SIZE)
+    # Magic signature, version, channel count, pre-skip and input sample rate precede the gain
+    start = data.find(b'OpusHead')
+    if start == -1 or len(data) < start + 18:
+        return None
+    return int.from_bytes(data[start + 16:start + 18], 'little', signed=True)
+
+
+def _audio_options(audio_type: AudioType, fragmented: bool = False) -> list[str]:
+    """
+    Args:
+        audio_type: Audio type
+        fragmented: Produce fragmented MP4, as required by Media Source Extensions
+    Returns: ffmpeg output options for an audio type
+    """
+    if audio_type in {AudioType.WEBM_OPUS_HIGH, AudioType.WEBM_OPUS_LOW}:
+        return _webm_opus_options(audio_type)
+
+    if audio_type == AudioType.MP4_AAC:
+        # https://trac.ffmpeg.org/wiki/Encode/AAC
+        return ['-f', 'mp4',
+                '-c:a', 'aac',
+                '-q:a', '3', # 96k-144k
+                # +faststart to allow playback without downloading entire file
+                '-movflags', '+frag_keyframe+empty_moov+default_base_moof' if fragmented else '+faststart',
+                '-vn']  # remove video track (and album covers)
+
+    if audio_type == AudioType.MP3_WITH_METADATA:
+        # https://trac.ffmpeg.org/wiki/Encode/MP3
+        return ['-f', 'mp3',
+                '-c:a', 'libmp3lame',
+                '-q:a', '2',  # VBR 190kbps
+                # Metadata is added by Track.mp3_with_metadata()
+                '-id3v2_version', '0',
+                '-write_id3v1', '0',
+                '-vn']
+
+    raise ValueError(audio_type)
+
+
+@contextmanager
+def _job_lock(cache_key: str, priority: jobs.Priority) -> Iterator[None]:
+    """
+    Occupy a job slot, then lock the cache key. Commands must be started using jobs.run_in_slot().
+    The slot is acquired first, so a job waiting in the queue never holds a lock that a job of
+    higher priority is waiting for.
+    """
+    with jobs.slot(priority), cache.Lock(cache_key):
+        yield
+
+
+def _process_output(command: list[str], priority: jobs.Priority, kind: str, track: str) -> Iterator[bytes]:
+    """
+    Run command, yielding its output as it is produced. A job slot of the given priority must
+    have been acquired using jobs.acquire().
+    Raises: CalledProcessError if the command fails, after all output has been yielded
+    """
+    start_time = time.monotonic()
+    output_bytes = 0
+    process = subprocess.Popen(command, shell=False, stdout=subprocess.PIPE)
+    assert process.stdout
+    try:
+        while chunk := process.stdout.read1(64*1024):
+            output_bytes += len(chunk)
+            yield chunk
+    finally:
+        # If output is no longer read, ffmpeg exits due to the closed pipe
+        process.stdout.close()
+        returncode = jobs.wait(process, command, priority, start_time, kind, track, output_bytes)
+    if returncode != 0:
+        raise CalledProcessError(returncode, command)
+
+
+def _remux_webm(priority: jobs.Priority, input_path: Path, output_path: Path) -> None:
+    """
+    When writing to a pipe, ffmpeg can't go back to write the duration and seek index. Remux
+    streamed audio before storing it in the cache, so later playback from cache is seekable.
+    Runs in the job slot of the streaming process.
+    """
+    jobs.run_in_slot(['ffmpeg', '-y', *settings.ffmpeg_flags(),
+                      '-i', input_path.as_posix(),
+                      '-c', 'copy',
+                      '-f', 'webm',
+                      output_path.as_posix()],
+                     priority, 'webm_remux')
+
+
 @dataclass
 class Track:
     conn: Connection
@@ -236,12 +432,9 @@ class Track:
 
         return Metadata(self.relpath, duration, metadata.sort_artists(artists, album_artist), album, title, year, album_artist, track_number, tags, lyrics, video)
 
-    def get_cover(self, meme: bool, img_quality: ImageQuality, img_format: ImageFormat) -> bytes:
+    def _cover_search(self) -> tuple[str | None, str]:
         """
-        Find album cover using MusicBrainz or Bing.
-        Parameters:
-            meta: Track metadata
-        Returns: Album cover image bytes, or None if MusicBrainz nor bing found an image.
+        Returns: Artist and album to find the album cover for
         """
         meta = self.metadata()
 
@@ -259,181 +452,526 @@ class Track:
         else:
             artist = None
 
-        return get_cover(artist, album, meme, img_quality, img_format)
+        return artist, album
 
-    def get_loudnorm_filter(self) -> str:
-        """Get ffmpeg loudnorm filter string"""
-        cache_key = 'loud3' + self.relpath + str(self.mtime)
-        cached_data = cache.retrieve(cache_key)
-        if cached_data is not None:
-            log.info('Returning cached loudness data')
-            return cached_data.decode()
-
-        # First phase of 2-phase loudness normalization
-        # http://k.ylo.ph/2016/04/04/loudnorm.html
-        log.info('Measuring loudness: %s', self.relpath)
-        meas_command = ['ffmpeg',
-                        '-hide_banner',
-                        '-nostats',
-                        '-i', self.path.resolve().as_posix(),
-                        '-map', '0:a',
-                        '-af', 'loudnorm=print_format=json',
-                        '-f', 'null',
-                        '/dev/null']
-        # Annoyingly, loudnorm outputs to stderr instead of stdout.
-        # Disabling logging also hides the loudnorm output...
-        meas_result = subprocess.run(meas_command, shell=False, capture_output=True, check=False)
-
-        if meas_result.returncode != 0:
-            log.warning('FFmpeg exited with exit code %s', meas_result.returncode)
-            log.warning('--- stdout ---\n%s', meas_result.stdout.decode())
-            log.warning('--- stderr ---\n%s', meas_result.stderr.decode())
-            raise RuntimeError()
-
-        # Manually find the start of loudnorm info json
-        meas_out = meas_result.stderr.decode()
-
-        start = meas_out.rindex('Parsed_loudnorm_0') + 37
-        end = start + meas_out[start:].index('}') + 1
-        json_text = meas_out[start:end]
-        try:
-            meas_json = jsonw.from_json(json_text)
-        except JSONDecodeError as ex:
-            log.error('Invalid json: %s', json_text)
-            log.error('Original output: %s', meas_out)
-            raise ex
+    def get_cover(self, meme: bool, img_quality: ImageQuality, img_format: ImageFormat) -> bytes:
+        """
+        Find album cover using MusicBrainz or Bing.
+        Parameters:
+            meta: Track metadata
+        Returns: Album cover image bytes, or None if MusicBrainz nor bing found an image.
+        """
+        return get_cover(*self._cover_search(), meme, img_quality, img_format)
 
-        log.info('Measured integrated loudness: %s', meas_json['input_i'])
+    def get_cover_file(self, meme: bool, img_quality: ImageQuality, img_format: ImageFormat) -> Path | None:
+        """
+        Returns: Path to cached album cover file, see get_cover_file()
+        """
+        return get_cover_file(*self._cover_search(), meme, img_quality, img_format)
 
-        if float(meas_json['input_i']) > 0:
+    def _measured_loudness(self) -> tuple[float, float, float, float, float] | None:
+        """
+        Returns: Integrated loudness, true peak, LRA, threshold and target offset measured by the
+        scanner, or None if the measurement is missing or unusable
+        """
+        row = self.conn.execute('''
+                                SELECT loudness_i, loudness_tp, loudness_lra, loudness_thresh, loudness_offset
+                                FROM track WHERE path=?
+                                ''', (self.relpath,)).fetchone()
+        if row is None or row[0] is None:
+            log.warning('Loudness has not been measured: %s', self.relpath)
+            return None
+
+        if row[0] > 0:
             log.warning('Measured positive loudness. This should be impossible, but can happen ' +
-                        'with input files containing out of range values. Need to use ' +
-                        'single-pass loudnorm filter instead.')
+                        'with input files containing out of range values.')
             log.warning('Track: %s', self.path.resolve().as_posix())
-            loudnorm = settings.loudnorm_filter
+            return None
+
+        return row
+
+    def get_loudnorm_filter(self) -> str:
+        """
+        Get ffmpeg loudnorm filter string, using loudness measured by the scanner
+        """
+        loudness = self._measured_loudness()
+        if loudness is None:
+            log.warning('Using single-pass loudnorm filter')
+            return settings.loudnorm_filter
+
+        measured_i, measured_tp, measured_lra, measured_thresh, offset = loudness
+
+        return f'{settings.loudnorm_filter}:' + \
+               f'measured_I={measured_i}:' + \
+               f'measured_TP={measured_tp}:' + \
+               f'measured_LRA={measured_lra}:' + \
+               f'measured_thresh={measured_thresh}:' + \
+               f'offset={offset}:' + \
+               'linear=true'
+
+    def get_gain_filter(self) -> str:
+        """
+        Get ffmpeg filter string that applies a static gain, to bring the measured integrated
+        loudness to the loudness target. Much cheaper than loudnorm, which resamples to 192kHz. A
+        limiter is only added if peaks would exceed the true peak target after amplification.
+        """
+        loudness = self._measured_loudness()
+        if loudness is None:
+            log.warning('Using single-pass loudnorm filter')
+            return settings.loudnorm_filter
+
+        measured_i, measured_tp, _lra, _thresh, _offset = loudness
+        gain = settings.loudness_target_i - measured_i
+        volume = f'volume={gain:.2f}dB'
+
+        if measured_tp + gain <= settings.loudness_target_tp:
+            return volume
+
+        limit = 10 ** (settings.loudness_target_tp / 20)
+        return f'{volume},alimiter=limit={limit:.4f}:level=false'
+
+    def get_normalization_filter(self) -> str:
+        """
+        Get ffmpeg filter string for loudness normalization, depending on the configured mode
+        """
+        if settings.normalization_mode == 'gain':
+            return self.get_gain_filter()
+        return self.get_loudnorm_filter()
+
+    def _audio_cache_key(self, audio_type: AudioType) -> str:
+        # Audio is identified by a hash of the source audio, so the cache stays valid when only
+        # metadata is modified
+        row = self.conn.execute('''
+                                SELECT audio_hash, loudness_i IS NULL AND loudness_failed = 0
+                                FROM track WHERE path=?
+                                ''', (self.relpath,)).fetchone()
+        if row and row[0]:
+            key = 'audio11' + settings.normalization_mode + str(audio_type) + row[0]
         else:
-            loudnorm = \
-                f'{settings.loudnorm_filter}:' + \
-                f"measured_I={meas_json['input_i']}:" + \
-                f"measured_TP={meas_json['input_tp']}:" + \
-                f"measured_LRA={meas_json['input_lra']}:" + \
-                f"measured_thresh={meas_json['input_thresh']}:" + \
-                f"offset={meas_json['target_offset']}:" + \
-                'linear=true'
-
-        # Cache for a year, expensive to calculate and orphan entries don't take up much space
-        cache.store(cache_key, loudnorm.encode(), duration=cache.YEAR)
-        return loudnorm
+            key = 'audio11' + settings.normalization_mode + str(audio_type) + self.relpath + str(self.mtime)
+        if row and row[1]:
+            # Loudness is still being measured in the background. Audio normalized without the
+            # measurement must not be used once it is available.
+            key += 'unmeasured'
+        return key
+
+    def _passthrough_options(self, audio_type: AudioType) -> list[str] | None:
+        """
+        Returns: ffmpeg output options to remux the audio stream without re-encoding, or None if
+        the source audio is not suitable for the requested audio type.
+        """
+        if audio_type not in PASSTHROUGH_CODECS:
+            return None
+
+        row = self.conn.execute('SELECT audio_codec, audio_bit_rate, audio_channels FROM track WHERE path=?',
+                                (self.relpath,)).fetchone()
+        if row is None:
+            return None
+        codec, bit_rate, channels = row
+        if codec != PASSTHROUGH_CODECS[audio_type] or \
+                bit_rate is None or bit_rate > PASSTHROUGH_MAX_BIT_RATE[audio_type] or \
+                channels is None or channels > 2:
+            return None
+
+        loudness = self._measured_loudness()
+        if loudness is None:
+            return None
+        measured_i, measured_tp, _lra, _thresh, _offset = loudness
+        gain = settings.loudness_target_i - measured_i
+        if measured_tp + gain > settings.loudness_target_tp:
+            # A limiter would be required
+            return None
+
+        if codec == 'opus':
+            # Set output gain in the Opus header, in Q7.8 format. Decoders are required to apply it.
+            # Loudness was measured with the existing gain applied, so the correction is added to it.
+            header_gain = _opus_header_gain(self.path)
+            if header_gain is None:
+                return None
+            output_gain = header_gain + round(gain * 256)
+            if not -32768 <= output_gain <= 32767:
+                return None
+            return ['-f', 'webm',
+                    '-c:a', 'copy',
+                    '-bsf:a', f'opus_metadata=gain={output_gain}',
+                    '-vn']
+
+        # AAC has no gain field that browsers respect, only pass through audio that is loud enough already
+        if abs(gain) > AAC_PASSTHROUGH_MAX_GAIN:
+            return None
+        return ['-f', 'mp4',
+                '-c:a', 'copy',
+                '-movflags', '+faststart',
+                '-vn']
 
     def transcoded_audio(self,
-                         audio_type: AudioType) -> bytes:
+                         audio_type: AudioType,
+                         priority: jobs.Priority = jobs.Priority.INTERACTIVE) -> Path:
         """
         Normalize and compress audio using ffmpeg
-        Returns: Compressed audio bytes
+        Args:
+            audio_type: Audio type to transcode to
+            priority: Priority of the ffmpeg job, if the audio is not cached yet
+        Returns: Path to compressed audio file in cache
         """
-        cache_key = 'audio9' + str(audio_type) + self.relpath + str(self.mtime)
+        cache_key = self._audio_cache_key(audio_type)
 
-        cached_data = cache.retrieve(cache_key)
+        cached_path = cache.retrieve_file(cache_key)
 
-        if cached_data is not None:
+        if cached_path is not None:
             log.info('Returning cached audio')
-            return cached_data
+            return cached_path
 
-        loudnorm = self.get_loudnorm_filter()
+        with _job_lock(cache_key, priority):
+            cached_path = cache.retrieve_file(cache_key)
+            if cached_path is not None:
+                log.info('Audio has been transcoded concurrently')
+                return cached_path
 
-        log.info('Transcoding audio: %s', self.relpath)
+            return self._transcode(audio_type, cache_key, priority)
 
-        input_options = ['-map', '0:a', # only keep audio
-                         '-map_metadata', '-1']  # discard metadata
-
-        if audio_type in {AudioType.WEBM_OPUS_HIGH, AudioType.WEBM_OPUS_LOW}:
-            bit_rate = '128k' if audio_type == AudioType.WEBM_OPUS_HIGH else '48k'
-            audio_options = ['-f', 'webm',
-                             '-c:a', 'libopus',
-                             '-b:a', bit_rate,
-                             '-vbr', 'on',
-                             # Higher frame duration offers better compression at the cost of latency
-                             '-frame_duration', '60',
-                             '-vn']  # remove video track (and album covers)
-        elif audio_type == AudioType.MP4_AAC:
-            # https://trac.ffmpeg.org/wiki/Encode/AAC
-            audio_options = ['-f', 'mp4',
-                             '-c:a', 'aac',
-                             '-q:a', '3', # 96k-144k
-                             # +faststart to allow playback without downloading entire file
-                             '-movflags', '+faststart',
-                             '-vn']  # remove video track (and album covers)
-        elif audio_type == AudioType.MP3_WITH_METADATA:
-            # https://trac.ffmpeg.org/wiki/Encode/MP3
-            cover = self.get_cover(False, image.QUALITY_HIGH, img_format=ImageFormat.JPEG)
-            # Write cover to temp file so ffmpeg can read it
-            # cover_temp_file = tempfile.NamedTemporaryFile('wb')  # pylint: disable=consider-using-with
-            cover_temp_file = open('/tmp/test', 'wb')
-            cover_temp_file.write(cover)
-            meta = self.metadata()
-
-            input_options = ['-i', cover_temp_file.name,  # Add album cover
-                             '-map', '0:a', # include audio stream from first input
-                             '-map', '1:0', # include first stream from second input
-                             '-id3v2_version', '3',
-                             '-map_metadata', '-1',  # discard original metadata
-                             '-metadata:s:v', 'title=Album cover',
-                             '-metadata:s:v', 'comment=Cover (front)',
-                             *meta.get_ffmpeg_options()]  # set new metadata
-
-            audio_options = ['-f', 'mp3',
-                             '-c:a', 'libmp3lame',
-                             '-c:v', 'copy',  # Leave cover as JPEG, don't re-encode as PNG
-                             '-q:a', '2']  # VBR 190kbps
-        else:
-            raise ValueError(audio_type)
+    def transcoded_audio_batch(self,
+                               audio_types: list[AudioType],
+                               priority: jobs.Priority = jobs.Priority.INTERACTIVE) -> dict[AudioType, Path]:
+        """
+        Like transcoded_audio(), for multiple audio types at once. Audio types that are not cached
+        yet are produced by a single ffmpeg process, which decodes and normalizes the source once
+        and then encodes it for every audio type.
+        Returns: Path to compressed audio file in cache, for each audio type
+        """
+        result: dict[AudioType, Path] = {}
+        for audio_type in audio_types:
+            cached_path = cache.retrieve_file(self._audio_cache_key(audio_type))
+            if cached_path is not None:
+                result[audio_type] = cached_path
 
-        with tempfile.NamedTemporaryFile() as temp_output:
+        if len(result) == len(audio_types):
+            return result
+
+        # The job slot is acquired before the locks, see _job_lock()
+        with jobs.slot(priority):
+            locks: dict[AudioType, cache.Lock] = {}
+
+            try:
+                # Locks are acquired in a consistent order, so concurrent batches can't deadlock
+                for audio_type in sorted(audio_types, key=lambda audio_type: audio_type.value):
+                    if audio_type in result:
+                        continue
+                    cache_key = self._audio_cache_key(audio_type)
+                    lock = cache.Lock(cache_key)
+                    lock.acquire()
+                    cached_path = cache.retrieve_file(cache_key)
+                    if cached_path is None:
+                        locks[audio_type] = lock
+                        continue
+                    lock.release()
+                    result[audio_type] = cached_path
+
+                batch: list[AudioType] = []
+                for audio_type in locks:
+                    if self._passthrough_options(audio_type) is None:
+                        batch.append(audio_type)
+                    else:
+                        result[audio_type] = self._transcode(audio_type, self._audio_cache_key(audio_type), priority)
+
+                if len(batch) == 1:
+                    result[batch[0]] = self._transcode(batch[0], self._audio_cache_key(batch[0]), priority)
+                elif batch:
+                    result.update(self._transcode_batch(batch, priority))
+            finally:
+                for lock in locks.values():
+                    lock.release()
+
+        return result
+
+    def _transcode_batch(self, audio_types: list[AudioType], priority: jobs.Priority) -> dict[AudioType, Path]:
+        audio_filter = self.get_normalization_filter()
+
+        log.info('Transcoding audio to %s formats: %s', len(audio_types), self.relpath)
+
+        labels = [f'[out{i}]' for i in range(len(audio_types))]
+        filter_complex = f'[0:a]{audio_filter},asplit={len(audio_types)}' + ''.join(labels)
+
+        with ExitStack() as stack:
+            temp_outputs = [stack.enter_context(cache.temp_file()) for _audio_type in audio_types]
+            command = ['ffmpeg',
+                       '-y',  # overwriting file is required, because the created temp file already exists
+                       *settings.ffmpeg_flags(),
+                       '-t', str(settings.track_max_duration_seconds),
+                       '-i', self.path.resolve().as_posix(),
+                       '-filter_complex', filter_complex]
+            for label, audio_type, temp_output in zip(labels, audio_types, temp_outputs):
+                command.extend(['-map', label,
+                                '-map_metadata', '-1',
+                                *_audio_options(audio_type),
+                                '-ac', '2',
+                                temp_output.name])
+            jobs.run_in_slot(command, priority, '+'.join(audio_type.name.lower() for audio_type in audio_types),
+                             self.relpath)
+
+            return {audio_type: cache.store_file(self._audio_cache_key(audio_type), Path(temp_output.name), cache.HALFYEAR)
+                    for audio_type, temp_output in zip(audio_types, temp_outputs)}
+
+    def _transcode(self, audio_type: AudioType, cache_key: str, priority: jobs.Priority) -> Path:
+        passthrough_options = self._passthrough_options(audio_type)
+        if passthrough_options is not None:
+            return self._remux(audio_type, passthrough_options, cache_key, priority)
+
+        audio_filter = self.get_normalization_filter()
+
+        log.info('Transcoding audio: %s', self.relpath)
+
+        with cache.temp_file() as temp_output:
             command = ['ffmpeg',
                     '-y',  # overwriting file is required, because the created temp file already exists
                     *settings.ffmpeg_flags(),
                     '-i', self.path.resolve().as_posix(),
-                    *input_options,
-                    *audio_options,
+                    '-map', '0:a', # only keep audio
+                    '-map_metadata', '-1',  # discard metadata
+                    *_audio_options(audio_type),
                     '-t', str(settings.track_max_duration_seconds),
                     '-ac', '2',
-                    '-filter:a', loudnorm,
+                    '-filter:a', audio_filter,
                     temp_output.name]
-            subprocess.run(command, shell=False, check=True)
-            audio_data = temp_output.read()
+            jobs.run_in_slot(command, priority, audio_type.name.lower(), self.relpath)
+
+            # Audio for sure doesn't change so ideally we'd cache for longer, but that would mean
+            # deleted tracks remain in the cache for longer as well.
+            return cache.store_file(cache_key, Path(temp_output.name), cache.HALFYEAR)
+
+    def _remux(self, audio_type: AudioType, output_options: list[str], cache_key: str, priority: jobs.Priority) -> Path:
+        log.info('Remuxing audio: %s', self.relpath)
 
-        if audio_type == AudioType.MP3_WITH_METADATA:
-            cover_temp_file.close()  # pyright: ignore[reportPossiblyUnboundVariable]
+        with cache.temp_file() as temp_output:
+            command = ['ffmpeg',
+                       '-y',  # overwriting file is required, because the created temp file already exists
+                       *settings.ffmpeg_flags(),
+                       '-i', self.path.resolve().as_posix(),
+                       '-map', '0:a',
+                       '-map_metadata', '-1',
+                       *output_options,
+                       '-t', str(settings.track_max_duration_seconds),
+                       temp_output.name]
+            jobs.run_in_slot(command, priority, audio_type.name.lower() + '_passthrough', self.relpath)
+            return cache.store_file(cache_key, Path(temp_output.name), cache.HALFYEAR)
+
+    def transcoded_audio_stream(self,
+                                audio_type: AudioType,
+                                priority: jobs.Priority = jobs.Priority.INTERACTIVE) -> Path | Iterator[bytes]:
+        """
+        Like transcoded_audio(), but if the audio is not cached yet and streaming transcoding is
+        enabled, audio is returned while ffmpeg is producing it. It is stored in the cache at the
+        same time, also when the returned iterator is not consumed completely.
+        Returns: Path to compressed audio file in cache, or iterator of compressed audio data
+        """
+        if not settings.transcode_streaming or audio_type not in STREAMING_AUDIO_TYPES or \
+                self._passthrough_options(audio_type) is not None:
+            # Remuxing is fast enough that streaming is not needed
+            return self.transcoded_audio(audio_type, priority)
 
-        # Audio for sure doesn't change so ideally we'd cache for longer, but that would mean
-        # deleted tracks remain in the cache for longer as well.
-        cache.store(cache_key, audio_data, cache.HALFYEAR)
-        return audio_data
+        cache_key = self._audio_cache_key(audio_type)
+
+        cached_path = cache.retrieve_file(cache_key)
+
+        if cached_path is not None:
+            log.info('Returning cached audio')
+            return cached_path
+
+        # The job slot is acquired before the lock, see _job_lock(). Both are held until the
+        # stream has been stored, so concurrent requests wait for it and then return the cached
+        # audio.
+        jobs.acquire(priority)
+        lock = cache.Lock(cache_key)
+        try:
+            lock.acquire()
+        except BaseException:
+            jobs.release(priority)
+            raise
+
+        def release() -> None:
+            lock.release()
+            jobs.release(priority)
+
+        try:
+            cached_path = cache.retrieve_file(cache_key)
+            if cached_path is not None:
+                log.info('Audio has been transcoded concurrently')
+                release()
+                return cached_path
+
+            audio_filter = self.get_normalization_filter()
+
+            log.info('Transcoding audio (streaming): %s', self.relpath)
+
+            command = ['ffmpeg',
+                       *settings.ffmpeg_flags(),
+                       '-i', self.path.resolve().as_posix(),
+                       '-map', '0:a',
+                       '-map_metadata', '-1',
+                       *_webm_opus_options(audio_type),
+                       '-t', str(settings.track_max_duration_seconds),
+                       '-ac', '2',
+                       '-filter:a', audio_filter,
+                       'pipe:1']
+
+            # From here on, the lock and job slot are released by the thread storing the stream
+            return cache.store_stream(cache_key,
+                                      _process_output(command, priority, audio_type.name.lower(), self.relpath),
+                                      cache.HALFYEAR,
+                                      partial(_remux_webm, priority), release)
+        except BaseException:
+            release()
+            raise
+
+    def remuxed_video(self, priority: jobs.Priority = jobs.Priority.INTERACTIVE) -> tuple[Path, str]:
+        """
+        Get the video stream of this track, without audio, in a container browsers can play
+        Args:
+            priority: Priority of the ffmpeg job, if the video is not cached yet
+        Returns: Path to video file in cache, and its media type
+        Raises: ValueError if the track has no suitable video stream
+        """
+        video = self.metadata().video
+        if video not in VIDEO_FORMATS:
+            raise ValueError('track has no suitable video stream')
+        output_format, media_type = VIDEO_FORMATS[video]
+
+        cache_key = 'video1' + self.relpath + str(self.mtime)
+
+        cached_path = cache.retrieve_file(cache_key)
+        if cached_path is not None:
+            return cached_path, media_type
+
+        with _job_lock(cache_key, priority):
+            cached_path = cache.retrieve_file(cache_key)
+            if cached_path is not None:
+                return cached_path, media_type
+
+            log.info('Remuxing video: %s', self.relpath)
+
+            with cache.temp_file() as temp_output:
+                jobs.run_in_slot(['ffmpeg',
+                                  '-y',  # overwriting file is required, because the created temp file already exists
+                                  *settings.ffmpeg_flags(),
+                                  '-i', self.path.resolve().as_posix(),
+                                  '-map', '0:V',  # video streams, excluding attached pictures (album covers)
+                                  '-c:v', 'copy',
+                                  # Allow playback to start without downloading the entire file
+                                  *(['-movflags', '+faststart'] if output_format == 'mp4' else []),
+                                  '-f', output_format,
+                                  temp_output.name],
+                                 priority, 'video', self.relpath)
+                return cache.store_file(cache_key, Path(temp_output.name), cache.HALFYEAR), media_type
+
+    def segment_count(self) -> int:
+        """
+        Returns: Number of segments of SEGMENT_DURATION seconds, see transcoded_segment()
+        """
+        duration = min(self.metadata().duration, settings.track_max_duration_seconds)
+        return max(1, math.ceil(duration / SEGMENT_DURATION))
+
+    def transcoded_segment(self,
+                           audio_type: AudioType,
+                           index: int,
+                           priority: jobs.Priority = jobs.Priority.INTERACTIVE) -> Path:
+        """
+        Like transcoded_audio(), for a single segment of SEGMENT_DURATION seconds. Segments are
+        transcoded on demand, so playback of a long track can start after transcoding the first
+        segment, and after seeking only the segments that are played are transcoded. Every
+        segment is a complete file with timestamps starting at zero, clients need to offset them
+        by the start time of the segment (index * SEGMENT_DURATION).
+        Args:
+            audio_type: One of SEGMENTED_AUDIO_TYPES
+            index: Segment index, from 0 to segment_count() (exclusive)
+            priority: Priority of the ffmpeg job, if the segment is not cached yet
+        Returns: Path to segment in cache
+        """
+        if audio_type not in SEGMENTED_AUDIO_TYPES:
+            raise ValueError(audio_type)
+        if not 0 <= index < self.segment_count():
+            raise ValueError(index)
+
+        cache_key = f'segment{SEGMENT_DURATION}-{index}' + self._audio_cache_key(audio_type)
+
+        cached_path = cache.retrieve_file(cache_key)
+        if cached_path is not None:
+            return cached_path
+
+        with _job_lock(cache_key, priority):
+            cached_path = cache.retrieve_file(cache_key)
+            if cached_path is not None:
+                return cached_path
+
+            start = index * SEGMENT_DURATION
+            duration = min(SEGMENT_DURATION, settings.track_max_duration_seconds - start)
+
+            log.info('Transcoding segment %s: %s', index, self.relpath)
+
+            with cache.temp_file() as temp_output:
+                command = ['ffmpeg',
+                           '-y',  # overwriting file is required, because the created temp file already exists
+                           *settings.ffmpeg_flags(),
+                           '-ss', str(start),
+                           '-t', str(duration),
+                           '-i', self.path.resolve().as_posix(),
+                           '-map', '0:a',
+                           '-map_metadata', '-1',
+                           *_audio_options(audio_type, fragmented=True),
+                           '-ac', '2',
+                           # Normalization must not depend on the segment, so the loudness of
+                           # the entire track is used (measured by the scanner)
+                           '-filter:a', self.get_normalization_filter(),
+                           temp_output.name]
+                jobs.run_in_slot(command, priority, audio_type.name.lower() + '_segment', self.relpath)
+
+                # Segments are only used for long tracks by some clients, cache for a shorter time
+                return cache.store_file(cache_key, Path(temp_output.name), cache.MONTH)
+
+    def mp3_with_metadata(self,
+                          priority: jobs.Priority = jobs.Priority.EXPORT) -> tuple[bytes, Path]:
+        """
+        MP3 audio with metadata, including cover art. The audio is transcoded once and cached
+        without metadata, the metadata tag is generated for every download.
+        Returns: ID3 tag, and path to MP3 audio in cache. Together they form the MP3 file.
+        """
+        audio_path = self.transcoded_audio(AudioType.MP3_WITH_METADATA, priority)
+        cover = self.get_cover(False, image.QUALITY_HIGH, img_format=ImageFormat.JPEG)
+        return id3.tag(self.metadata(), cover), audio_path
 
     def write_metadata(self, meta: Metadata):
         """
-        Write metadata to file
+        Write metadata to file. Tags are written natively where possible, so large files don't
+        need to be copied. Other formats are remuxed using ffmpeg.
         """
-        original_extension = '.' + self.path.name.split('.')[-1]
+        if tags.write(self.path, meta.tag_values()):
+            return
+
         # ogg format seems to require setting metadata in stream instead of container
         metadata_flag = '-metadata:s' if self.path.name.endswith('.ogg') else '-metadata'
-        with tempfile.NamedTemporaryFile(suffix=original_extension) as temp_file:
-            command = [
-                'ffmpeg',
-                '-y',  # overwriting file is required, because the created temp file already exists
-                '-hide_banner',
-                '-nostats',
-                '-loglevel', settings.ffmpeg_log_level,
-                '-i', self.path.resolve().as_posix(),
-                '-codec', 'copy',
-                *meta.get_ffmpeg_options(metadata_flag),
-                temp_file.name,
-            ]
-
-            log.info('Writing metadata: %s', str(command))
-            subprocess.run(command, shell=False, check=True, capture_output=False)
-            shutil.copy(temp_file.name, self.path)
-
+        # The temporary file is created next to the original file so it can be renamed atomically. It does
+        # not have a music extension, so the scanner ignores it, and the output format is specified explicitly.
+        with tempfile.NamedTemporaryFile(dir=self.path.parent, prefix='.', suffix='.tmp', delete=False) as temp_file:
+            try:
+                command = [
+                    'ffmpeg',
+                    '-y',  # overwriting file is required, because the created temp file already exists
+                    '-hide_banner',
+                    '-nostats',
+                    '-loglevel', settings.ffmpeg_log_level,
+                    '-i', self.path.resolve().as_posix(),
+                    '-codec', 'copy',
+                    *meta.get_ffmpeg_options(metadata_flag),
+                    '-f', MUXERS[self.path.suffix.lower()],
+                    temp_file.name,
+                ]
+
+                log.info('Writing metadata: %s', str(command))
+                jobs.run(command, jobs.Priority.INTERACTIVE, 'metadata', self.relpath)
+                shutil.copymode(self.path, temp_file.name)
+                os.replace(temp_file.name, self.path)
+            except BaseException:
+                os.unlink(temp_file.name)
+                raise
 
     def info_dict(self):
         meta = self.metadata()
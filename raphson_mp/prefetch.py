@@ -0,0 +1,78 @@
+"""
+Speculative transcoding of tracks chosen by the music player, so the audio is already cached
+when the player requests it a few seconds later.
+"""
+import logging
+from threading import Lock, Thread
+
+from raphson_mp import db, jobs, settings
+from raphson_mp.music import AudioType, Track
+
+log = logging.getLogger(__name__)
+
+# Maximum number of tracks transcoded speculatively at the same time, so prefetching can't
+# use all CPU cores while users are waiting for audio
+MAX_IN_FLIGHT = 2
+
+_lock = Lock()
+_in_flight: set[str] = set()
+_audio_types: dict[int, AudioType] = {}
+
+# Statistics, exported as metrics by prometheus.py
+started: int = 0
+skipped: int = 0
+failed: int = 0
+
+
+def in_flight() -> int:
+    return len(_in_flight)
+
+
+def record_audio_type(user_id: int, audio_type: AudioType) -> None:
+    """
+    Remember the audio type requested by a user's music player, so that audio type is prefetched
+    for the next chosen track.
+    """
+    # MP3 is only used for downloads
+    if audio_type != AudioType.MP3_WITH_METADATA:
+        _audio_types[user_id] = audio_type
+
+
+def _prefetch(relpath: str, audio_type: AudioType) -> None:
+    global failed
+    try:
+        with db.connect(read_only=True) as conn:
+            track = Track.by_relpath(conn, relpath)
+            if track:
+                track.transcoded_audio(audio_type, jobs.Priority.PREFETCH)
+    except Exception:
+        log.exception('Failed to prefetch track: %s', relpath)
+        failed += 1
+    finally:
+        with _lock:
+            _in_flight.remove(relpath)
+
+
+def start(relpath: str, user_id: int) -> None:
+    """
+    Start transcoding a track in the background, for the audio type most recently requested by
+    the user. Does nothing if too many tracks are being prefetched already.
+    """
+    global started, skipped
+
+    if settings.offline_mode:
+        return
+
+    audio_type = _audio_types.get(user_id, AudioType.WEBM_OPUS_HIGH)
+
+    with _lock:
+        if relpath in _in_flight:
+            return
+        if len(_in_flight) >= MAX_IN_FLIGHT:
+            log.info('Not prefetching, too many tracks are being prefetched: %s', relpath)
+            skipped += 1
+            return
+        _in_flight.add(relpath)
+        started += 1
+
+    Thread(target=_prefetch, args=(relpath, audio_type), daemon=True, name='prefetch').start()
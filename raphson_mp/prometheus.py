@@ -1,9 +1,9 @@
 import functools
 import time
 
-from prometheus_client import Gauge
+from prometheus_client import Gauge, Histogram
 
-from raphson_mp import db
+from raphson_mp import cache, db, jobs, prefetch, refresh, warmup
 
 
 def _active_players():
@@ -17,5 +17,86 @@ g_database_size = Gauge('database_size', 'Size of SQLite database files', labeln
 for db_name in db.DATABASE_NAMES:
     g_database_size.labels(db_name).set_function(functools.partial(db.db_size, db_name))
 
+# In-memory cache tier
+Gauge('cache_memory_bytes', 'Size of cache entries kept in memory').set_function(lambda: cache.memory.size)
+Gauge('cache_memory_entries', 'Number of cache entries kept in memory').set_function(lambda: len(cache.memory))
+Gauge('cache_memory_hits', 'Cache entries retrieved from memory').set_function(lambda: cache.memory.hits)
+Gauge('cache_memory_misses', 'Cache entries not found in memory').set_function(lambda: cache.memory.misses)
+
+# Cache statistics by key namespace
+_cache_hits = Gauge('cache_hits', 'Cache entries retrieved', ['namespace'])
+_cache_misses = Gauge('cache_misses', 'Cache entries not found', ['namespace'])
+_cache_expired_hits = Gauge('cache_expired_hits', 'Expired cache entries retrieved', ['namespace'])
+_cache_bytes_stored = Gauge('cache_bytes_stored', 'Size of data stored in the cache', ['namespace'])
+_cache_bytes_served = Gauge('cache_bytes_served', 'Size of data retrieved from the cache', ['namespace'])
+_cache_retrieve_seconds = Histogram('cache_retrieve_seconds', 'Time to retrieve a cache entry', ['namespace'],
+                                    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, float('inf')))
+for _name, _stats in cache.stats.items():
+    _cache_hits.labels(_name).set_function(lambda s=_stats: s.hits)
+    _cache_misses.labels(_name).set_function(lambda s=_stats: s.misses)
+    _cache_expired_hits.labels(_name).set_function(lambda s=_stats: s.expired_hits)
+    _cache_bytes_stored.labels(_name).set_function(lambda s=_stats: s.bytes_stored)
+    _cache_bytes_served.labels(_name).set_function(lambda s=_stats: s.bytes_served)
+
+
+def _observe_cache_retrieve(name: str, duration: float) -> None:
+    _cache_retrieve_seconds.labels(name).observe(duration)
+
+
+cache.retrieve_observers.append(_observe_cache_retrieve)
+
 # Active players
 Gauge('active_players', 'Active players').set_function(_active_players)
+
+# Warm-up progress
+Gauge('warmup_pending', 'Tracks waiting to be warmed up').set_function(lambda: warmup.pending)
+Gauge('warmup_completed', 'Tracks warmed up since start').set_function(lambda: warmup.completed)
+Gauge('warmup_failed', 'Tracks that failed to warm up since start').set_function(lambda: warmup.failed)
+Gauge('warmup_paused', 'Whether warm-up is paused for interactive requests').set_function(lambda: warmup.paused)
+
+# Speculative transcoding of chosen tracks
+Gauge('prefetch_in_flight', 'Tracks being prefetched').set_function(prefetch.in_flight)
+Gauge('prefetch_started', 'Prefetch jobs started since start').set_function(lambda: prefetch.started)
+Gauge('prefetch_skipped', 'Prefetch jobs skipped because too many were in flight').set_function(lambda: prefetch.skipped)
+Gauge('prefetch_failed', 'Prefetch jobs that failed').set_function(lambda: prefetch.failed)
+
+# Background refresh of expired cache entries
+Gauge('refresh_queued', 'Expired cache entries waiting to be refreshed').set_function(refresh.queued)
+Gauge('refresh_started', 'Cache entry refreshes started since start').set_function(lambda: refresh.started)
+Gauge('refresh_skipped', 'Cache entry refreshes skipped because too many were queued').set_function(lambda: refresh.skipped)
+Gauge('refresh_failed', 'Cache entry refreshes that failed').set_function(lambda: refresh.failed)
+
+# Job scheduler
+_jobs_queue_depth = Gauge('jobs_queue_depth', 'Jobs waiting for a slot', ['priority'])
+_jobs_running = Gauge('jobs_running', 'Jobs running', ['priority'])
+_jobs_started = Gauge('jobs_started', 'Jobs started since start', ['priority'])
+_jobs_timed_out = Gauge('jobs_timed_out', 'Jobs that waited too long in the queue', ['priority'])
+_jobs_wait_seconds = Gauge('jobs_wait_seconds', 'Total time started jobs have waited in the queue', ['priority'])
+for _priority in jobs.Priority:
+    _jobs_queue_depth.labels(_priority.label).set_function(lambda p=_priority: jobs.queue_depth(p))
+    _jobs_running.labels(_priority.label).set_function(lambda p=_priority: jobs.running(p))
+    _jobs_started.labels(_priority.label).set_function(lambda p=_priority: jobs.started[p])
+    _jobs_timed_out.labels(_priority.label).set_function(lambda p=_priority: jobs.timed_out[p])
+    _jobs_wait_seconds.labels(_priority.label).set_function(lambda p=_priority: jobs.wait_seconds[p])
+
+# Resource usage of ffmpeg processes, by output format or purpose
+_BYTES_BUCKETS = (10_000, 100_000, 1_000_000, 10_000_000, 100_000_000, 1_000_000_000, float('inf'))
+_ffmpeg_wall_seconds = Histogram('ffmpeg_wall_seconds', 'Wall time of ffmpeg processes', ['kind'],
+                                 buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf')))
+_ffmpeg_cpu_seconds = Histogram('ffmpeg_cpu_seconds', 'CPU time of ffmpeg processes', ['kind', 'mode'],
+                                buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf')))
+_ffmpeg_input_bytes = Histogram('ffmpeg_input_bytes', 'Size of input files of ffmpeg processes', ['kind'],
+                                buckets=_BYTES_BUCKETS)
+_ffmpeg_output_bytes = Histogram('ffmpeg_output_bytes', 'Size of output of ffmpeg processes', ['kind'],
+                                 buckets=_BYTES_BUCKETS)
+
+
+def _observe_process(stats: jobs.ProcessStats) -> None:
+    _ffmpeg_wall_seconds.labels(stats.kind).observe(stats.wall_time)
+    _ffmpeg_cpu_seconds.labels(stats.kind, 'user').observe(stats.user_time)
+    _ffmpeg_cpu_seconds.labels(stats.kind, 'system').observe(stats.system_time)
+    _ffmpeg_input_bytes.labels(stats.kind).observe(stats.input_bytes)
+    _ffmpeg_output_bytes.labels(stats.kind).observe(stats.output_bytes)
+
+
+jobs.observers.append(_observe_process)
@@ -0,0 +1,91 @@
+"""
+Stale-while-revalidate for cache entries derived from network requests, like lyrics and album
+covers. Expired entries are returned immediately, and refreshed in the background.
+"""
+import logging
+import os
+import time
+from collections.abc import Callable
+from queue import Full, Queue
+from threading import Lock, Thread
+
+from raphson_mp import settings
+
+log = logging.getLogger(__name__)
+
+# Number of threads refreshing entries
+WORKERS = 2
+# Maximum number of entries waiting to be refreshed, more refreshes are skipped
+MAX_QUEUED = 100
+# Refreshing an entry is not attempted again for this many seconds after it has failed
+RETRY_DELAY = 60*60
+
+_lock = Lock()
+_queue: Queue[tuple[str, Callable[[], None]]] = Queue(MAX_QUEUED)
+_queued: set[str] = set()  # keys waiting to be refreshed or being refreshed
+_failed: dict[str, float] = {}  # time of last failed refresh, by key
+_workers_pid: int | None = None  # process the workers were started in, they do not survive fork()
+
+# Statistics, exported as metrics by prometheus.py
+started: int = 0
+skipped: int = 0
+failed: int = 0
+
+
+def queued() -> int:
+    return len(_queued)
+
+
+def _worker() -> None:
+    global failed
+
+    while True:
+        key, function = _queue.get()
+        try:
+            function()
+        except Exception:
+            log.exception('Failed to refresh cache entry: %s', key)
+            with _lock:
+                now = time.monotonic()
+                for failed_key, failed_time in list(_failed.items()):
+                    if now - failed_time > RETRY_DELAY:
+                        del _failed[failed_key]
+                _failed[key] = now
+                failed += 1
+        finally:
+            with _lock:
+                _queued.remove(key)
+
+
+def start(key: str, function: Callable[[], None]) -> None:
+    """
+    Refresh an expired cache entry in the background. Does nothing if the entry is already being
+    refreshed, failed to refresh recently, or too many entries are waiting to be refreshed.
+    Args:
+        key: Cache key, only one refresh is queued for each key
+        function: Function fetching the data again and storing it in the cache
+    """
+    global started, skipped, _workers_pid
+
+    if settings.offline_mode:
+        return
+
+    with _lock:
+        if key in _queued:
+            return
+        failed_time = _failed.get(key)
+        if failed_time is not None and time.monotonic() - failed_time < RETRY_DELAY:
+            return
+        try:
+            _queue.put_nowait((key, function))
+        except Full:
+            log.info('Not refreshing, too many cache entries are being refreshed: %s', key)
+            skipped += 1
+            return
+        _queued.add(key)
+        started += 1
+
+        if _workers_pid != os.getpid():
+            _workers_pid = os.getpid()
+            for _i in range(WORKERS):
+                Thread(target=_worker, daemon=True, name='refresh').start()
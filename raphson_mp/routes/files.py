@@ -1,3 +1,4 @@
+import mimetypes
 from pathlib import Path
 from typing import cast
 from urllib.parse import quote as urlencode
@@ -174,7 +175,11 @@ def route_download():
     with db.connect(read_only=True) as conn:
         auth.verify_auth_cookie(conn)
     path = music.from_relpath(request.args['path'])
-    return send_file(path, as_attachment=True)
+    response = util.send_offloaded(path, mimetypes.guess_type(path.name)[0] or 'application/octet-stream')
+    if response is None:
+        return send_file(path, as_attachment=True)
+    response.headers['Content-Disposition'] = util.content_disposition(path.name)
+    return response
 
 
 @bp.route('/download_zip')
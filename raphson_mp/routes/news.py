@@ -1,28 +1,34 @@
+import hashlib
+import logging
 import shutil
-import subprocess
 import tempfile
+import time
+from threading import Lock
 
 import requests
-from flask import Blueprint, Response, abort
+from flask import Blueprint, Response, abort, request
 
-from raphson_mp import settings
+from raphson_mp import cache, jobs, settings
 
+log = logging.getLogger(__name__)
 bp = Blueprint('news', __name__, url_prefix='/news')
 
+# All players request news at the same moment, on the hour. The news server is asked for a new
+# version at most once in this many seconds, other requests are served the audio in memory.
+CHECK_INTERVAL = 30
 
-@bp.route('/audio')
-def audio():
-    with tempfile.NamedTemporaryFile() as temp_input, tempfile.NamedTemporaryFile() as temp_output:
+# Held while checking for and transcoding a new version, so concurrent requests share its result
+_lock = Lock()
+_audio: bytes | None = None
+_etag: str | None = None  # Our ETag for _audio
+_upstream_headers: dict[str, str] = {}  # Validators of the news server version of _audio
+_checked: float = 0
 
-        # Download wave audio to temp file
-        with requests.get(settings.news_server + '/news.wav', timeout=10, stream=True) as response:
-            # News is only kept in temporary storage, if the news service has just
-            # started it won't have news cached yet.
-            if response.status_code == 503:
-                abort(503)
 
-            response.raise_for_status()
-            shutil.copyfileobj(response.raw, temp_input)
+def _transcode(response: requests.Response) -> bytes:
+    with tempfile.NamedTemporaryFile() as temp_input, tempfile.NamedTemporaryFile() as temp_output:
+        # Download wave audio to temp file
+        shutil.copyfileobj(response.raw, temp_input)
 
         # Transcode wave PCM audio to opus
         command = ['ffmpeg',
@@ -38,7 +44,69 @@ def audio():
                    '-filter:a', settings.loudnorm_filter,
                    temp_output.name]
 
-        subprocess.check_call(command, shell=False)
-        audio_bytes = temp_output.read()
+        jobs.run(command, jobs.Priority.INTERACTIVE, 'news')
+        return temp_output.read()
+
+
+def _news_audio() -> tuple[bytes, str]:
+    """
+    Returns: Transcoded news audio and its ETag, from memory or the cache if the news server has
+    not published a new version.
+    """
+    global _audio, _etag, _upstream_headers, _checked
+
+    with _lock:
+        if _audio is not None and time.monotonic() - _checked < CHECK_INTERVAL:
+            return _audio, _etag
 
-    return Response(audio_bytes, mimetype='audio/webm')
+        # Conditional request, the news server does not send the audio if it has not changed
+        request_headers: dict[str, str] = {}
+        if _audio is not None:
+            if 'ETag' in _upstream_headers:
+                request_headers['If-None-Match'] = _upstream_headers['ETag']
+            if 'Last-Modified' in _upstream_headers:
+                request_headers['If-Modified-Since'] = _upstream_headers['Last-Modified']
+
+        with requests.get(settings.news_server + '/news.wav', headers=request_headers, timeout=10, stream=True) as response:
+            # News is only kept in temporary storage, if the news service has just
+            # started it won't have news cached yet.
+            if response.status_code == 503:
+                abort(503)
+
+            if response.status_code == 304:
+                assert _audio is not None
+                _checked = time.monotonic()
+                return _audio, _etag
+
+            response.raise_for_status()
+
+            upstream_headers = {name: response.headers[name] for name in ('ETag', 'Last-Modified')
+                                if name in response.headers}
+            if not upstream_headers:
+                log.warning('News server does not send ETag or Last-Modified, news audio is transcoded again every %s seconds',
+                            CHECK_INTERVAL)
+                audio = _transcode(response)
+            else:
+                # Other worker processes may have transcoded this version already
+                cache_key = 'news' + ''.join(upstream_headers.values())
+                with cache.Lock(cache_key):
+                    audio = cache.retrieve(cache_key, return_expired=False)
+                    if audio is None:
+                        log.info('Transcoding new news audio: %s', upstream_headers)
+                        audio = _transcode(response)
+                        cache.store(cache_key, audio, cache.DAY)
+
+        _audio = audio
+        _etag = hashlib.sha256(audio).hexdigest()[:32]
+        _upstream_headers = upstream_headers
+        _checked = time.monotonic()
+        return _audio, _etag
+
+
+@bp.route('/audio')
+def audio():
+    audio_bytes, etag = _news_audio()
+    response = Response(audio_bytes, mimetype='audio/webm')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # always revalidate cache
+    return response.make_conditional(request)
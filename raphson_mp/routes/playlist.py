@@ -6,8 +6,8 @@ from typing import cast
 from flask import (Blueprint, Response, abort, redirect, render_template,
                    request)
 
-from raphson_mp import (auth, db, jsonw, metadata, music, scanner, settings,
-                        spotify, util)
+from raphson_mp import (auth, db, jsonw, metadata, music, prefetch, scanner,
+                        settings, spotify, util)
 from raphson_mp.metadata import normalize_title
 from raphson_mp.spotify import SpotifyTrack
 
@@ -182,6 +182,9 @@ def route_track(playlist):
         if chosen_track is None:
             return Response('no track found', 404, content_type='text/plain')
 
+        # The music player will request audio for this track soon
+        prefetch.start(chosen_track.relpath, user.user_id)
+
         return chosen_track.info_dict()
 
 
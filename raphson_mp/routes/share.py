@@ -1,3 +1,4 @@
+import mimetypes
 import os
 import time
 from base64 import b32encode
@@ -6,7 +7,7 @@ from sqlite3 import Connection
 from flask import (Blueprint, Response, abort, render_template, request,
                    send_file)
 
-from raphson_mp import auth, db, jsonw
+from raphson_mp import auth, db, jobs, jsonw, util
 from raphson_mp.image import QUALITY_HIGH, ImageFormat
 from raphson_mp.lyrics import PlainLyrics, TimeSyncedLyrics
 from raphson_mp.music import AudioType, Track
@@ -75,9 +76,9 @@ def audio(code: str):
     """
     with db.connect(read_only=True) as conn:
         track = track_by_code(conn, code)
-        audio_bytes = track.transcoded_audio(AudioType.WEBM_OPUS_HIGH)
+        audio_path = track.transcoded_audio(AudioType.WEBM_OPUS_HIGH)
 
-    return Response(audio_bytes, content_type='audio/webm')
+    return util.send_ranged_file(audio_path, 'audio/webm', etag=audio_path.name)
 
 
 @bp.route('/<code>/download/<file_format>')
@@ -89,13 +90,15 @@ def download(code: str, file_format: str):
         track = track_by_code(conn, code)
 
         if file_format == 'original':
-            response = send_file(track.path)
-            response.headers['Content-Disposition'] = f'attachment; filename="{track.path.name}"'
+            response = util.send_offloaded(track.path, mimetypes.guess_type(track.path.name)[0] or 'application/octet-stream')
+            if response is None:
+                response = send_file(track.path)
+            response.headers['Content-Disposition'] = util.content_disposition(track.path.name)
         elif file_format == 'mp3':
-            audio_bytes = track.transcoded_audio(AudioType.MP3_WITH_METADATA)
-            response = Response(audio_bytes, content_type='audio/mp3')
+            mp3_tag, mp3_audio = track.mp3_with_metadata(jobs.Priority.EXPORT)
+            response = util.send_ranged_mp3(mp3_tag, mp3_audio)
             download_name = track.metadata().download_name() + '.mp3'
-            response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+            response.headers['Content-Disposition'] = util.content_disposition(download_name)
         else:
             abort(400, 'Invalid format')
 
@@ -1,13 +1,13 @@
 import logging
-import subprocess
 import time
-from tempfile import NamedTemporaryFile
+from pathlib import Path
 
-from flask import Blueprint, Response, abort, request, send_file
+from flask import Blueprint, Response, abort, request
 from flask.typing import TemplateContextProcessorCallable
 
-from raphson_mp import (acoustid, auth, db, image, jsonw, lyrics, music,
-                        musicbrainz, scanner, settings)
+from raphson_mp import (acoustid, auth, db, image, jobs, jsonw, lyrics, music,
+                        musicbrainz, prefetch, scanner, settings, util,
+                        warmup)
 from raphson_mp.image import ImageFormat
 from raphson_mp.lyrics import TimeSyncedLyrics
 from raphson_mp.music import AudioType, Track
@@ -37,20 +37,33 @@ def route_raw(path: str):
         if track is None:
             abort(404, 'track not found')
 
-        meta = track.metadata()
+        last_modified = track.mtime_dt
+        if request.if_modified_since and last_modified <= request.if_modified_since:
+            return Response(None, 304)
 
-        if meta.video == 'vp9':
-            output_format = 'webm'
-            output_media_type = 'video/webm'
-        elif meta.video == 'h264':
-            output_format = 'mp4'
-            output_media_type = 'video/mp4'
-        else:
+        try:
+            video, media_type = track.remuxed_video()
+        except ValueError:
             abort(400, 'file has no suitable video stream')
 
-        with NamedTemporaryFile() as tempfile:
-            subprocess.check_call(['ffmpeg', *settings.ffmpeg_flags(), '-y', '-i', track.path.as_posix(), '-c:v', 'copy', '-map', '0:v', '-f', output_format, tempfile.name], shell=False)
-            return send_file(tempfile.name, mimetype=output_media_type)
+    response = util.send_ranged_file(video, media_type, etag=video.name, last_modified=last_modified)
+    response.cache_control.no_cache = True  # always revalidate cache
+    return response
+
+
+def _audio_type(type_str: str) -> tuple[AudioType, str]:
+    """
+    Returns: Audio type and its media type, for the 'type' query parameter
+    """
+    if type_str == 'webm_opus_high':
+        return AudioType.WEBM_OPUS_HIGH, 'audio/webm'
+    if type_str == 'webm_opus_low':
+        return AudioType.WEBM_OPUS_LOW, 'audio/webm'
+    if type_str == 'mp4_aac':
+        return AudioType.MP4_AAC, 'audio/mp4'
+    if type_str == 'mp3_with_metadata':
+        return AudioType.MP3_WITH_METADATA, 'audio/mp3'
+    raise ValueError(type_str)
 
 
 @bp.route('/<path:path>/audio')
@@ -58,41 +71,95 @@ def route_audio(path: str):
     """
     Get transcoded audio for the given track path.
     """
+    audio_type, media_type = _audio_type(request.args['type'])
+
     with db.connect(read_only=True) as conn:
-        auth.verify_auth_cookie(conn)
+        user = auth.verify_auth_cookie(conn)
         track = Track.by_relpath(conn, path)
 
-    if track is None:
-        abort(404, 'Track does not exist')
+        if track is None:
+            abort(404, 'Track does not exist')
+
+        prefetch.record_audio_type(user.user_id, audio_type)
 
-    last_modified = track.mtime_dt
-    if request.if_modified_since and last_modified <= request.if_modified_since:
-        return Response(None, 304)
+        if audio_type == AudioType.MP3_WITH_METADATA:
+            # MP3 files are downloaded for use outside the music player, nobody is waiting to listen
+            mp3_tag, mp3_audio = track.mp3_with_metadata(jobs.Priority.EXPORT)
+            mp3_name = track.metadata().filename_title()
+        else:
+            # Transcoding uses the database connection, to get loudness
+            with warmup.interactive():
+                audio = track.transcoded_audio_stream(audio_type)
 
-    type_str = request.args['type']
-    if type_str == 'webm_opus_high':
-        audio_type = AudioType.WEBM_OPUS_HIGH
-        media_type = 'audio/webm'
-    elif type_str == 'webm_opus_low':
-        audio_type = AudioType.WEBM_OPUS_LOW
-        media_type = 'audio/webm'
-    elif type_str == 'mp4_aac':
-        audio_type = AudioType.MP4_AAC
-        media_type = 'audio/mp4'
-    elif type_str == 'mp3_with_metadata':
-        audio_type = AudioType.MP3_WITH_METADATA
-        media_type = 'audio/mp3'
+    # Audio changes without the track being modified, for example once loudness has been measured,
+    # so the track modification time is not used. Responses are revalidated using the content hash.
+    if audio_type == AudioType.MP3_WITH_METADATA:
+        response = util.send_ranged_mp3(mp3_tag, mp3_audio)
+        response.headers['Content-Disposition'] = util.content_disposition(mp3_name)
+    elif isinstance(audio, Path):
+        # Cached audio files are named after a hash of their contents
+        response = util.send_ranged_file(audio, media_type, etag=audio.name)
     else:
-        raise ValueError(type_str)
+        # Audio is still being transcoded, length is not known yet so range requests are not possible
+        response = Response(audio, content_type=media_type, direct_passthrough=True)
+    response.cache_control.no_cache = True  # always revalidate cache
+    return response
 
-    audio = track.transcoded_audio(audio_type)
-    response = Response(audio, content_type=media_type)
-    response.last_modified = last_modified
+
+@bp.route('/<path:path>/segments')
+def route_segments(path: str):
+    """
+    Get manifest for segmented playback, listing the segments available from route_segment()
+    """
+    audio_type, media_type = _audio_type(request.args['type'])
+    if audio_type not in music.SEGMENTED_AUDIO_TYPES:
+        abort(400, 'Audio type is not available in segments')
+
+    with db.connect(read_only=True) as conn:
+        user = auth.verify_auth_cookie(conn)
+        track = Track.by_relpath(conn, path)
+
+        if track is None:
+            abort(404, 'Track does not exist')
+
+        prefetch.record_audio_type(user.user_id, audio_type)
+
+        codec = 'mp4a.40.2' if audio_type == AudioType.MP4_AAC else 'opus'
+        return jsonw.json_response({'mime': f'{media_type}; codecs="{codec}"',
+                                    'duration': min(track.metadata().duration, settings.track_max_duration_seconds),
+                                    'segment_duration': music.SEGMENT_DURATION,
+                                    'segment_count': track.segment_count()},
+                                   last_modified=track.mtime)
+
+
+@bp.route('/<path:path>/segment')
+def route_segment(path: str):
+    """
+    Get a single segment of transcoded audio, see Track.transcoded_segment()
+    """
+    audio_type, media_type = _audio_type(request.args['type'])
+    if audio_type not in music.SEGMENTED_AUDIO_TYPES:
+        abort(400, 'Audio type is not available in segments')
+    index = request.args.get('index', type=int)
+    if index is None:
+        abort(400, 'Invalid segment index')
+
+    with db.connect(read_only=True) as conn:
+        auth.verify_auth_cookie(conn)
+        track = Track.by_relpath(conn, path)
+
+        if track is None:
+            abort(404, 'Track does not exist')
+
+        if not 0 <= index < track.segment_count():
+            abort(404, 'Segment does not exist')
+
+        with warmup.interactive():
+            segment = track.transcoded_segment(audio_type, index)
+
+    # Like route_audio(), revalidated using the content hash only
+    response = util.send_ranged_file(segment, media_type, etag=segment.name)
     response.cache_control.no_cache = True  # always revalidate cache
-    response.accept_ranges = 'bytes'  # Workaround for Chromium bug https://stackoverflow.com/a/65804889
-    if audio_type == AudioType.MP3_WITH_METADATA:
-        mp3_name = track.metadata().filename_title()
-        response.headers['Content-Disposition'] = f'attachment; filename="{mp3_name}"'
     return response
 
 
@@ -120,6 +187,13 @@ def route_album_cover(path: str) -> Response:
         if request.if_modified_since and last_modified <= request.if_modified_since:
             return Response(None, 304)
 
+        # Large covers are stored as a file in the cache, which the reverse proxy can send
+        cover_path = track.get_cover_file(meme, quality, ImageFormat.WEBP) if settings.proxy_offload else None
+        response = util.send_offloaded(cover_path, 'image/webp', last_modified=last_modified) if cover_path else None
+        if response is not None:
+            response.cache_control.no_cache = True  # always revalidate cache
+            return response
+
         image_bytes = track.get_cover(meme, quality, ImageFormat.WEBP)
 
     response = Response(image_bytes, content_type='image/webp')
@@ -175,7 +249,7 @@ def route_update_metadata(path: str):
     track.write_metadata(meta)
 
     with db.connect() as conn:
-        scanner.scan_track(conn, track.playlist, track.path, track.relpath)
+        scanner.scan_track(conn, track.playlist, track.path, track.relpath, meta)
 
     return Response(None, 200)
 
@@ -1,6 +1,6 @@
 from flask import Blueprint, Response, abort, request
 
-from raphson_mp import auth, db, image, jsonw, lyrics, settings
+from raphson_mp import auth, db, image, jsonw, lyrics, settings, util
 from raphson_mp.image import ImageFormat
 from raphson_mp.lyrics import PlainLyrics
 from raphson_mp.music import Track
@@ -16,19 +16,37 @@ def route_info(path: str):
         return track.info_dict()
 
 
+def _send_content(path: str, column: str, mimetype: str) -> Response:
+    """
+    Send audio or cover downloaded by offline sync, streamed from the content table
+    """
+    with db.connect(read_only=True) as conn:
+        track = Track.by_relpath(conn, path)
+        if track is None:
+            abort(404, 'track not found')
+
+    with db.offline(read_only=True) as conn:
+        row = conn.execute(f'SELECT rowid, length({column}) FROM content WHERE path=?', (path,)).fetchone()
+        if row is None:
+            abort(404, 'track not downloaded')
+        rowid, length = row
+
+    read = util.blob_reader(lambda: db.offline(read_only=True), 'content', column, rowid)
+    # Content is replaced by offline sync when the track modification time has changed
+    response = util.send_ranged(read, length, mimetype, etag=f'{track.mtime}-{length}', last_modified=track.mtime_dt)
+    response.cache_control.no_cache = True  # always revalidate cache
+    return response
+
+
 @bp.route('/<path:path>/audio')
 def route_audio(path: str):
-    with db.offline(read_only=True) as conn:
-        music_data: bytes = conn.execute('SELECT music_data FROM content WHERE path=?', (path,)).fetchone()[0]
-        return Response(music_data, content_type='audio/webm')
+    return _send_content(path, 'music_data', 'audio/webm')
 
 
 @bp.route('/<path:path>/cover')
 def route_album_cover(path: str) -> Response:
     if settings.offline_mode:
-        with db.offline(read_only=True) as conn:
-            cover_data: bytes = conn.execute('SELECT cover_data FROM content WHERE path=?', (path,)).fetchone()[0]
-            return Response(cover_data, content_type='image/webp')
+        return _send_content(path, 'cover_data', 'image/webp')
 
     meme = 'meme' in request.args and bool(int(request.args['meme']))
 
@@ -1,11 +1,11 @@
 import logging
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from datetime import datetime, timezone
 from pathlib import Path
 from sqlite3 import Connection
 
-from raphson_mp import db, metadata, music, settings
+from raphson_mp import db, jobs, metadata, music, settings
 
 log = logging.getLogger(__name__)
 
@@ -37,21 +37,66 @@ def scan_playlists(conn: Connection) -> set[str]:
 
 @dataclass
 class QueryParams:
-    main_data: dict[str, str|int|None]
+    main_data: dict[str, str|int|float|None]
     artist_data: list[dict[str, str]]
     tag_data: list[dict[str, str]]
 
 
-def query_params(relpath: str, path: Path) -> QueryParams | None:
+def _loudness_params(loudness: metadata.Loudness | None) -> dict[str, float | None]:
+    if loudness is None:
+        return {'loudness_i': None, 'loudness_tp': None, 'loudness_lra': None,
+                'loudness_thresh': None, 'loudness_offset': None}
+    return {'loudness_i': loudness.integrated,
+            'loudness_tp': loudness.true_peak,
+            'loudness_lra': loudness.lra,
+            'loudness_thresh': loudness.threshold,
+            'loudness_offset': loudness.offset}
+
+
+def _known_loudness(conn: Connection, relpath: str, audio_hash: str | None) -> metadata.Loudness | None:
+    """
+    Returns: Loudness stored in the database, if it was measured for the same audio data
+    """
+    if audio_hash is None:
+        return None
+    row = conn.execute('''
+                       SELECT loudness_i, loudness_tp, loudness_lra, loudness_thresh, loudness_offset
+                       FROM track WHERE path=? AND audio_hash=? AND loudness_i IS NOT NULL
+                       ''', (relpath, audio_hash)).fetchone()
+    if row is None:
+        return None
+    return metadata.Loudness(*row)
+
+
+def query_params(conn: Connection, relpath: str, path: Path,
+                 meta: metadata.Metadata | None = None) -> QueryParams | None:
     """
     Create dictionary of track metadata, to be used as SQL query parameters
+    Args:
+        meta: Metadata that was just written to the file. Only tags have changed, so the file is not
+              probed again and the duration and audio properties are reused.
     """
-    meta = metadata.probe(path)
+    if meta is None:
+        meta = metadata.probe(path)
 
-    if not meta:
-        return None
+        if not meta:
+            return None
 
-    main_data: dict[str, str|int|None] = {'path': relpath,
+        audio_hash = metadata.audio_hash(path, jobs.Priority.INTERACTIVE)
+    else:
+        audio_codec, audio_bit_rate, audio_channels, audio_hash = conn.execute('''
+            SELECT audio_codec, audio_bit_rate, audio_channels, audio_hash FROM track WHERE path=?
+            ''', (relpath,)).fetchone()
+        meta = replace(meta,
+                       audio_codec=audio_codec,
+                       audio_bit_rate=audio_bit_rate,
+                       audio_channels=audio_channels)
+
+    # When only metadata has changed, there is no need to measure loudness again. Otherwise,
+    # loudness is measured in the background by measure_loudness().
+    loudness = _known_loudness(conn, relpath, audio_hash)
+
+    main_data: dict[str, str|int|float|None] = {'path': relpath,
                                           'duration': meta.duration,
                                           'title': meta.title,
                                           'album': meta.album,
@@ -59,7 +104,12 @@ def query_params(relpath: str, path: Path) -> QueryParams | None:
                                           'track_number': meta.track_number,
                                           'year': meta.year,
                                           'lyrics': meta.lyrics,
-                                          'video': meta.video}
+                                          'video': meta.video,
+                                          'audio_codec': meta.audio_codec,
+                                          'audio_bit_rate': meta.audio_bit_rate,
+                                          'audio_channels': meta.audio_channels,
+                                          'audio_hash': audio_hash,
+                                          **_loudness_params(loudness)}
     if meta.artists is None:
         artist_data = []
     else:
@@ -71,9 +121,12 @@ def query_params(relpath: str, path: Path) -> QueryParams | None:
     return QueryParams(main_data, artist_data, tag_data)
 
 
-def scan_track(conn: Connection, playlist_name: str, track_path: Path, track_relpath: str) -> bool:
+def scan_track(conn: Connection, playlist_name: str, track_path: Path, track_relpath: str,
+               meta: metadata.Metadata | None = None) -> bool:
     """
     Scan single track.
+    Args:
+        meta: Metadata that was just written to the file, see query_params()
     Returns: Whether track exists (False if deleted)
     """
     if not track_path.exists():
@@ -92,13 +145,17 @@ def scan_track(conn: Connection, playlist_name: str, track_path: Path, track_rel
     # Track does not yet exist in database
     if db_mtime is None:
         log.info('New track, insert: %s', track_relpath)
-        params = query_params(track_relpath, track_path)
+        params = query_params(conn, track_relpath, track_path)
         if not params:
             log.warning('Skipping due to metadata error')
             return False
         conn.execute('''
-                     INSERT INTO track (path, playlist, duration, title, album, album_artist, track_number, year, lyrics, video, mtime)
-                     VALUES (:path, :playlist, :duration, :title, :album, :album_artist, :track_number, :year, :lyrics, :video, :mtime)
+                     INSERT INTO track (path, playlist, duration, title, album, album_artist, track_number, year, lyrics, video,
+                                        audio_codec, audio_bit_rate, audio_channels, audio_hash,
+                                        loudness_i, loudness_tp, loudness_lra, loudness_thresh, loudness_offset, mtime)
+                     VALUES (:path, :playlist, :duration, :title, :album, :album_artist, :track_number, :year, :lyrics, :video,
+                             :audio_codec, :audio_bit_rate, :audio_channels, :audio_hash,
+                             :loudness_i, :loudness_tp, :loudness_lra, :loudness_thresh, :loudness_offset, :mtime)
                      ''',
                      {**params.main_data,
                       'playlist': playlist_name,
@@ -110,11 +167,12 @@ def scan_track(conn: Connection, playlist_name: str, track_path: Path, track_rel
                      INSERT INTO scanner_log (timestamp, action, playlist, track)
                      VALUES (?, 'insert', ?, ?)
                      ''', (int(time.time()), playlist_name, track_relpath))
+
         return True
 
     if file_mtime != db_mtime:
         log.info('Changed, update: %s (%s to %s)', track_relpath, datetime.fromtimestamp(db_mtime, tz=timezone.utc), datetime.fromtimestamp(file_mtime, tz=timezone.utc))
-        params = query_params(track_relpath, track_path)
+        params = query_params(conn, track_relpath, track_path, meta)
         if not params:
             log.warning('Metadata error, delete track from database')
             conn.execute('DELETE FROM track WHERE path=?', (track_relpath,))
@@ -129,6 +187,17 @@ def scan_track(conn: Connection, playlist_name: str, track_path: Path, track_rel
                             year=:year,
                             lyrics=:lyrics,
                             video=:video,
+                            audio_codec=:audio_codec,
+                            audio_bit_rate=:audio_bit_rate,
+                            audio_channels=:audio_channels,
+                            audio_hash=:audio_hash,
+                            loudness_i=:loudness_i,
+                            loudness_tp=:loudness_tp,
+                            loudness_lra=:loudness_lra,
+                            loudness_thresh=:loudness_thresh,
+                            loudness_offset=:loudness_offset,
+                            loudness_failed=0,
+                            audio_hash_failed=0,
                             mtime=:mtime
                         WHERE path=:path
                     ''',
@@ -143,12 +212,77 @@ def scan_track(conn: Connection, playlist_name: str, track_path: Path, track_rel
                      INSERT INTO scanner_log (timestamp, action, playlist, track)
                      VALUES (?, 'update', ?, ?)
                      ''', (int(time.time()), playlist_name, track_relpath))
+
         return True
 
     # Track exists in filesystem and is unchanged
     return True
 
 
+def unhashed_tracks(conn: Connection) -> list[tuple[str, int]]:
+    """
+    Returns: Path and mtime of tracks of which the audio stream has not been hashed yet
+    """
+    return conn.execute('''
+                        SELECT path, mtime FROM track
+                        WHERE audio_hash IS NULL AND audio_hash_failed = 0
+                        ''').fetchall()
+
+
+def hash_audio(relpath: str, mtime: int) -> None:
+    """
+    Hash the audio stream of a track scanned before the audio hash was stored, or for which hashing
+    failed during the scan. Runs at warm-up priority, because the entire file is read. If ffmpeg
+    fails, this is recorded so hashing is not retried until the file changes.
+    Args:
+        relpath: Track path
+        mtime: Modification time of the track when it was scanned, see measure_loudness()
+    """
+    audio_hash = metadata.audio_hash(music.from_relpath(relpath), jobs.Priority.WARMUP)
+    with db.connect() as conn:
+        if audio_hash is None:
+            conn.execute('UPDATE track SET audio_hash_failed=1 WHERE path=? AND mtime=?', (relpath, mtime))
+            return
+        conn.execute('UPDATE track SET audio_hash=? WHERE path=? AND mtime=?', (audio_hash, relpath, mtime))
+
+
+def unmeasured_tracks(conn: Connection) -> list[tuple[str, int]]:
+    """
+    Returns: Path and mtime of tracks of which loudness has not been measured yet
+    """
+    return conn.execute('''
+                        SELECT path, mtime FROM track
+                        WHERE loudness_i IS NULL AND loudness_failed = 0
+                        ''').fetchall()
+
+
+def measure_loudness(relpath: str, mtime: int) -> None:
+    """
+    Measure loudness of a track, for new tracks and tracks scanned before loudness was measured.
+    Loudness is measured at warm-up priority, outside of the scanner, because it requires decoding
+    the entire file. If the measurement fails, this is recorded so it is not retried until the
+    file changes.
+    Args:
+        relpath: Track path
+        mtime: Modification time of the track when it was scanned. The result is discarded if the
+               track has been changed since.
+    """
+    loudness = metadata.measure_loudness(music.from_relpath(relpath), jobs.Priority.WARMUP)
+    with db.connect() as conn:
+        if loudness is None:
+            conn.execute('UPDATE track SET loudness_failed=1 WHERE path=? AND mtime=?', (relpath, mtime))
+            return
+        conn.execute('''
+                     UPDATE track
+                     SET loudness_i=:loudness_i,
+                         loudness_tp=:loudness_tp,
+                         loudness_lra=:loudness_lra,
+                         loudness_thresh=:loudness_thresh,
+                         loudness_offset=:loudness_offset
+                     WHERE path=:path AND mtime=:mtime
+                     ''', {**_loudness_params(loudness), 'path': relpath, 'mtime': mtime})
+
+
 def scan_tracks(conn: Connection, playlist_name: str) -> None:
     """
     Scan for added, removed or changed tracks in a playlist.
@@ -160,11 +294,14 @@ def scan_tracks(conn: Connection, playlist_name: str) -> None:
                                         (playlist_name,)).fetchall():
         if scan_track(conn, playlist_name, music.from_relpath(track_relpath), track_relpath):
             paths_db.add(track_relpath)
+        # Probing and hashing new tracks is slow, don't keep the database locked for the entire scan
+        conn.commit()
 
     for track_path in music.list_tracks_recursively(music.from_relpath(playlist_name)):
         track_relpath = music.to_relpath(track_path)
         if track_relpath not in paths_db:
             scan_track(conn, playlist_name, track_path, track_relpath)
+            conn.commit()
 
 
 def last_change(conn: Connection, playlist: str | None = None):
@@ -13,7 +13,9 @@ raphson_png = static_dir / 'img' / 'raphson.png'
 user_agent = 'Super-fancy-music-player/2.0 (https://github.com/DanielKoomen/WebApp/)'
 user_agent_offline_sync = 'Super fancy music player (offline sync) (https://github.com/DanielKoomen/WebApp/)'
 webscraping_user_agent = getenv('MUSIC_WEBSCRAPING_USER_AGENT', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/114.0')  # https://useragents.me
-loudnorm_filter = 'loudnorm=I=-16'
+loudness_target_i = -16  # LUFS
+loudness_target_tp = -2  # dBTP, loudnorm default
+loudnorm_filter = f'loudnorm=I={loudness_target_i}'
 
 # User configurable settings
 music_dir: Path = None
@@ -27,6 +29,15 @@ spotify_api_id: str | None = None
 spotify_api_secret: str | None = None
 offline_mode: bool = None
 news_server: str = None
+transcode_streaming: bool = None
+normalization_mode: str = None
+max_jobs: int | None = None
+warmup: bool = None
+warmup_workers: int | None = None
+scan_video: bool = None
+proxy_offload: str | None = None
+cache_memory_mb: int = 0
+cache_max_gb: int = 0
 
 def ffmpeg_flags():
     return ['-hide_banner', '-nostats', '-loglevel', ffmpeg_log_level]
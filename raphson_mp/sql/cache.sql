@@ -3,7 +3,10 @@ BEGIN;
 CREATE TABLE cache (
     key TEXT NOT NULL UNIQUE PRIMARY KEY,
     data BLOB NOT NULL,
-    expire_time INTEGER NOT NULL
+    expire_time INTEGER NOT NULL,
+    external TEXT NULL, -- sha256 hex digest of file in cache directory, if data is stored externally
+    size INTEGER NOT NULL DEFAULT 0, -- size of data or external file in bytes
+    last_access INTEGER NOT NULL DEFAULT 0 -- approximate time of last retrieval, in seconds since UNIX epoch
 ) STRICT; -- STRICT mode only for new databases since 2024-08-24, no migration exists for old databases as it would be too expensive
 
 CREATE INDEX idx_cache_expire_time ON cache(expire_time);
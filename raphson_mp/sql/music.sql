@@ -16,7 +16,18 @@ CREATE TABLE track (
     mtime INTEGER NOT NULL,
     last_chosen INTEGER NOT NULL DEFAULT 0,
     lyrics TEXT NULL,
-    video TEXT NULL
+    video TEXT NULL,
+    audio_codec TEXT NULL, -- codec of first audio stream, as reported by ffprobe
+    audio_bit_rate INTEGER NULL,
+    audio_channels INTEGER NULL,
+    audio_hash TEXT NULL, -- sha256 of audio stream data, excluding metadata
+    loudness_i REAL NULL, -- measured by loudnorm filter, NULL if not measured yet
+    loudness_tp REAL NULL,
+    loudness_lra REAL NULL,
+    loudness_thresh REAL NULL,
+    loudness_offset REAL NULL,
+    loudness_failed INTEGER NOT NULL DEFAULT 0, -- 1 if ffmpeg failed to measure loudness
+    audio_hash_failed INTEGER NOT NULL DEFAULT 0 -- 1 if ffmpeg failed to hash the audio stream
 ) STRICT;
 
 CREATE INDEX idx_track_playlist ON track(playlist);
@@ -119,6 +130,22 @@ CREATE TABLE scanner_log (
 
 CREATE INDEX idx_scanner_log_timestamp ON scanner_log(timestamp);
 
+CREATE TABLE transcode (
+    id INTEGER NOT NULL UNIQUE PRIMARY KEY AUTOINCREMENT,
+    timestamp INTEGER NOT NULL, -- Seconds since UNIX epoch
+    kind TEXT NOT NULL, -- Output format (audio type name), or other purpose like 'thumbnail'
+    priority TEXT NOT NULL,
+    track TEXT NULL, -- Intentionally not a foreign key, log may contain deleted tracks
+    wall_time REAL NOT NULL, -- Seconds
+    user_time REAL NOT NULL, -- Seconds
+    system_time REAL NOT NULL, -- Seconds
+    input_bytes INTEGER NOT NULL,
+    output_bytes INTEGER NOT NULL,
+    returncode INTEGER NOT NULL
+) STRICT;
+
+CREATE INDEX idx_transcode_timestamp ON transcode(timestamp);
+
 CREATE TABLE dislikes (
     user INTEGER NOT NULL REFERENCES user(id) ON DELETE CASCADE,
     track TEXT NOT NULL REFERENCES track(path) ON DELETE CASCADE,
@@ -425,9 +425,19 @@ class Track {
     /**
      * @param {string} audioType
      * @param {boolean} stream
+     * @param {boolean} segmented Fetch audio in segments while it is played, if supported by the browser
      * @returns {Promise<string>} URL
      */
-    async getAudio(audioType, stream) {
+    async getAudio(audioType, stream, segmented=false) {
+        if (segmented) {
+            const segmentedAudio = await SegmentedAudio.create(this.path, audioType);
+            if (segmentedAudio) {
+                return segmentedAudio.url;
+            }
+            console.debug('track: segmented playback not supported, streaming instead');
+            stream = true;
+        }
+
         const audioUrl = `/track/${encodeURIComponent(this.path)}/audio?type=${audioType}`;
         if (stream) {
             return audioUrl;
@@ -487,12 +497,13 @@ class Track {
      * @param {string} audioType
      * @param {boolean} stream
      * @param {boolean} memeCover
+     * @param {boolean} segmented
      * @returns {Promise<DownloadedTrack>}
      */
-    async download(audioType='webm_opus_high', stream=false, memeCover=false) {
+    async download(audioType='webm_opus_high', stream=false, memeCover=false, segmented=false) {
         // Download audio, cover, lyrics in parallel
         const promises = [
-            this.getAudio(audioType, stream),
+            this.getAudio(audioType, stream, segmented),
             this.getCover(audioType == 'webm_opus_low' ? 'low' : 'high', stream, memeCover),
             this.getLyrics(),
         ];
@@ -596,6 +607,147 @@ class DownloadedTrack {
     }
 }
 
+/**
+ * Audio played using Media Source Extensions, from segments that are downloaded while the audio is
+ * played. Playback can start as soon as the first segment is available, and after seeking only the
+ * segments around the new position are downloaded.
+ */
+class SegmentedAudio {
+    /** Seconds of audio to download ahead of the playback position */
+    static BUFFER_AHEAD = 30;
+
+    /** @type {string} */
+    #segmentUrl;
+    /** @type {object} */
+    #manifest;
+    /** @type {MediaSource} */
+    #mediaSource;
+    /** @type {string} Object URL, to be used as source of an audio element */
+    url;
+
+    /**
+     * @param {string} segmentUrl
+     * @param {object} manifest
+     */
+    constructor(segmentUrl, manifest) {
+        this.#segmentUrl = segmentUrl;
+        this.#manifest = manifest;
+        this.#mediaSource = new MediaSource();
+        this.url = URL.createObjectURL(this.#mediaSource);
+        // Fired when the object URL is used as source of a media element
+        this.#mediaSource.addEventListener('sourceopen', () => this.#load(), {once: true});
+    }
+
+    /**
+     * @param {string} path
+     * @param {string} audioType
+     * @returns {Promise<SegmentedAudio|null>} Null if the browser does not support segmented playback
+     */
+    static async create(path, audioType) {
+        if (!window.MediaSource) {
+            return null;
+        }
+        const trackUrl = `/track/${encodeURIComponent(path)}`;
+        const response = await fetch(`${trackUrl}/segments?type=${audioType}`);
+        checkResponseCode(response);
+        const manifest = await response.json();
+        if (!MediaSource.isTypeSupported(manifest.mime)) {
+            return null;
+        }
+        return new SegmentedAudio(`${trackUrl}/segment?type=${audioType}`, manifest);
+    }
+
+    /**
+     * @returns {HTMLMediaElement|null} Media element playing this audio
+     */
+    #findMediaElement() {
+        for (const elem of document.querySelectorAll('audio, video')) {
+            if (elem.src == this.url) {
+                return elem;
+            }
+        }
+        return null;
+    }
+
+    /**
+     * @param {SourceBuffer} sourceBuffer
+     * @param {number} index
+     * @returns {boolean}
+     */
+    #isBuffered(sourceBuffer, index) {
+        const start = index * this.#manifest.segment_duration;
+        const end = Math.min(start + this.#manifest.segment_duration, this.#manifest.duration);
+        const middle = (start + end) / 2;
+        for (let i = 0; i < sourceBuffer.buffered.length; i++) {
+            if (sourceBuffer.buffered.start(i) <= middle && middle < sourceBuffer.buffered.end(i)) {
+                return true;
+            }
+        }
+        return false;
+    }
+
+    /**
+     * @param {number} position Playback position in seconds
+     * @param {SourceBuffer} sourceBuffer
+     * @returns {number|null} Index of the first segment needed soon that is not buffered
+     */
+    #nextSegment(position, sourceBuffer) {
+        const segmentDuration = this.#manifest.segment_duration;
+        for (let index = Math.floor(position / segmentDuration);
+                index < this.#manifest.segment_count && index * segmentDuration < position + SegmentedAudio.BUFFER_AHEAD;
+                index++) {
+            if (!this.#isBuffered(sourceBuffer, index)) {
+                return index;
+            }
+        }
+        return null;
+    }
+
+    async #load() {
+        const mediaElem = this.#findMediaElement();
+        this.#mediaSource.duration = this.#manifest.duration;
+        const sourceBuffer = this.#mediaSource.addSourceBuffer(this.#manifest.mime);
+
+        // Stops when the media element starts playing something else
+        while (this.#mediaSource.readyState != 'closed') {
+            const index = this.#nextSegment(mediaElem ? mediaElem.currentTime : 0, sourceBuffer);
+
+            if (index == null) {
+                if (mediaElem == null) {
+                    return;
+                }
+                // Wait for playback to continue, or for the user to seek
+                await new Promise(resolve => mediaElem.addEventListener('timeupdate', resolve, {once: true}));
+                continue;
+            }
+
+            const response = await fetch(`${this.#segmentUrl}&index=${index}`);
+            checkResponseCode(response);
+            const data = await response.arrayBuffer();
+            if (this.#mediaSource.readyState == 'closed') {
+                return;
+            }
+
+            // Segment timestamps start at zero
+            const start = index * this.#manifest.segment_duration;
+            sourceBuffer.timestampOffset = start;
+            // Drop encoder padding beyond the segment boundaries, so it doesn't overlap adjacent
+            // segments. The start must stay below the end, so the end is moved out of the way first.
+            sourceBuffer.appendWindowEnd = Infinity;
+            sourceBuffer.appendWindowStart = start;
+            sourceBuffer.appendWindowEnd = start + this.#manifest.segment_duration;
+            sourceBuffer.appendBuffer(data);
+            await new Promise(resolve => sourceBuffer.addEventListener('updateend', resolve, {once: true}));
+            console.debug('track: appended segment', index);
+
+            if (index == this.#manifest.segment_count - 1 && this.#mediaSource.readyState == 'open') {
+                // Required for the media element to fire the 'ended' event
+                this.#mediaSource.endOfStream();
+            }
+        }
+    }
+}
+
 class Lyrics {
     /** @type {string | null} */
     source;
@@ -48,9 +48,11 @@ function getTrackDownloadParams() {
         audioType = "mp4_aac";
     }
 
-    const stream = document.getElementById('settings-download-mode').value == 'stream';
+    const downloadMode = document.getElementById('settings-download-mode').value;
+    const stream = downloadMode == 'stream';
+    const segmented = downloadMode == 'segmented';
     const memeCover = document.getElementById('settings-meme-mode').checked;
-    return [audioType, stream, memeCover];
+    return [audioType, stream, memeCover, segmented];
 }
 
 document.addEventListener('DOMContentLoaded', () => {
@@ -0,0 +1,270 @@
+"""
+Native tag writers for the metadata editor. Tags are updated in place when they fit in the space
+of the existing tags and padding, otherwise the file is rewritten to a temporary file which is
+renamed over the original. Formats that are not supported here are written using ffmpeg, see
+Track.write_metadata().
+"""
+import logging
+import os
+import shutil
+import struct
+import tempfile
+from pathlib import Path
+
+from raphson_mp import id3
+
+log = logging.getLogger(__name__)
+
+# Padding added when a file needs to be rewritten, so following edits can be done in place
+PADDING = 4096
+
+
+class UnsupportedFileError(Exception):
+    """
+    File is not in a format or variant that can be written natively
+    """
+
+
+def _rewrite(path: Path, header: bytes, audio_offset: int) -> None:
+    """
+    Replace everything before audio_offset with header, by writing a temporary file in the same
+    directory and renaming it over the original file.
+    """
+    # The temporary file name does not have a music extension, so it is never picked up by the scanner
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix='.', suffix='.tmp', delete=False) as temp_file:
+        try:
+            temp_file.write(header)
+            with path.open('rb') as original:
+                original.seek(audio_offset)
+                shutil.copyfileobj(original, temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+            shutil.copymode(path, temp_file.name)
+            os.replace(temp_file.name, path)
+        except BaseException:
+            os.unlink(temp_file.name)
+            raise
+
+
+def _write_in_place(path: Path, offset: int, data: bytes) -> None:
+    with path.open('r+b') as file:
+        file.seek(offset)
+        file.write(data)
+
+
+# FLAC: https://xiph.org/flac/format.html
+
+_FLAC_STREAMINFO = 0
+_FLAC_PADDING = 1
+_FLAC_VORBIS_COMMENT = 4
+
+# ffmpeg metadata keys to Vorbis comment field names, and other field names ffmpeg reads as the
+# same key, which need to be removed when the value is replaced
+_VORBIS_FIELDS: dict[str, tuple[str, ...]] = {'album': ('ALBUM',),
+                                               'artist': ('ARTIST',),
+                                               'title': ('TITLE',),
+                                               'date': ('DATE', 'YEAR'),
+                                               'album_artist': ('ALBUMARTIST', 'ALBUM_ARTIST', 'ALBUM ARTIST'),
+                                               'track': ('TRACKNUMBER', 'TRACK'),
+                                               'lyrics': ('LYRICS', 'UNSYNCEDLYRICS'),
+                                               'genre': ('GENRE',)}
+
+
+def _flac_block(block_type: int, data: bytes, last: bool) -> bytes:
+    if len(data) >= 1 << 24:
+        raise UnsupportedFileError('metadata block too large')
+    return bytes((block_type | (0x80 if last else 0),)) + len(data).to_bytes(3, 'big') + data
+
+
+def _vorbis_comment(old_data: bytes | None, values: dict[str, str]) -> bytes:
+    """
+    Returns: Vorbis comment with the fields for the given values replaced, other fields are kept
+    """
+    replaced: set[str] = set()
+    for key in values:
+        replaced.update(_VORBIS_FIELDS[key])
+
+    vendor = b'raphson_mp'
+    comments: list[bytes] = []
+    if old_data is not None:
+        (vendor_length,) = struct.unpack_from('<I', old_data, 0)
+        vendor = old_data[4:4+vendor_length]
+        pos = 4 + vendor_length
+        (count,) = struct.unpack_from('<I', old_data, pos)
+        pos += 4
+        for _i in range(count):
+            (length,) = struct.unpack_from('<I', old_data, pos)
+            comment = old_data[pos+4:pos+4+length]
+            pos += 4 + length
+            name = comment.split(b'=', 1)[0].decode(errors='replace').upper()
+            if name not in replaced:
+                comments.append(comment)
+
+    for key, value in values.items():
+        comments.append(_VORBIS_FIELDS[key][0].encode() + b'=' + value.encode())
+
+    return (struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(comments)) +
+            b''.join(struct.pack('<I', len(comment)) + comment for comment in comments))
+
+
+def _write_flac(path: Path, values: dict[str, str]) -> None:
+    blocks: list[tuple[int, bytes]] = []
+    with path.open('rb') as file:
+        if file.read(4) != b'fLaC':
+            raise UnsupportedFileError('missing FLAC signature')
+        last = False
+        while not last:
+            header = file.read(4)
+            if len(header) != 4:
+                raise UnsupportedFileError('truncated metadata')
+            last = bool(header[0] & 0x80)
+            block_type = header[0] & 0x7f
+            data = file.read(int.from_bytes(header[1:], 'big'))
+            if block_type != _FLAC_PADDING:
+                blocks.append((block_type, data))
+        audio_offset = file.tell()
+
+    if not blocks or blocks[0][0] != _FLAC_STREAMINFO:
+        raise UnsupportedFileError('STREAMINFO must be the first metadata block')
+
+    old_comment = next((data for block_type, data in blocks if block_type == _FLAC_VORBIS_COMMENT), None)
+    comment = _vorbis_comment(old_comment, values)
+    if old_comment is None:
+        blocks.insert(1, (_FLAC_VORBIS_COMMENT, comment))
+    else:
+        blocks = [(block_type, comment if block_type == _FLAC_VORBIS_COMMENT else data)
+                  for block_type, data in blocks]
+
+    def metadata(padding: int | None) -> bytes:
+        encoded = [_flac_block(block_type, data, padding is None and i == len(blocks) - 1)
+                   for i, (block_type, data) in enumerate(blocks)]
+        if padding is not None:
+            encoded.append(_flac_block(_FLAC_PADDING, bytes(padding), True))
+        return b''.join(encoded)
+
+    available = audio_offset - 4
+    needed = len(metadata(None))
+    if needed == available:
+        log.info('Writing FLAC metadata in place: %s', path)
+        _write_in_place(path, 4, metadata(None))
+    elif needed + 4 <= available:
+        log.info('Writing FLAC metadata in place, using padding: %s', path)
+        _write_in_place(path, 4, metadata(available - needed - 4))
+    else:
+        log.info('Rewriting FLAC file, metadata does not fit in padding: %s', path)
+        _rewrite(path, b'fLaC' + metadata(PADDING), audio_offset)
+
+
+# MP3 with ID3v2.3 or ID3v2.4 tag
+
+# ffmpeg metadata keys to ID3 frame identifiers
+_ID3_FRAMES: dict[str, bytes] = {'album': id3.ALBUM,
+                                 'artist': id3.ARTIST,
+                                 'title': id3.TITLE,
+                                 'album_artist': id3.ALBUM_ARTIST,
+                                 'track': id3.TRACK_NUMBER,
+                                 'genre': id3.GENRE}
+
+
+_ID3_TEXT_ENCODINGS = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}
+
+
+def _id3_user_text_description(data: bytes) -> str:
+    encoding = _ID3_TEXT_ENCODINGS.get(data[0], 'latin-1') if data else 'latin-1'
+    return data[1:].decode(encoding, errors='replace').split('\x00', 1)[0]
+
+
+def _id3_is_replaced(frame_id: bytes, data: bytes, values: dict[str, str]) -> bool:
+    if frame_id in (id3.YEAR, id3.RECORDING_TIME):
+        return 'date' in values
+    if frame_id == id3.LYRICS:
+        return 'lyrics' in values
+    if frame_id == id3.USER_TEXT:
+        # ffmpeg writes lyrics as a user defined text frame with 'USLT' description, and reads it
+        # back as lyrics, just like user defined text frames with a 'lyrics' description
+        description = _id3_user_text_description(data).lower()
+        return 'lyrics' in values and (description == 'uslt' or description.startswith('lyrics'))
+    return any(_ID3_FRAMES.get(key) == frame_id for key in values)
+
+
+def _id3_frames(values: dict[str, str], version: int) -> list[bytes]:
+    frames: list[bytes] = []
+    for key, value in values.items():
+        if key == 'date':
+            frames.append(id3.text_frame(id3.RECORDING_TIME if version == 4 else id3.YEAR, value, version))
+        elif key == 'lyrics':
+            frames.append(id3.lyrics_frame(value, version))
+        else:
+            frames.append(id3.text_frame(_ID3_FRAMES[key], value, version))
+    return frames
+
+
+def _write_mp3(path: Path, values: dict[str, str]) -> None:
+    with path.open('rb') as file:
+        header = file.read(10)
+        if len(header) == 10 and header[:3] == b'ID3':
+            version = header[3]
+            if version not in (3, 4) or header[5] != 0:
+                # Unsynchronisation, extended headers and footers are not supported
+                raise UnsupportedFileError(f'ID3v2.{version} tag with flags {header[5]}')
+            tag_size = id3.parse_sync_safe(header[6:10])
+            tag_data = file.read(tag_size)
+        else:
+            version = 3
+            tag_size = None
+            tag_data = b''
+
+        if path.stat().st_size >= 128:
+            file.seek(-128, os.SEEK_END)
+            if file.read(3) == b'TAG':
+                raise UnsupportedFileError('file has an ID3v1 tag')
+
+    frames: list[bytes] = []
+    pos = 0
+    while pos + 10 <= len(tag_data) and tag_data[pos] != 0:
+        frame_id = tag_data[pos:pos+4]
+        size_bytes = tag_data[pos+4:pos+8]
+        size = id3.parse_sync_safe(size_bytes) if version == 4 else int.from_bytes(size_bytes, 'big')
+        end = pos + 10 + size
+        if not frame_id.isalnum() or end > len(tag_data):
+            raise UnsupportedFileError('invalid ID3 frame')
+        if not _id3_is_replaced(frame_id, tag_data[pos+10:end], values):
+            frames.append(tag_data[pos:end])
+        pos = end
+
+    frames.extend(_id3_frames(values, version))
+    body = b''.join(frames)
+
+    def tag(size: int) -> bytes:
+        return b'ID3' + bytes((version, 0, 0)) + id3.sync_safe(size) + body + bytes(size - len(body))
+
+    if tag_size is not None and len(body) <= tag_size:
+        log.info('Writing ID3 tag in place: %s', path)
+        _write_in_place(path, 0, tag(tag_size))
+    else:
+        log.info('Rewriting MP3 file, tag does not fit in padding: %s', path)
+        _rewrite(path, tag(len(body) + PADDING), 0 if tag_size is None else 10 + tag_size)
+
+
+_WRITERS = {'.flac': _write_flac,
+            '.mp3': _write_mp3}
+
+
+def write(path: Path, values: dict[str, str]) -> bool:
+    """
+    Write tags to a file, keeping other existing tags
+    Args:
+        path: Music file
+        values: Tags, see Metadata.tag_values()
+    Returns: True if tags were written, False if the file needs to be written using ffmpeg instead
+    """
+    writer = _WRITERS.get(path.suffix.lower())
+    if writer is None:
+        return False
+
+    try:
+        writer(path, values)
+        return True
+    except UnsupportedFileError as ex:
+        log.info('Cannot write tags natively to %s: %s', path, ex)
+        return False
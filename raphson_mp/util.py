@@ -1,16 +1,27 @@
+import hashlib
 import logging
-from collections.abc import Iterator
+import unicodedata
+from collections.abc import Callable, Iterator
+from datetime import datetime
 from io import IOBase
 from pathlib import Path
 from queue import Queue
+from sqlite3 import Connection
 from threading import Thread
 from typing import override
+from urllib.parse import quote
 from zipfile import ZipFile
 
 from flask import Response, request
+from werkzeug.datastructures import ContentRange
+from werkzeug.http import dump_options_header
+
+from raphson_mp import settings
 
 log = logging.getLogger(__name__)
 
+CHUNK_SIZE = 64*1024
+
 
 def check_filename(name: str) -> None:
     """
@@ -71,6 +82,20 @@ def _send_directory(queue_io: QueueIO, path: Path):
 
     queue_io.close()
 
+def content_disposition(filename: str) -> str:
+    """
+    Content-Disposition header value to download a file with the given name. Like send_file(),
+    non-ASCII names are encoded according to RFC 5987, with an ASCII fallback for older clients.
+    """
+    try:
+        filename.encode('ascii')
+        names = {'filename': filename}
+    except UnicodeEncodeError:
+        fallback = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': fallback, 'filename*': "UTF-8''" + quote(filename, safe="!#$&+-.^_`|~")}
+    return dump_options_header('attachment', names)
+
+
 def send_directory(path: Path):
     """
     Flask response sending directory contents as ZipFile
@@ -80,5 +105,192 @@ def send_directory(path: Path):
     queue_io = QueueIO()
     Thread(target=_send_directory, args=(queue_io, path)).start()
     response = Response(queue_io.iterator(), direct_passthrough=True, mimetype='application/zip')
-    response.headers['Content-Disposition'] = f'attachment; filename="{path.name}.zip"'
+    response.headers['Content-Disposition'] = content_disposition(path.name + '.zip')
     return response
+
+
+def file_reader(path: Path) -> Callable[[int, int], Iterator[bytes]]:
+    """
+    Returns: Function reading part of a file in chunks, for use with send_ranged()
+    """
+    def read(start: int, length: int) -> Iterator[bytes]:
+        with path.open('rb') as fp:
+            fp.seek(start)
+            while length > 0:
+                chunk = fp.read(min(length, CHUNK_SIZE))
+                if not chunk:
+                    return
+                length -= len(chunk)
+                yield chunk
+    return read
+
+
+def blob_reader(connect: Callable[[], Connection],
+                table: str,
+                column: str,
+                rowid: int) -> Callable[[int, int], Iterator[bytes]]:
+    """
+    Returns: Function reading part of a BLOB in chunks using incremental BLOB I/O, for use with
+    send_ranged(). Only the requested part is read, the BLOB is never loaded into memory entirely.
+    Args:
+        connect: Function creating a read only database connection. The response is sent after the
+                 request handler has closed its connection, so a new connection is created.
+    """
+    def read(start: int, length: int) -> Iterator[bytes]:
+        with connect() as conn, conn.blobopen(table, column, rowid, readonly=True) as blob:
+            blob.seek(start)
+            while length > 0:
+                chunk = blob.read(min(length, CHUNK_SIZE))
+                if not chunk:
+                    return
+                length -= len(chunk)
+                yield chunk
+    return read
+
+
+def _is_not_modified(etag: str | None, last_modified: datetime | None) -> bool:
+    if request.if_none_match:
+        return etag is not None and request.if_none_match.contains(etag)
+    if request.if_modified_since and last_modified is not None:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def _if_range_matches(etag: str | None, last_modified: datetime | None) -> bool:
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return last_modified is not None and last_modified.replace(microsecond=0) <= if_range.date
+    return True  # no If-Range header
+
+
+def send_ranged(read: Callable[[int, int], Iterator[bytes]],
+                length: int,
+                mimetype: str,
+                etag: str | None = None,
+                last_modified: datetime | None = None) -> Response:
+    """
+    Flask response supporting conditional requests and single part range requests. Data is
+    streamed to the client, only the requested part is read.
+    Args:
+        read: Function returning an iterator of data chunks, given a start offset and length
+        length: Total length of data
+        mimetype: Content type
+        etag: Strong entity tag
+        last_modified: Last modification time
+    """
+    if _is_not_modified(etag, last_modified):
+        response = Response(None, 304)
+        if etag:
+            response.set_etag(etag)
+        response.last_modified = last_modified
+        return response
+
+    start, stop = 0, length
+    status = 200
+    content_range = None
+
+    # Multipart ranges are not supported, the full response is sent instead
+    if request.range and len(request.range.ranges) == 1 and _if_range_matches(etag, last_modified):
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            response = Response(None, 416)
+            response.content_range = ContentRange('bytes', None, None, length)
+            return response
+        start, stop = byte_range
+        status = 206
+        content_range = ContentRange('bytes', start, stop, length)
+
+    response = Response(read(start, stop - start), status, mimetype=mimetype, direct_passthrough=True)
+    response.content_length = stop - start
+    response.content_range = content_range
+    response.accept_ranges = 'bytes'
+    if etag:
+        response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+
+def _offload_header(path: Path) -> tuple[str, str] | None:
+    """
+    Returns: Header instructing the reverse proxy to send the file, or None if the proxy can't access it
+    """
+    path = path.resolve()
+
+    if settings.proxy_offload == 'sendfile':
+        # Header values are latin-1 in WSGI, send the raw UTF-8 bytes of the path
+        return 'X-Sendfile', path.as_posix().encode().decode('latin-1')
+
+    # Internal locations in the nginx configuration, see docker/nginx/default.conf
+    for location, directory in (('/internal/music/', settings.music_dir),
+                                ('/internal/cache/', settings.data_dir / 'cache')):
+        directory = directory.resolve()
+        if path.is_relative_to(directory):
+            return 'X-Accel-Redirect', location + quote(path.relative_to(directory).as_posix())
+
+    return None
+
+
+def send_offloaded(path: Path,
+                   mimetype: str,
+                   etag: str | None = None,
+                   last_modified: datetime | None = None) -> Response | None:
+    """
+    Let the reverse proxy send a file, if enabled using --proxy-offload, so the file contents don't
+    pass through a worker thread. Conditional requests are handled here, range requests by the proxy.
+    Returns: Response without body, or None if the file must be sent by the application.
+    """
+    if settings.proxy_offload is None:
+        return None
+
+    header = _offload_header(path)
+    if header is None:
+        log.warning('Reverse proxy cannot access file, sending it from the application: %s', path)
+        return None
+
+    if _is_not_modified(etag, last_modified):
+        response = Response(None, 304)
+    else:
+        response = Response(None, mimetype=mimetype)
+        response.headers[header[0]] = header[1]
+    if etag:
+        response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+
+def send_ranged_file(path: Path,
+                     mimetype: str,
+                     etag: str | None = None,
+                     last_modified: datetime | None = None) -> Response:
+    """
+    send_ranged() for a file on disk, or send_offloaded() if enabled
+    """
+    response = send_offloaded(path, mimetype, etag, last_modified)
+    if response is not None:
+        return response
+    return send_ranged(file_reader(path), path.stat().st_size, mimetype, etag, last_modified)
+
+
+def send_ranged_mp3(tag: bytes,
+                    audio_path: Path,
+                    last_modified: datetime | None = None) -> Response:
+    """
+    send_ranged() for an MP3 file made of an ID3 tag followed by cached audio without tags
+    """
+    tag_length = len(tag)
+    read_audio = file_reader(audio_path)
+
+    def read(start: int, length: int) -> Iterator[bytes]:
+        if start < tag_length:
+            part = tag[start:start + length]
+            yield part
+            start += len(part)
+            length -= len(part)
+        if length > 0:
+            yield from read_audio(start - tag_length, length)
+
+    # Cached audio files are named after a hash of their contents
+    etag = hashlib.sha256(tag).hexdigest()[:32] + audio_path.name[:32]
+    return send_ranged(read, tag_length + audio_path.stat().st_size, 'audio/mp3', etag, last_modified)
@@ -0,0 +1,239 @@
+"""
+Background warm-up: hash and measure loudness of new tracks, and transcode new and changed tracks
+before they are first played
+"""
+import logging
+import os
+import time
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Lock, Thread
+
+from raphson_mp import db, jobs, music, scanner, settings
+
+log = logging.getLogger(__name__)
+
+# Audio types requested by the music player. MP3_WITH_METADATA is only used for downloads.
+WARMUP_AUDIO_TYPES = [music.AudioType.WEBM_OPUS_HIGH, music.AudioType.WEBM_OPUS_LOW, music.AudioType.MP4_AAC]
+
+POLL_INTERVAL = 60
+
+_interactive_lock = Lock()
+_interactive_count = 0
+
+# Progress, exported as metrics by prometheus.py
+pending: int = 0
+completed: int = 0
+failed: int = 0
+paused: bool = False
+
+
+def _position_path() -> Path:
+    return settings.data_dir / 'warmup_position'
+
+
+def _get_position() -> int:
+    try:
+        return int(_position_path().read_text(encoding='utf-8'))
+    except FileNotFoundError:
+        return 0
+
+
+def _set_position(position: int) -> None:
+    _position_path().write_text(str(position), encoding='utf-8')
+
+
+def worker_count() -> int:
+    """
+    Returns: Number of tracks to warm up concurrently. By default, half of the CPU cores are used
+    so enough capacity is left for interactive requests.
+    """
+    if settings.warmup_workers:
+        return settings.warmup_workers
+    return max(1, (os.cpu_count() or 1) // 2)
+
+
+@contextmanager
+def interactive() -> Iterator[None]:
+    """
+    Context manager to wrap around work that a user is waiting for. Warm-up is paused while
+    interactive work is in progress.
+    """
+    global _interactive_count
+    with _interactive_lock:
+        _interactive_count += 1
+    try:
+        yield
+    finally:
+        with _interactive_lock:
+            _interactive_count -= 1
+
+
+def _wait_for_interactive() -> None:
+    global paused
+    while _interactive_count > 0:
+        paused = True
+        time.sleep(1)
+    paused = False
+
+
+def _warm_track(relpath: str, transcode: bool) -> None:
+    """
+    Runs in a worker thread
+    Args:
+        transcode: Whether to transcode audio. Video is remuxed if enabled using --scan-video.
+    """
+    if transcode:
+        with db.connect(read_only=True) as conn:
+            row = conn.execute('SELECT mtime FROM track WHERE path=? AND loudness_i IS NULL AND loudness_failed = 0',
+                               (relpath,)).fetchone()
+
+        if row:
+            # Track was added after loudness was measured for pending tracks, see _analyse_pending().
+            # Measure it first, because audio is normalized using the measured loudness.
+            scanner.measure_loudness(relpath, row[0])
+
+    with db.connect(read_only=True) as conn:
+        track = music.Track.by_relpath(conn, relpath)
+        if track is None:
+            # Track has been deleted since it was scanned
+            return
+
+        if transcode:
+            track.transcoded_audio_batch(WARMUP_AUDIO_TYPES, jobs.Priority.WARMUP)
+
+        if settings.scan_video and track.metadata().video in music.VIDEO_FORMATS:
+            track.remuxed_video(jobs.Priority.WARMUP)
+
+
+def _analyse_pending(executor: ThreadPoolExecutor, max_in_flight: int) -> None:
+    """
+    Hash audio and measure loudness of all tracks for which it is not known yet. Hashes are
+    computed first, because they are part of the audio cache key.
+    """
+    with db.connect(read_only=True) as conn:
+        tasks = [(scanner.hash_audio, relpath, mtime) for relpath, mtime in scanner.unhashed_tracks(conn)] + \
+                [(scanner.measure_loudness, relpath, mtime) for relpath, mtime in scanner.unmeasured_tracks(conn)]
+    if not tasks:
+        return
+
+    log.info('Analysing %s tracks', len(tasks))
+
+    in_flight: list[tuple[str, Future[None]]] = []
+
+    def wait_oldest() -> None:
+        relpath, future = in_flight.pop(0)
+        try:
+            future.result()
+        except Exception:
+            log.exception('Failed to analyse track: %s', relpath)
+
+    for function, relpath, mtime in tasks:
+        _wait_for_interactive()
+        if len(in_flight) >= max_in_flight:
+            wait_oldest()
+        in_flight.append((relpath, executor.submit(function, relpath, mtime)))
+
+    while in_flight:
+        wait_oldest()
+
+
+def _pending_tracks(position: int) -> list[tuple[int, str]]:
+    with db.connect(read_only=True) as conn:
+        return conn.execute('''
+                            SELECT MAX(id), track
+                            FROM scanner_log
+                            WHERE id > ? AND action IN ('insert', 'update')
+                            GROUP BY track
+                            ORDER BY MAX(id)
+                            ''', (position,)).fetchall()
+
+
+def run_once(executor: ThreadPoolExecutor, max_in_flight: int, transcode: bool) -> None:
+    """
+    Hash and measure loudness of new tracks, and warm up all tracks inserted or updated since the
+    last run
+    Args:
+        transcode: False to not transcode audio. Tracks are still hashed and their loudness is
+                   measured, and video is remuxed if enabled using --scan-video.
+    """
+    global pending
+
+    _analyse_pending(executor, max_in_flight)
+
+    if not transcode and not settings.scan_video:
+        return
+
+    position = _get_position()
+    tracks = _pending_tracks(position)
+    pending = len(tracks)
+    if pending == 0:
+        return
+
+    log.info('Warming up %s tracks', pending)
+
+    in_flight: list[tuple[int, str, Future[None]]] = []
+
+    def wait_oldest() -> None:
+        global pending, completed, failed
+        log_id, relpath, future = in_flight.pop(0)
+        try:
+            future.result()
+            completed += 1
+        except Exception:
+            log.exception('Failed to warm up track: %s', relpath)
+            failed += 1
+        pending -= 1
+        # Jobs are completed in order, so the position can be saved
+        _set_position(log_id)
+
+    for log_id, relpath in tracks:
+        _wait_for_interactive()
+        if len(in_flight) >= max_in_flight:
+            wait_oldest()
+        in_flight.append((log_id, relpath, executor.submit(_warm_track, relpath, transcode)))
+
+    while in_flight:
+        wait_oldest()
+
+
+def _executor(workers: int) -> ThreadPoolExecutor:
+    # The work is done by ffmpeg processes, worker threads only wait for them. Threads are used
+    # instead of processes, so ffmpeg is started through the job scheduler of this process: warm-up
+    # jobs count towards --max-jobs and the warm-up class limit, and are included in the metrics.
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='warmup-worker')
+
+
+def run() -> None:
+    """
+    Warm up pending tracks in the foreground, for the warmup command
+    """
+    workers = worker_count()
+    with _executor(workers) as executor:
+        run_once(executor, workers, True)
+
+
+def _run_forever() -> None:
+    workers = worker_count()
+    log.info('Starting warm-up with %s workers', workers)
+    with _executor(workers) as executor:
+        while True:
+            try:
+                run_once(executor, workers, settings.warmup)
+            except Exception:
+                log.exception('Warm-up failed')
+            time.sleep(POLL_INTERVAL)
+
+
+def start() -> None:
+    """
+    Start warm-up in a background thread. Tracks are always hashed and their loudness is always
+    measured. Audio is only transcoded if warm-up is enabled, and video is only remuxed if
+    --scan-video is enabled.
+    """
+    if settings.offline_mode:
+        return
+
+    Thread(target=_run_forever, daemon=True, name='warmup').start()
@@ -1,16 +1,24 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
 import os
 import random
+import re
 import secrets
+import subprocess
 from tempfile import TemporaryDirectory
+import time
 import tracemalloc
 from typing import Any, cast, override
 import unittest
 from pathlib import Path
+from threading import Event, Thread
 
+from flask import Flask
 from flask.testing import FlaskClient
 
-from raphson_mp import auth, main, packer, reddit, settings
+from raphson_mp import auth, cache, db, id3, jobs, main, packer, reddit, settings, tags, util, warmup
 from raphson_mp.lyrics import AZLyricsFetcher, GeniusFetcher, LrcLibFetcher, PlainLyrics, TimeSyncedLyrics
+from raphson_mp.metadata import Metadata
 from raphson_mp.spotify import SpotifyClient
 
 tracemalloc.start()
@@ -23,6 +31,45 @@ settings.data_dir = Path('./data').resolve()
 settings.music_dir = Path('./music').resolve()
 
 
+@contextmanager
+def temp_data_dir() -> Iterator[Path]:
+    """
+    Use an empty data directory with new databases
+    """
+    data_dir = settings.data_dir
+    with TemporaryDirectory() as tempdir:
+        settings.data_dir = Path(tempdir)
+        try:
+            db.migrate()
+            yield settings.data_dir
+        finally:
+            settings.data_dir = data_dir
+
+
+def ffmpeg_metadata(path: Path) -> dict[str, str]:
+    """
+    Read tags using ffmpeg, independently of the tag writers
+    """
+    output = subprocess.run(['ffmpeg', '-v', 'error', '-i', path.as_posix(), '-f', 'ffmetadata', '-'],
+                            capture_output=True, text=True, check=True).stdout
+    values: dict[str, str] = {}
+    # Special characters, including newlines in values, are escaped using a backslash
+    for line in re.split(r'(?<!\\)\n', output):
+        key, sep, value = line.partition('=')
+        if sep and not key.startswith(';'):
+            values[key] = re.sub(r'\\(.)', r'\1', value, flags=re.DOTALL)
+    return values
+
+
+def mp3_audio() -> bytes:
+    """
+    Returns: One second of MP3 audio without tags
+    """
+    return subprocess.run(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'sine=d=1', '-c:a', 'libmp3lame',
+                           '-write_xing', '0', '-id3v2_version', '0', '-write_id3v1', '0', '-f', 'mp3', '-'],
+                          capture_output=True, check=True).stdout
+
+
 class TestFlask(unittest.TestCase):
     client: FlaskClient  # pyright: ignore[reportUninitializedInstanceVariable]
 
@@ -92,6 +139,349 @@ class TestPacker(unittest.TestCase):
             assert result == a + b
 
 
+class TestRanged(unittest.TestCase):
+    def test_range(self):
+        data = os.urandom(1000)
+        with TemporaryDirectory() as tempdir:
+            path = Path(tempdir, 'data')
+            path.write_bytes(data)
+            app = Flask(__name__)
+
+            with app.test_request_context(headers={'Range': 'bytes=100-199'}):
+                response = util.send_ranged_file(path, 'application/octet-stream', etag='test')
+                assert response.status_code == 206
+                assert response.headers['Content-Range'] == 'bytes 100-199/1000'
+                assert b''.join(response.response) == data[100:200]
+
+            with app.test_request_context(headers={'Range': 'bytes=2000-'}):
+                response = util.send_ranged_file(path, 'application/octet-stream', etag='test')
+                assert response.status_code == 416
+
+            with app.test_request_context(headers={'If-None-Match': '"test"'}):
+                response = util.send_ranged_file(path, 'application/octet-stream', etag='test')
+                assert response.status_code == 304
+
+            with app.test_request_context():
+                response = util.send_ranged_file(path, 'application/octet-stream', etag='test')
+                assert response.status_code == 200
+                assert b''.join(response.response) == data
+
+    def test_blob(self):
+        data = os.urandom(200_000)
+        with TemporaryDirectory() as tempdir:
+            def connect():
+                return db.ClosingConnection(Path(tempdir, 'test.db'))
+
+            with connect() as conn:
+                conn.execute('CREATE TABLE content (data BLOB)')
+                rowid = conn.execute('INSERT INTO content VALUES (?)', (data,)).lastrowid
+                assert rowid is not None
+
+            read = util.blob_reader(connect, 'content', 'data', rowid)
+            assert b''.join(read(0, len(data))) == data
+            assert b''.join(read(100_000, 100)) == data[100_000:100_100]
+            assert b''.join(read(199_990, 100)) == data[199_990:]
+
+    def test_offload(self):
+        app = Flask(__name__)
+        path = settings.music_dir / 'Playlist' / 'a b.flac'
+        try:
+            settings.proxy_offload = 'nginx'
+            with app.test_request_context(headers={'Range': 'bytes=100-199'}):
+                response = util.send_offloaded(path, 'audio/flac')
+                assert response is not None
+                assert response.status_code == 200
+                assert response.headers['X-Accel-Redirect'] == '/internal/music/Playlist/a%20b.flac'
+
+            settings.proxy_offload = 'sendfile'
+            with app.test_request_context():
+                response = util.send_offloaded(path, 'audio/flac')
+                assert response is not None
+                assert response.headers['X-Sendfile'] == path.as_posix()
+        finally:
+            settings.proxy_offload = None
+
+        with app.test_request_context():
+            assert util.send_offloaded(path, 'audio/flac') is None
+
+    def test_content_disposition(self):
+        assert util.content_disposition('a b.flac') == 'attachment; filename="a b.flac"'
+        assert util.content_disposition('"ü".flac') == \
+            'attachment; filename="\\"u\\".flac"; filename*=UTF-8\'\'%22%C3%BC%22.flac'
+
+
+class TestJobs(unittest.TestCase):
+    def test_priority(self):
+        max_jobs = settings.max_jobs
+        settings.max_jobs = 1
+        try:
+            started: list[jobs.Priority] = []
+
+            def job(priority: jobs.Priority):
+                with jobs.slot(priority):
+                    started.append(priority)
+
+            with jobs.slot(jobs.Priority.INTERACTIVE):
+                warmup_thread = Thread(target=job, args=(jobs.Priority.WARMUP,))
+                warmup_thread.start()
+                time.sleep(0.1)
+                interactive_thread = Thread(target=job, args=(jobs.Priority.INTERACTIVE,))
+                interactive_thread.start()
+                time.sleep(0.1)
+                assert jobs.queue_depth(jobs.Priority.WARMUP) == 1
+                assert jobs.queue_depth(jobs.Priority.INTERACTIVE) == 1
+
+                with self.assertRaises(jobs.QueueTimeout):
+                    with jobs.slot(jobs.Priority.PREFETCH, timeout=0.1):
+                        pass
+
+            warmup_thread.join()
+            interactive_thread.join()
+            assert started == [jobs.Priority.INTERACTIVE, jobs.Priority.WARMUP]
+        finally:
+            settings.max_jobs = max_jobs
+
+    def test_record(self):
+        with temp_data_dir():
+            # Statistics are recorded while the caller holds a write transaction
+            with db.connect() as conn:
+                conn.execute("INSERT INTO playlist (path) VALUES ('test')")
+                start_time = time.monotonic()
+                jobs.run(['true'], jobs.Priority.INTERACTIVE, 'test', 'test/track')
+                assert time.monotonic() - start_time < 5
+
+            jobs.flush()
+            with db.connect(read_only=True) as conn:
+                row = conn.execute("SELECT track, returncode FROM transcode WHERE kind = 'test'").fetchone()
+                assert row == ('test/track', 0), row
+
+    def test_warmup_recorded(self):
+        # Warm-up jobs go through the scheduler and observers of this process
+        observed: list[jobs.ProcessStats] = []
+        jobs.observers.append(observed.append)
+        try:
+            with temp_data_dir():
+                started = jobs.started[jobs.Priority.WARMUP]
+                with warmup._executor(1) as executor:
+                    executor.submit(jobs.run, ['true'], jobs.Priority.WARMUP, 'test').result()
+                assert jobs.started[jobs.Priority.WARMUP] == started + 1
+                assert [stats.priority for stats in observed] == [jobs.Priority.WARMUP]
+                jobs.flush()
+        finally:
+            jobs.observers.remove(observed.append)
+
+
+class TestCache(unittest.TestCase):
+    def test_memory(self):
+        cache_memory_mb = settings.cache_memory_mb
+        settings.cache_memory_mb = 1
+        try:
+            memory = cache._MemoryCache()
+            entry = os.urandom(cache.MEMORY_MAX_ENTRY_SIZE)
+            for i in range(16):
+                memory.put(f'key{i}', entry, time.time() + 60)
+            memory.get('key0')
+            memory.put('key16', entry, time.time() + 60)
+            # least recently used entry is evicted to stay within budget
+            assert memory.size == 1024 * 1024
+            assert memory.get('key0') == entry
+            assert memory.get('key1') is None
+
+            memory.put('large', os.urandom(cache.MEMORY_MAX_ENTRY_SIZE + 1), time.time() + 60)
+            assert memory.get('large') is None
+
+            memory.put('expired', b'data', time.time() - 1)
+            assert memory.get('expired') is None
+        finally:
+            settings.cache_memory_mb = cache_memory_mb
+
+    def test_namespace(self):
+        assert cache.namespace('audio11loudnormAudioType.WEBM_OPUS_HIGH') == 'audio'
+        assert cache.namespace('segment10-0audio11loudnorm') == 'segment'
+        assert cache.namespace('coverArtistAlbumFalseHIGHWEBP') == 'cover'
+        assert cache.namespace('unknown') == cache.OTHER_NAMESPACE
+
+    def test_evict(self):
+        cache_max_gb = settings.cache_max_gb
+        try:
+            with temp_data_dir():
+                def store(key: str, data: bytes) -> Path:
+                    with cache.temp_file() as temp_file:
+                        temp_file.write(data)
+                        temp_file.flush()
+                        return cache.store_file(key, Path(temp_file.name), cache.DAY)
+
+                shared_data = os.urandom(200_000)
+                shared_path = store('a', shared_data)
+                store('b', shared_data)
+                path = store('c', os.urandom(200_000))
+                # Recently written files are not deleted, see EVICT_MIN_FILE_AGE
+                old = time.time() - cache.EVICT_MIN_FILE_AGE - 60
+                os.utime(shared_path, (old, old))
+                os.utime(path, (old, old))
+
+                now = int(time.time())
+                with db.cache() as conn:
+                    assert cache._total_size(conn) == 400_000  # pyright: ignore[reportPrivateUsage]
+                    for key, days in [('a', 5), ('b', 4), ('c', 1)]:
+                        conn.execute('UPDATE cache SET last_access=? WHERE key=?', (now - days * cache.DAY, key))
+
+                # Both entries referencing the least recently used file must be evicted to free space
+                settings.cache_max_gb = 300_000 / 1024**3
+                assert cache.evict() == 2
+                assert not shared_path.exists()
+                assert path.exists()
+                with db.cache(read_only=True) as conn:
+                    assert [key for key, in conn.execute('SELECT key FROM cache')] == ['c']
+                    assert cache._total_size(conn) == 200_000  # pyright: ignore[reportPrivateUsage]
+        finally:
+            settings.cache_max_gb = cache_max_gb
+
+    def test_store_stream(self):
+        with temp_data_dir():
+            chunks = [os.urandom(cache.EXTERNAL_MIN_SIZE) for _i in range(3)]
+            released = Event()
+
+            # Data is stored completely, even if the client stops reading after the first chunk
+            stream = cache.store_stream('stream', iter(chunks), cache.DAY, release=released.set)
+            assert b''.join(chunks).startswith(next(stream))
+            stream.close()
+            assert released.wait(5)
+            assert cache.retrieve('stream') == b''.join(chunks)
+            path = cache.retrieve_file('stream')
+            assert path is not None and path.read_bytes() == b''.join(chunks)
+
+            def postprocess(input_path: Path, output_path: Path) -> None:
+                output_path.write_bytes(input_path.read_bytes()[::-1])
+
+            released.clear()
+            stream = cache.store_stream('stream-postprocess', iter(chunks), cache.DAY, postprocess, released.set)
+            assert b''.join(stream) == b''.join(chunks)
+            assert released.wait(5)
+            assert cache.retrieve('stream-postprocess') == b''.join(chunks)[::-1]
+
+            # Incomplete data is not stored
+            def failing() -> Iterator[bytes]:
+                yield chunks[0]
+                raise OSError('test')
+
+            released.clear()
+            with self.assertRaises(RuntimeError):
+                b''.join(cache.store_stream('stream-failed', failing(), cache.DAY, release=released.set))
+            assert released.wait(5)
+            assert cache.retrieve('stream-failed') is None
+
+    def test_write_behind(self):
+        with temp_data_dir():
+            def stored(key: str) -> bool:
+                with db.cache(read_only=True) as conn:
+                    return conn.execute('SELECT 1 FROM cache WHERE key=?', (key,)).fetchone() is not None
+
+            # Small entries can be retrieved before they are written to the database. The writer
+            # thread is blocked while holding the write lock.
+            with cache._write_lock:  # pyright: ignore[reportPrivateUsage]
+                cache.store('pending', b'data', cache.DAY)
+                assert 'pending' in cache._pending  # pyright: ignore[reportPrivateUsage]
+                assert not stored('pending')
+                assert cache.retrieve('pending') == b'data'
+            cache.flush()
+            assert 'pending' not in cache._pending  # pyright: ignore[reportPrivateUsage]
+            assert stored('pending')
+
+            # Without flush(), entries are written by a background thread
+            cache.store('background', b'data', cache.DAY)
+            for _i in range(100):
+                if stored('background'):
+                    break
+                time.sleep(0.05)
+            assert stored('background')
+
+
+class TestTags(unittest.TestCase):
+    def test_flac(self):
+        audio = os.urandom(1000)
+        with TemporaryDirectory() as tempdir:
+            path = Path(tempdir, 'test.flac')
+            # STREAMINFO block, followed by 1000 bytes of padding
+            path.write_bytes(b'fLaC' + b'\x00\x00\x00\x22' + bytes(34) + b'\x81\x00\x03\xe8' + bytes(1000) + audio)
+            size = path.stat().st_size
+            inode = path.stat().st_ino
+
+            assert tags.write(path, {'title': 'Title', 'artist': 'A; B'})
+            data = path.read_bytes()
+            assert path.stat().st_size == size
+            assert path.stat().st_ino == inode
+            assert b'TITLE=Title' in data
+            assert data.endswith(audio)
+
+            # Does not fit in padding, file is rewritten
+            assert tags.write(path, {'title': 'Title', 'lyrics': 'x' * 2000})
+            data = path.read_bytes()
+            assert data.count(b'TITLE=') == 1
+            assert b'ARTIST=A; B' in data
+            assert data.endswith(audio)
+
+            assert not tags.write(Path(tempdir, 'test.webm'), {'title': 'Title'})
+
+    def test_id3(self):
+        meta = Metadata('test/test.mp3', 1, ['Artist A', 'Artist B'], 'Album', 'Tïtle ☃', 2001, 'Album Artist', 3,
+                        ['Pop', 'Rock'], 'Line 1\nLine 2', None)
+        cover = b'\xff\xd8\xff\xe0cover'
+        audio = mp3_audio()
+        with TemporaryDirectory() as tempdir:
+            path = Path(tempdir, 'test.mp3')
+            tag = id3.tag(meta, cover)
+            path.write_bytes(tag + audio)
+
+            values = ffmpeg_metadata(path)
+            assert values['title'] == 'Tïtle ☃'
+            assert values['artist'] == 'Artist A/Artist B'
+            assert values['album'] == 'Album'
+            assert values['album_artist'] == 'Album Artist'
+            assert values['track'] == '3'
+            assert values['date'] == '2001'
+            assert values['genre'] == 'Pop; Rock'
+            assert values['lyrics-XXX'] == 'Line 1\nLine 2'
+            assert b'APIC' in tag and cover in tag
+            assert id3.parse_sync_safe(tag[6:10]) == len(tag) - 10
+
+    def test_mp3(self):
+        audio = mp3_audio()
+        with TemporaryDirectory() as tempdir:
+            path = Path(tempdir, 'test.mp3')
+            # ID3v2.4 tag as written by ffmpeg
+            subprocess.run(['ffmpeg', '-v', 'error', '-f', 'mp3', '-i', '-', '-c', 'copy', '-metadata', 'title=Old',
+                            '-metadata', 'album=Album', '-write_xing', '0', '-write_id3v1', '0', path.as_posix()],
+                           input=audio, capture_output=True, check=True)
+
+            # Tag does not fit, file is rewritten with padding
+            assert tags.write(path, {'title': 'Title', 'artist': 'A; B', 'date': '2001', 'lyrics': 'Lyrics'})
+            values = ffmpeg_metadata(path)
+            assert values['title'] == 'Title'
+            assert values['artist'] == 'A; B'
+            assert values['album'] == 'Album'
+            assert values['date'] == '2001'
+            assert values['lyrics-XXX'] == 'Lyrics'
+            assert path.read_bytes().endswith(audio)
+
+            # Fits in padding, tag is written in place
+            size = path.stat().st_size
+            inode = path.stat().st_ino
+            assert tags.write(path, {'title': 'Tïtle ☃', 'lyrics': 'Line 1\nLine 2'})
+            assert path.stat().st_size == size
+            assert path.stat().st_ino == inode
+            values = ffmpeg_metadata(path)
+            assert values['title'] == 'Tïtle ☃'
+            assert values['artist'] == 'A; B'
+            assert values['lyrics-XXX'] == 'Line 1\nLine 2'
+            assert path.read_bytes().endswith(audio)
+
+            # Not supported natively
+            with path.open('ab') as file:
+                file.write(b'TAG' + bytes(125))
+            assert not tags.write(path, {'title': 'Title'})
+
+
 class TestReddit(unittest.TestCase):
     def test_search(self):
         image_url = reddit.search('test')